@@ -1,12 +1,57 @@
 from langchain_openai import ChatOpenAI
 from langchain_community.chat_models import BedrockChat
 from langchain_core.messages import HumanMessage, SystemMessage
-from typing import Optional, Dict, Any
-from prompts import MultimodalPromptTemplates, DiagramPromptTemplates
-import boto3
+from typing import Optional, Dict, Any, AsyncIterator, List
+from prompts import (
+    MultimodalPromptTemplates,
+    DiagramPromptTemplates,
+    MULTIMODAL_PROMPT_VERSION,
+    DIAGRAM_PROMPT_VERSION
+)
+from scheduler import ProviderScheduler, shared_scheduler, SchedulerOverloaded
+from resilience import Resilience, shared_resilience
+from clients import openai_http_clients, bedrock_runtime_client, bedrock_response_streams
+from svg_utils import SvgStreamExtractor, minify_svg
+from metrics import span, record_stage, record_tokens, record_outcome
+from cascade import check_answer, CascadeStats, DEFAULT_MIN_CONFIDENCE, CASCADE_CHECKS_VERSION
+from image_utils import ImageHandle
 import json
+import logging
+import re
+import time
 from pydantic import BaseModel, Field
 
+logger = logging.getLogger(__name__)
+
+# Prefix of the diagram returned when the Bedrock call fails
+DIAGRAM_ERROR_PREFIX = "Error generating diagram description"
+
+# Rough token cost of one image in a prompt, used for rate limit budgeting
+IMAGE_TOKEN_ESTIMATE = 1000
+
+def estimate_tokens(messages: list, max_tokens: int) -> int:
+    """
+    Estimate the tokens a model call may consume for rate limit budgeting.
+    
+    Args:
+        messages (list): Chat messages of the call
+        max_tokens (int): Completion token limit of the model
+        
+    Returns:
+        int: Approximate prompt tokens plus the completion limit
+    """
+    tokens = max_tokens
+    for message in messages:
+        parts = message.content if isinstance(message.content, list) else [message.content]
+        for part in parts:
+            if isinstance(part, str):
+                tokens += len(part) // 4
+            elif part.get("type") == "text":
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
 class QAResponse(BaseModel):
     """Pydantic model for the QA response format"""
     answer: str = Field(
@@ -15,26 +60,176 @@ class QAResponse(BaseModel):
     subject: str = Field(
         description="The academic subject this question belongs to (e.g., Mathematics, Physics, Biology, etc.)"
     )
+    confidence: Optional[float] = Field(
+        default=None,
+        description="Confidence that the answer is correct and complete, from 0 to 1 (model cascade only)"
+    )
+
+class StreamingAnswerParser:
+    """
+    Incrementally decodes one string field of a streamed JSON object.
+    
+    The model emits {"answer": "...", "subject": "..."} token by token. Each
+    call to feed returns the newly completed characters of the answer string,
+    with JSON escapes already decoded, so they can be forwarded to the client
+    before the object is complete. The full raw text is kept for the final
+    parse once the stream ends.
+    """
+
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field: str = "answer"):
+        """
+        Initialize the parser.
+        
+        Args:
+            field (str): Name of the top level string field to stream
+        """
+        self._field_pattern = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self._buffer = ""
+        self._pos: Optional[int] = None
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        """Raw text received so far."""
+        return self._buffer
+
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk of the streamed response.
+        
+        Args:
+            chunk (str): Next piece of raw model output
+            
+        Returns:
+            str: Newly decoded characters of the field value, possibly empty
+        """
+        self._buffer += chunk
+        if self.done:
+            return ""
+        
+        if self._pos is None:
+            match = self._field_pattern.search(self._buffer)
+            if match is None:
+                return ""
+            self._pos = match.end()
+        
+        buffer = self._buffer
+        pos = self._pos
+        decoded = []
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.done = True
+                pos += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                pos += 1
+                continue
+            
+            # Escape sequence, wait for the rest of it when it is split across chunks
+            if pos + 1 >= len(buffer):
+                break
+            escape = buffer[pos + 1]
+            if escape != 'u':
+                decoded.append(self._ESCAPES.get(escape, escape))
+                pos += 2
+                continue
+            if pos + 6 > len(buffer):
+                break
+            code = int(buffer[pos + 2:pos + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # High surrogate, combine with the following low surrogate
+                if pos + 12 > len(buffer):
+                    break
+                low = int(buffer[pos + 8:pos + 12], 16)
+                decoded.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                pos += 12
+            else:
+                decoded.append(chr(code))
+                pos += 6
+        
+        self._pos = pos
+        return "".join(decoded)
+
+class ModelTier:
+    """One OpenAI model of the MultimodalAgent cascade and its scheduler lane."""
+
+    def __init__(self, model_id: str, model: Any):
+        self.model_id = model_id
+        self.provider = f"openai:{model_id}"
+        self.model = model
 
 class MultimodalAgent:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, scheduler: Optional[ProviderScheduler] = None,
+                 models: Optional[List[str]] = None, min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+                 resilience: Optional[Resilience] = None):
         """
         Initialize the MultimodalAgent.
         
+        With more than one model the agent runs a cascade: each model but the
+        last answers first, and its answer is returned unless cheap local
+        checks (parse success, self-reported confidence, answer length,
+        hedging and LaTeX sanity) send the question on to the next model.
+        
         Args:
             api_key (str): OpenAI API key
+            scheduler (ProviderScheduler, optional): Admission control for OpenAI calls,
+                defaults to the process-wide scheduler
+            models (List[str], optional): Models from cheapest to strongest, gpt-4o alone by default
+            min_confidence (float): Lowest self-reported confidence a cheaper model's answer is accepted with
+            resilience (Resilience, optional): Deadlines, retries, circuit breakers and hedging of
+                OpenAI calls, defaults to the process-wide resilience layer
         """
-        self.model = ChatOpenAI(
-            model="gpt-4o",
-            api_key=api_key,
-            max_tokens=1000,
-            model_kwargs={
-                "response_format": {"type": "json_object"}
-            }
+        models = models or ["gpt-4o"]
+        # Cached answers of the cascade and of a single model must not be mixed up
+        self.model_id = ">".join(models)
+        self.prompt_version = (
+            MULTIMODAL_PROMPT_VERSION if len(models) == 1
+            else f"{MULTIMODAL_PROMPT_VERSION}-cascade{CASCADE_CHECKS_VERSION}"
         )
+        self.max_tokens = 1000
+        self.min_confidence = min_confidence
+        self.scheduler = scheduler or shared_scheduler
+        self.resilience = resilience or shared_resilience
+        http_client, http_async_client = openai_http_clients()
+        self.tiers = [
+            ModelTier(model_id, ChatOpenAI(
+                model=model_id,
+                api_key=api_key,
+                max_tokens=self.max_tokens,
+                # Retried by the resilience layer, within the request deadline
+                max_retries=0,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                model_kwargs={
+                    "response_format": {"type": "json_object"}
+                }
+            ))
+            for model_id in models
+        ]
+        # Streaming always uses the strongest model: streamed tokens cannot be taken back
+        self.provider = self.tiers[-1].provider
+        self.cascade = CascadeStats()
         self.prompt_templates = MultimodalPromptTemplates()
 
-    def _parse_openai_response(self, content: str) -> Dict[str, Any]:
+    @property
+    def model(self) -> Any:
+        """Chat model of the strongest tier."""
+        return self.tiers[-1].model
+
+    @model.setter
+    def model(self, model: Any) -> None:
+        self.tiers[-1].model = model
+
+    @property
+    def providers(self) -> List[str]:
+        """Scheduler lanes of all tiers."""
+        return [tier.provider for tier in self.tiers]
+
+    def _validate_response(self, content: str) -> Optional[QAResponse]:
         """
         Parse OpenAI response using Pydantic model.
         
@@ -42,7 +237,7 @@ class MultimodalAgent:
             content (str): Raw response content from OpenAI
             
         Returns:
-            dict: Validated and parsed response
+            QAResponse: Validated response, None if it could not be parsed
         """
         try:
             # Clean the input content if needed
@@ -53,30 +248,41 @@ class MultimodalAgent:
                 content = json.loads(content)
             
             # Validate and parse using Pydantic model
-            response = QAResponse(**content)
-            
-            # Return as dictionary
-            return response.model_dump()
+            return QAResponse(**content)
             
         except Exception as e:
-            print(f"Error parsing response: {e}")
-            print(f"Problematic content: {content}")
+            logger.warning("Error parsing response: %s", e)
+            logger.debug("Problematic content: %s", content)
+            return None
+
+    def _parse_openai_response(self, content: str) -> Dict[str, Any]:
+        """
+        Parse OpenAI response, falling back to the raw content as the answer.
+        
+        Args:
+            content (str): Raw response content from OpenAI
+            
+        Returns:
+            dict: Validated and parsed response with answer and subject
+        """
+        response = self._validate_response(content)
+        if response is None:
             # Return default response if parsing fails
-            return QAResponse(
-                answer=str(content),
-                subject="General"
-            ).model_dump()
+            response = QAResponse(answer=str(content).strip(), subject="General")
+        return response.model_dump(exclude={"confidence"})
 
-    def process_query(self, question: str, image: Optional[str] = None) -> Dict[str, Any]:
+    def _build_messages(self, question: str, image: Optional[ImageHandle] = None) -> list:
         """
-        Process a query with or without an image.
+        Build the chat messages for a query.
+        
+        In cascade mode the models are also asked for their confidence.
         
         Args:
             question (str): The question to be answered
-            image (str, optional): Base64 encoded image
+            image (ImageHandle, optional): Preprocessed image
             
         Returns:
-            dict: Response from the model with answer and subject
+            list: System and human messages for the model
         """
         # Get the chat prompt template
         chat_prompt = self.prompt_templates.get_chat_prompt()
@@ -96,27 +302,132 @@ class MultimodalAgent:
             },
             "required": ["answer", "subject"]
         }
+        if len(self.tiers) > 1:
+            schema_description["properties"]["confidence"] = {
+                "type": "number",
+                "description": "Your confidence that the answer is correct and complete, from 0 to 1"
+            }
+            schema_description["required"].append("confidence")
         
         # Add the response format to the system message
         system_message = chat_prompt.messages[0].prompt.template
         system_message += f"\n\nYou must respond with a JSON object in the following format:\n{json.dumps(schema_description, indent=2)}"
         
         # Format the messages
-        messages = [
+        return [
             SystemMessage(content=system_message),
             HumanMessage(
                 content=self.prompt_templates.format_human_message(question, image)
             )
         ]
 
-        # Get response from the model
-        response = self.model.invoke(messages)
+    async def _attempt(self, tier: ModelTier, messages: list, deadline: float) -> Any:
+        """Call the model of one tier once, within its scheduler lane."""
+        async with self.scheduler.slot(tier.provider, estimate_tokens(messages, self.max_tokens), deadline) as slot:
+            with span("openai_call"):
+                response = await tier.model.ainvoke(messages)
+            slot.record_usage(response)
+        record_tokens(tier.provider, response)
+        return response
+
+    async def _invoke(self, tier: ModelTier, messages: list) -> Any:
+        """Call the model of one tier with the deadline, retries, breaker and hedging of its provider."""
+        return await self.resilience.call(
+            tier.provider, lambda deadline: self._attempt(tier, messages, deadline)
+        )
+
+    async def process_query(self, question: str, image: Optional[ImageHandle] = None) -> Dict[str, Any]:
+        """
+        Process a query with or without an image.
+        
+        Args:
+            question (str): The question to be answered
+            image (ImageHandle, optional): Preprocessed image
+            
+        Returns:
+            dict: Response from the model with answer and subject
+        """
+        with span("prompt_build"):
+            messages = self._build_messages(question, image)
+
+        # Try the cheaper tiers first, escalating when their answer fails the checks
+        for tier in self.tiers[:-1]:
+            started = time.perf_counter()
+            try:
+                response = await self._invoke(tier, messages)
+            except Exception as e:
+                logger.warning("Cascade tier %s failed, escalating: %s", tier.model_id, e)
+                accepted, reason, parsed = False, "error", None
+            else:
+                with span("openai_parse"):
+                    parsed = self._validate_response(response.content)
+                truncated = response.response_metadata.get("finish_reason") == "length"
+                accepted, reason = check_answer(
+                    parsed.model_dump() if parsed is not None else None, truncated, self.min_confidence
+                )
+            self.cascade.record(tier.model_id, time.perf_counter() - started, accepted, reason)
+            record_outcome("cascade", f"{tier.model_id}:{reason}")
+            if accepted:
+                return parsed.model_dump(exclude={"confidence"})
+
+        # Get response from the strongest model without blocking the event loop
+        tier = self.tiers[-1]
+        started = time.perf_counter()
+        response = await self._invoke(tier, messages)
+        if len(self.tiers) > 1:
+            self.cascade.record(tier.model_id, time.perf_counter() - started, True, "final")
+            record_outcome("cascade", f"{tier.model_id}:final")
         
         # Parse and return the response
-        return self._parse_openai_response(response.content)
+        with span("openai_parse"):
+            return self._parse_openai_response(response.content)
+
+    def cascade_stats(self) -> Dict[str, Any]:
+        """
+        Get the cascade configuration and per-tier hit rates and latencies.
+        
+        Returns:
+            dict: Models from cheapest to strongest, the confidence threshold and tier statistics
+        """
+        return {
+            "models": [tier.model_id for tier in self.tiers],
+            "min_confidence": self.min_confidence,
+            "tiers": self.cascade.stats()
+        }
+
+    async def stream_query(self, question: str, image: Optional[ImageHandle] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Process a query and stream the answer as it is generated.
+        
+        Args:
+            question (str): The question to be answered
+            image (ImageHandle, optional): Preprocessed image
+            
+        Yields:
+            dict: {"type": "token", "text": ...} for every new piece of the
+                answer, then {"type": "result", "answer": ..., "subject": ...}
+                with the fully parsed response
+        """
+        with span("prompt_build"):
+            messages = self._build_messages(question, image)
+        parser = StreamingAnswerParser("answer")
+
+        # Streams are not retried or hedged: their tokens are forwarded as they arrive
+        deadline = self.resilience.admit(self.provider)
+        async with self.scheduler.slot(self.provider, estimate_tokens(messages, self.max_tokens), deadline):
+            with span("openai_call"):
+                async for chunk in self.resilience.stream(self.provider, self.model.astream(messages), deadline):
+                    text = parser.feed(chunk.content)
+                    if text:
+                        yield {"type": "token", "text": text}
+
+        with span("openai_parse"):
+            result = self._parse_openai_response(parser.text)
+        yield {"type": "result", **result}
 
 class DiagramAgent:
-    def __init__(self, aws_access_key: str, aws_secret_key: str, region: str, session_token: str = None):
+    def __init__(self, aws_access_key: str, aws_secret_key: str, region: str, session_token: str = None,
+                 scheduler: Optional[ProviderScheduler] = None, resilience: Optional[Resilience] = None):
         """
         Initialize the DiagramAgent with AWS Bedrock.
         
@@ -125,68 +436,131 @@ class DiagramAgent:
             aws_secret_key (str): AWS secret key
             region (str): AWS region
             session_token (str, optional): AWS session token
+            scheduler (ProviderScheduler, optional): Admission control for Bedrock calls,
+                defaults to the process-wide scheduler
+            resilience (Resilience, optional): Deadlines, retries, circuit breakers and hedging of
+                Bedrock calls, defaults to the process-wide resilience layer
         """
-        #print (aws_access_key, region)
-        
-        # Initialize AWS Bedrock client
-        self.bedrock_runtime = boto3.client(
-            service_name='bedrock-runtime',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            aws_session_token=session_token,
-            region_name=region
+        # Get the shared, pooled AWS Bedrock client
+        self.bedrock_runtime = bedrock_runtime_client(
+            aws_access_key,
+            aws_secret_key,
+            region,
+            session_token
         )
 
        
+        #self.model_id = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+        self.model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+        #self.model_id = "anthropic.claude-3-7-sonnet-20250219-v1:0"
+        self.prompt_version = DIAGRAM_PROMPT_VERSION
+        self.max_tokens = 2000
+        self.scheduler = scheduler or shared_scheduler
+        self.resilience = resilience or shared_resilience
+        self.provider = f"bedrock:{self.model_id}"
+
         # Initialize BedrockChat for Claude 3
         self.model = BedrockChat(
-            #model_id="anthropic.claude-3-5-sonnet-20241022-v2:0",
-            model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            #model_id="anthropic.claude-3-7-sonnet-20250219-v1:0",
+            model_id=self.model_id,
             client=self.bedrock_runtime,
             model_kwargs={
-                "max_tokens": 2000,
+                "max_tokens": self.max_tokens,
                 "temperature": 0.6
             }
         )
         self.prompt_templates = DiagramPromptTemplates()
 
-    def generate_diagram_description(self, context: str, image: Optional[str] = None) -> str:
+        # Stop generating at </svg> instead of paying for trailing prose
+        self.stream_svg = True
+        # Minify and validate the extracted SVG
+        self.minify_svg = True
+
+    async def _stream_svg(self, messages: List[Any]) -> str:
+        """Stream the diagram and stop the generation as soon as the SVG is complete."""
+        extractor = SvgStreamExtractor()
+        extract_seconds = 0.0
+        with bedrock_response_streams() as responses:
+            stream = self.model.astream(messages)
+            try:
+                async for chunk in stream:
+                    started = time.perf_counter()
+                    complete = extractor.feed(chunk.content)
+                    extract_seconds += time.perf_counter() - started
+                    if complete:
+                        break
+            finally:
+                # aclose only stops reading; BedrockChat streams in executor threads and leaves the
+                # HTTP response open. Closing it drops the connection, which ends the generation
+                await stream.aclose()
+                for response in responses:
+                    response.close()
+        record_stage("svg_extract", extract_seconds)
+        return extractor.svg
+
+    @staticmethod
+    def _extract_svg(content: str) -> str:
+        """Cut the first SVG document out of a complete response."""
+        if "<svg" in content and "</svg>" in content:
+            start_idx = content.find("<svg")
+            end_idx = content.find("</svg>") + 6
+            return content[start_idx:end_idx]
+        return ""
+
+    async def _attempt(self, messages: List[Any], deadline: float) -> str:
+        """Generate the diagram once within the scheduler lane, returning the extracted SVG."""
+        async with self.scheduler.slot(self.provider, estimate_tokens(messages, self.max_tokens), deadline) as slot:
+            if self.stream_svg:
+                # Streamed chunks carry no usage, the estimate stays charged
+                with span("bedrock_call"):
+                    return await self._stream_svg(messages)
+            with span("bedrock_call"):
+                response = await self.model.ainvoke(messages)
+            slot.record_usage(response)
+        record_tokens(self.provider, response)
+        with span("svg_extract"):
+            return self._extract_svg(response.content.strip())
+
+    async def generate_diagram_description(self, context: str, image: Optional[ImageHandle] = None) -> str:
         """
         Generate a diagram description using AWS Bedrock's Claude model.
         
         Args:
             context (str): Text description or question
-            image (Optional[str]): Base64 encoded image
+            image (Optional[ImageHandle]): Preprocessed image
             
         Returns:
             str: Detailed diagram description
         """
         try:
-            chat_prompt = self.prompt_templates.get_diagram_prompt()
-            
-            messages = [
-                SystemMessage(content=chat_prompt.messages[0].prompt.template),
-                HumanMessage(content=self.prompt_templates.format_diagram_message(context, image))
-            ]
-
-            # Invoke the chat model
-            response = self.model.invoke(messages)
-
-            # get the content of the response
-            content = response.content.strip()
-            print("diagram content", content[0:100])
-
-            # Extract SVG content if present
-            if "<svg" in content and "</svg>" in content:
-                start_idx = content.find("<svg")
-                end_idx = content.find("</svg>") + 6
-                content = content[start_idx:end_idx]
-            else:
-                content = ""
+            with span("prompt_build"):
+                chat_prompt = self.prompt_templates.get_diagram_prompt()
+                
+                messages = [
+                    SystemMessage(content=chat_prompt.messages[0].prompt.template),
+                    HumanMessage(content=self.prompt_templates.format_diagram_message(context, image))
+                ]
+
+            # Invoke the chat model with the deadline, retries, breaker and hedging of Bedrock
+            content = await self.resilience.call(
+                self.provider, lambda deadline: self._attempt(messages, deadline)
+            )
+            logger.debug("Diagram content: %s", content[0:100])
+
+            if self.minify_svg and content:
+                with span("svg_minify"):
+                    minified = minify_svg(content)
+                if minified is None:
+                    logger.warning("Dropping malformed SVG diagram")
+                    content = ""
+                else:
+                    content = minified
 
             return content
             
+        except SchedulerOverloaded as e:
+            # Shed, timed out or circuit open: expected while Bedrock degrades
+            logger.warning("Skipping diagram: %s", e)
+            return f"{DIAGRAM_ERROR_PREFIX}: {str(e)}"
         except Exception as e:
-            print(f"Bedrock Error: {str(e)}")
-            return f"Error generating diagram description: {str(e)}" 
\ No newline at end of file
+            logger.error("Bedrock Error: %s", e)
+            return f"{DIAGRAM_ERROR_PREFIX}: {str(e)}" 
\ No newline at end of file
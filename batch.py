@@ -0,0 +1,203 @@
+"""
+Answer a whole problem set offline through the QA graph.
+
+The input is either a directory of problem images or a JSON lines file with
+one problem per line. JSON lines records may carry "id" (or "request_id"),
+"question" (or "title" and "body"), an optional "image" path relative to
+the file and an optional "want_diagram" override. Results are appended to
+the output file as JSON lines in completion order; rerunning with the same
+output file skips problems that already succeeded, so an interrupted run
+resumes where it stopped.
+
+Usage:
+    python batch.py test_data/diagram-generation --output results.jsonl --concurrency 16
+    python batch.py problems.jsonl --output results.jsonl
+"""
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncIterator, Iterable
+from image_utils import ImageHandle, process_image_bytes, find_images
+from scheduler import request_deadline
+import argparse
+import asyncio
+import json
+import os
+import time
+
+DEFAULT_QUESTION = "Solve the problem shown in the image."
+
+ImageLoader = Callable[[Dict[str, Any]], Awaitable[Optional[ImageHandle]]]
+
+def load_items(source: str, default_question: str = DEFAULT_QUESTION) -> List[Dict[str, Any]]:
+    """
+    Read the problems of a batch.
+
+    Args:
+        source (str): Directory of images or JSON lines file
+        default_question (str): Question asked for records and images without one
+
+    Returns:
+        list: Items with "id", "question" and optional "image_path"
+    """
+    if os.path.isdir(source):
+        return [
+            {
+                "id": os.path.relpath(path, source),
+                "question": default_question,
+                "image_path": path
+            }
+            for path in find_images(source)
+        ]
+
+    items = []
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = record.get("question") or "\n\n".join(
+                part for part in (record.get("title"), record.get("body")) if part
+            ) or default_question
+            image = record.get("image")
+            items.append({
+                "id": str(record.get("id") or record.get("request_id") or line_number),
+                "question": question,
+                "image_path": os.path.join(base_dir, image) if image else None,
+                "want_diagram": record.get("want_diagram")
+            })
+    return items
+
+def completed_ids(output: str) -> set:
+    """
+    Ids of the items that already succeeded in a previous run.
+
+    Args:
+        output (str): JSON lines results file
+
+    Returns:
+        set: Item ids with status "success"
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if record.get("status") == "success":
+                done.add(record["id"])
+    return done
+
+async def run_batch(chain: Any, items: Iterable[Dict[str, Any]], load_image: ImageLoader,
+                    concurrency: int = 8, item_timeout: Optional[float] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run many problems through the graph with bounded fan-out.
+
+    Args:
+        chain: Compiled QA graph
+        items: Items with "id" and "question" plus whatever load_image needs
+        load_image: Coroutine function returning the preprocessed image of an item, None without one
+        concurrency (int): Maximum number of problems processed at once
+        item_timeout (float, optional): Scheduler deadline of each problem, counted
+            from when it starts rather than from when the batch was submitted
+
+    Yields:
+        dict: One result per item in completion order, with "status"
+            "success" (answer, subject, diagram) or "error" (message)
+    """
+    # Imported here so importing the server does not import the agents
+    from graph import ERROR_ANSWER
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(item: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            started = time.perf_counter()
+            if item_timeout is not None:
+                # Each task runs in its own context copy, so this only affects this item
+                request_deadline.set(time.monotonic() + item_timeout)
+            try:
+                image = await load_image(item)
+                result = await chain.ainvoke({
+                    "question": item["question"],
+                    "image": image,
+                    "answer": None,
+                    "diagram": None,
+                    "subject": None,
+                    "want_diagram": item.get("want_diagram")
+                })
+                if result["answer"] == ERROR_ANSWER:
+                    raise RuntimeError(ERROR_ANSWER)
+                return {
+                    "id": item["id"],
+                    "status": "success",
+                    "answer": result["answer"],
+                    "subject": result["subject"],
+                    "diagram": result["diagram"],
+                    "seconds": round(time.perf_counter() - started, 3)
+                }
+            except Exception as e:
+                return {
+                    "id": item["id"],
+                    "status": "error",
+                    "message": str(e),
+                    "seconds": round(time.perf_counter() - started, 3)
+                }
+
+    tasks = [asyncio.create_task(run_one(item)) for item in items]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Stop outstanding work when the consumer goes away early
+        for task in tasks:
+            task.cancel()
+
+async def main(source: str, output: str, question: str, concurrency: int) -> None:
+    # Imported here so the graph and agents come from the server configuration
+    from main import build_graph, IMAGE_PREPROCESS_MODE
+    _, chain = build_graph()
+
+    items = load_items(source, question)
+    done = completed_ids(output)
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} problems, {len(items) - len(pending)} already done, {len(pending)} to run")
+
+    async def load_image(item: Dict[str, Any]):
+        if not item.get("image_path"):
+            return None
+        with open(item["image_path"], "rb") as f:
+            contents = f.read()
+        return await asyncio.to_thread(
+            process_image_bytes, contents, item["image_path"], IMAGE_PREPROCESS_MODE
+        )
+
+    started = time.perf_counter()
+    succeeded = failed = 0
+    with open(output, "a+") as f:
+        # Start on a fresh line if a previous run was killed mid-write
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        async for result in run_batch(chain, pending, load_image, concurrency):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            if result["status"] == "success":
+                succeeded += 1
+            else:
+                failed += 1
+                print(f"Failed {result['id']}: {result['message']}")
+    print(f"Finished in {time.perf_counter() - started:.1f}s: {succeeded} succeeded, {failed} failed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory of images or JSON lines file of problems")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSON lines file results are appended to")
+    parser.add_argument("--question", default=DEFAULT_QUESTION, help="Question asked for problems without one")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of problems processed at once")
+    args = parser.parse_args()
+    asyncio.run(main(args.source, args.output, args.question, args.concurrency))
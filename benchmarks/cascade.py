@@ -0,0 +1,125 @@
+"""
+Compare a QA model cascade with the strongest model alone.
+
+Every problem of a source (a directory of images or a JSON lines file, as
+for batch.py) is answered by MultimodalAgent once with the strongest model
+only and then with the cascade at every confidence threshold. Each run
+reports:
+
+- the share of answers every tier served (its hit rate) and why answers
+  were escalated
+- p50/p95 answer latency
+- the model cost per question relative to the strongest model alone, from
+  the relative price of one call to each tier (--tier-costs)
+
+By default the models are deterministic fakes (see fake_models.py) with
+latencies scaled by --latency-scale, so the cascade can be exercised
+offline; --live calls the configured OpenAI models, to tune the threshold
+on real problems.
+
+Usage:
+    python -m benchmarks.cascade [--source test_data] [--models gpt-4o-mini,gpt-4o]
+        [--thresholds 0.5,0.7,0.9] [--tier-costs 0.06,1] [--live]
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import logging
+import os
+import time
+from agents import MultimodalAgent
+from batch import load_items, DEFAULT_QUESTION
+from image_utils import process_image_bytes, PREPROCESS_BUDGET
+from benchmarks.fake_models import install_fake_qa_models, fake_qa_model, fake_fast_qa_model
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def load_problems(source: str, limit: Optional[int]) -> List[Dict[str, Any]]:
+    """Questions of a source with their images preprocessed like the server does."""
+    problems = []
+    for item in load_items(source, DEFAULT_QUESTION)[:limit]:
+        image = None
+        if item.get("image_path"):
+            with open(item["image_path"], "rb") as f:
+                image = process_image_bytes(f.read(), item["image_path"], PREPROCESS_BUDGET)
+        problems.append({"question": item["question"], "image": image})
+    return problems
+
+async def run(agent: MultimodalAgent, problems: List[Dict[str, Any]], concurrency: int) -> List[float]:
+    """Answer every problem with bounded concurrency, returning the latencies."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(problem: Dict[str, Any]) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await agent.process_query(question=problem["question"], image=problem["image"])
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(problem) for problem in problems))
+    return latencies
+
+def build_agent(models: List[str], min_confidence: float, live: bool, scale: float, seed: int) -> MultimodalAgent:
+    agent = MultimodalAgent(os.getenv("OPENAI_API_KEY", "offline"), models=models, min_confidence=min_confidence)
+    if not live:
+        # Fresh fakes so every run sees the same output and latency sequence
+        install_fake_qa_models(
+            agent,
+            fake_qa_model(ttft_median=0.8 * scale, tokens_per_second=80 / scale, seed=seed),
+            fake_fast_qa_model(ttft_median=0.35 * scale, tokens_per_second=150 / scale, seed=seed + 2)
+        )
+    return agent
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="test_data", help="Directory of images or JSON lines file of problems")
+    parser.add_argument("--limit", type=int, default=None, help="Answer only the first N problems")
+    parser.add_argument("--models", default="gpt-4o-mini,gpt-4o", help="Cascade models from cheapest to strongest")
+    parser.add_argument("--thresholds", default="0.5,0.7,0.9", help="Confidence thresholds to compare")
+    parser.add_argument("--tier-costs", default="0.06,1",
+                        help="Relative price of one call to each model, in cascade order")
+    parser.add_argument("--concurrency", type=int, default=8, help="Problems answered at once")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Scale of the fake model latencies")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake latency distributions")
+    parser.add_argument("--live", action="store_true", help="Call the real OpenAI models instead of fakes")
+    args = parser.parse_args()
+    # Cheaper models failing to produce JSON is expected and counted below
+    logging.basicConfig(level=logging.ERROR)
+
+    models = [model.strip() for model in args.models.split(",")]
+    costs = [float(cost) for cost in args.tier_costs.split(",")]
+    if len(costs) != len(models):
+        parser.error("--tier-costs needs one price per model")
+    problems = load_problems(args.source, args.limit)
+    print(f"{len(problems)} problems from {args.source}, {'live models' if args.live else 'fake models'}")
+
+    runs = [("single", models[-1:], 1.0)]
+    runs += [(f"cascade@{threshold}", models, float(threshold)) for threshold in args.thresholds.split(",")]
+    print(f"{'run':<16}{'hit rates':<36}{'p50 ms':>9}{'p95 ms':>9}{'cost':>7}  escalations")
+    for name, run_models, threshold in runs:
+        agent = build_agent(run_models, threshold, args.live, args.latency_scale, args.seed)
+        latencies = await run(agent, problems, args.concurrency)
+        tiers = agent.cascade_stats()["tiers"]
+        if len(run_models) == 1:
+            hit_rates, cost, escalations = f"{run_models[0]} 1.00", 1.0, {}
+        else:
+            hit_rates = " ".join(
+                f"{model} {tiers.get(model, {}).get('accepted', 0) / len(problems):.2f}" for model in run_models
+            )
+            calls = [tiers.get(model, {}).get("calls", 0) for model in run_models]
+            cost = sum(count * price for count, price in zip(calls, costs)) / (len(problems) * costs[-1])
+            escalations = {}
+            for model in run_models[:-1]:
+                for reason, count in tiers.get(model, {}).get("reasons", {}).items():
+                    if reason != "accepted":
+                        escalations[reason] = escalations.get(reason, 0) + count
+        print(
+            f"{name:<16}{hit_rates:<36}{percentile(latencies, 0.5) * 1000:>9.1f}"
+            f"{percentile(latencies, 0.95) * 1000:>9.1f}{cost:>7.2f}  "
+            + ", ".join(f"{reason} {count}" for reason, count in sorted(escalations.items()))
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Compare diagram generation with and without streaming early stop and SVG
+minification over the images in test_data/diagram-generation.
+
+For every image, reports the Bedrock call time and the size of the returned
+diagram. This calls Bedrock, so the AWS credentials from .env are required;
+the response cache is not involved.
+
+Usage:
+    python -m benchmarks.diagram_generation [--dir test_data/diagram-generation] [--repeat 1]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from dotenv import load_dotenv
+from agents import DiagramAgent, DIAGRAM_ERROR_PREFIX
+from image_utils import ImageHandle, process_image_bytes, find_images
+
+QUESTION = "Draw a diagram for the problem shown in the image."
+
+async def measure(agent: DiagramAgent, image: ImageHandle, repeat: int) -> dict:
+    timings, sizes = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        diagram = await agent.generate_diagram_description(QUESTION, image)
+        timings.append(time.perf_counter() - start)
+        sizes.append(len(diagram))
+        if diagram.startswith(DIAGRAM_ERROR_PREFIX):
+            raise RuntimeError(diagram)
+    return {"seconds": statistics.median(timings), "bytes": statistics.median(sizes)}
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default="test_data/diagram-generation", help="Directory of problem images")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per image, the median is reported")
+    args = parser.parse_args()
+
+    load_dotenv()
+    agent = DiagramAgent(
+        os.getenv("AWS_ACCESS_KEY_ID"),
+        os.getenv("AWS_SECRET_ACCESS_KEY"),
+        os.getenv("AWS_REGION", "us-west-1"),
+        os.getenv("AWS_SESSION_TOKEN")
+    )
+
+    images = []
+    for path in find_images(args.dir):
+        with open(path, "rb") as f:
+            images.append(process_image_bytes(f.read(), path))
+
+    totals = {}
+    for mode, stream_svg in (("full", False), ("stream", True)):
+        agent.stream_svg = agent.minify_svg = stream_svg
+        results = [await measure(agent, image, args.repeat) for image in images]
+        totals[mode] = {
+            "seconds": sum(r["seconds"] for r in results),
+            "bytes": sum(r["bytes"] for r in results)
+        }
+
+    print(f"{len(images)} images from {args.dir}")
+    print(f"{'mode':<8}{'time s':>10}{'diagram KB':>12}")
+    for mode, total in totals.items():
+        print(f"{mode:<8}{total['seconds']:>10.1f}{total['bytes'] / 1e3:>12.1f}")
+    full, stream = totals["full"], totals["stream"]
+    print(
+        f"stream vs full: generation {1 - stream['seconds'] / full['seconds']:.0%} faster, "
+        f"diagrams {1 - stream['bytes'] / full['bytes']:.0%} smaller"
+    )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,237 @@
+"""
+Deterministic stand-ins for the GPT-4o and Claude chat models.
+
+The fakes are LangChain chat models, so the agents, the graph and the app
+run unchanged on top of them. Each call waits for a time to first token
+drawn from a seeded log-normal distribution and then emits canned output
+at a fixed token rate, without touching the network. Faults can be
+injected: a share of calls fails with a retryable 503 or stalls before the
+first token.
+"""
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+
+# Characters per emitted token, roughly what both providers average on English
+CHARS_PER_TOKEN = 4
+
+CANNED_ANSWERS = [
+    {"answer": "The missing angle is 180 - 72 = 108 degrees.", "subject": "Geometry"},
+    {"answer": "Subtract 3 from both sides to get 2x = 8, so x = 4.", "subject": "Algebra"},
+    {"answer": "The area of the triangle is 1/2 * 6 * 4 = 12 square units.", "subject": "Geometry"},
+    {"answer": "Paris is the capital of France.", "subject": "Geography"}
+]
+
+# Answers of a cheaper model with self-reported confidence, including the kinds
+# the cascade checks catch: low confidence, hedging, broken LaTeX, no JSON at all
+CANNED_FAST_ANSWERS = [
+    json.dumps({"answer": "The missing angle is 180 - 72 = 108 degrees.", "subject": "Geometry", "confidence": 0.95}),
+    json.dumps({"answer": "Subtract 3 from both sides: $$2x = 8$$ so $$x = 4$$.", "subject": "Algebra", "confidence": 0.9}),
+    json.dumps({"answer": "The area is $$\\frac{1}{2} \\cdot 6 \\cdot 4 = 12$$ square units.", "subject": "Geometry", "confidence": 0.85}),
+    json.dumps({"answer": "Paris is the capital of France.", "subject": "Geography", "confidence": 0.99}),
+    json.dumps({"answer": "The perimeter is probably 24 units.", "subject": "Geometry", "confidence": 0.55}),
+    json.dumps({"answer": "The slope is 3.", "subject": "Algebra", "confidence": 0.75}),
+    json.dumps({"answer": "I cannot determine the length from the image.", "subject": "Geometry", "confidence": 0.8}),
+    json.dumps({"answer": "The volume is $$\\frac{4}{3}\\pi r^3 = \\frac{32}{3\\pi$$.", "subject": "Geometry", "confidence": 0.9}),
+    json.dumps({"answer": "The mean of the data set is 7.", "subject": "Statistics", "confidence": 0.65}),
+    "The answer is x = 5"
+]
+
+CANNED_SVG = (
+    '<svg viewBox="0 0 400 300" xmlns="http://www.w3.org/2000/svg">\n'
+    '  <!-- Triangle -->\n'
+    '  <polygon points="50.000000,250.000000 350.000000,250.000000 200.123456,50.654321" '
+    'fill="none" stroke="black" stroke-width="2"/>\n'
+    '  <line x1="200.123456" y1="50.654321" x2="200.123456" y2="250.000000" '
+    'stroke="blue" stroke-dasharray="4,4"/>\n'
+    '  <text x="190" y="270" font-family="Arial" font-size="14">base = 6</text>\n'
+    '  <text x="210" y="150" font-family="Arial" font-size="14">height = 4</text>\n'
+    '</svg>'
+)
+
+CANNED_DIAGRAMS = [
+    f"Here is a diagram of the problem:\n\n{CANNED_SVG}\n\n"
+    "The dashed line marks the height of the triangle, which is perpendicular to the base."
+]
+
+class FakeProviderError(Exception):
+    """Injected upstream failure, retryable like an HTTP 503 of the real providers."""
+
+    status_code = 503
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning canned outputs with simulated latency, token rate and faults."""
+
+    outputs: List[str]
+    ttft_median: float = 0.5
+    ttft_sigma: float = 0.3
+    tokens_per_second: float = 50.0
+    seed: int = 0
+    # Share of calls failing after their time to first token
+    error_rate: float = 0.0
+    # Share of calls stalling for stall_seconds before their first token
+    stall_rate: float = 0.0
+    stall_seconds: float = 30.0
+
+    _rng: random.Random = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _calls: int = PrivateAttr(default=0)
+
+    def __init__(self, **data: Any):
+        super().__init__(**data)
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _next_call(self) -> tuple:
+        """Output, time to first token and injected fault of the next call, in a reproducible sequence."""
+        with self._lock:
+            output = self.outputs[self._calls % len(self.outputs)]
+            self._calls += 1
+            ttft = self._rng.lognormvariate(math.log(self.ttft_median), self.ttft_sigma)
+            # Drawn only with faults configured, so fault free runs keep their latency sequence
+            failed = self.error_rate > 0 and self._rng.random() < self.error_rate
+            if self.stall_rate > 0 and self._rng.random() < self.stall_rate:
+                ttft += self.stall_seconds
+        return output, ttft, failed
+
+    @staticmethod
+    def _fail(failed: bool) -> None:
+        if failed:
+            raise FakeProviderError("Injected fault: service unavailable")
+
+    def _chunks(self, output: str) -> List[str]:
+        return [output[i:i + CHARS_PER_TOKEN] for i in range(0, len(output), CHARS_PER_TOKEN)]
+
+    def _message(self, messages: List[BaseMessage], output: str) -> AIMessage:
+        input_tokens = sum(len(str(message.content)) for message in messages) // CHARS_PER_TOKEN
+        output_tokens = len(self._chunks(output))
+        return AIMessage(content=output, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens
+        })
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        output, ttft, failed = self._next_call()
+        time.sleep(ttft)
+        self._fail(failed)
+        time.sleep(len(self._chunks(output)) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, output))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        output, ttft, failed = self._next_call()
+        await asyncio.sleep(ttft)
+        self._fail(failed)
+        await asyncio.sleep(len(self._chunks(output)) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, output))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        output, ttft, failed = self._next_call()
+        time.sleep(ttft)
+        self._fail(failed)
+        for chunk in self._chunks(output):
+            time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        output, ttft, failed = self._next_call()
+        await asyncio.sleep(ttft)
+        self._fail(failed)
+        for chunk in self._chunks(output):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+def fake_qa_model(ttft_median: float = 0.8, ttft_sigma: float = 0.3,
+                  tokens_per_second: float = 80.0, seed: int = 0, **faults: Any) -> FakeChatModel:
+    """Fake GPT-4o returning the JSON answers MultimodalAgent parses; faults are FakeChatModel fields."""
+    return FakeChatModel(
+        outputs=[json.dumps(answer) for answer in CANNED_ANSWERS],
+        ttft_median=ttft_median,
+        ttft_sigma=ttft_sigma,
+        tokens_per_second=tokens_per_second,
+        seed=seed,
+        **faults
+    )
+
+def fake_fast_qa_model(ttft_median: float = 0.35, ttft_sigma: float = 0.3,
+                       tokens_per_second: float = 150.0, seed: int = 2, **faults: Any) -> FakeChatModel:
+    """Fake gpt-4o-mini for the cheaper tiers of a cascade, answering with a confidence."""
+    return FakeChatModel(
+        outputs=CANNED_FAST_ANSWERS,
+        ttft_median=ttft_median,
+        ttft_sigma=ttft_sigma,
+        tokens_per_second=tokens_per_second,
+        seed=seed,
+        **faults
+    )
+
+def fake_diagram_model(ttft_median: float = 1.5, ttft_sigma: float = 0.4,
+                       tokens_per_second: float = 60.0, seed: int = 1, **faults: Any) -> FakeChatModel:
+    """Fake Claude returning an SVG wrapped in prose, like the real model tends to."""
+    return FakeChatModel(
+        outputs=CANNED_DIAGRAMS,
+        ttft_median=ttft_median,
+        ttft_sigma=ttft_sigma,
+        tokens_per_second=tokens_per_second,
+        seed=seed,
+        **faults
+    )
+
+def install_fake_models(graph: Any, qa_model: Optional[FakeChatModel] = None,
+                        diagram_model: Optional[FakeChatModel] = None,
+                        fast_qa_model: Optional[FakeChatModel] = None) -> Dict[str, FakeChatModel]:
+    """
+    Swap the chat models of a MultimodalQAGraph for fakes.
+
+    Args:
+        graph: MultimodalQAGraph whose agents get the fake models
+        qa_model (FakeChatModel, optional): Fake for the strongest MultimodalAgent model,
+            defaults to fake_qa_model()
+        diagram_model (FakeChatModel, optional): Fake for DiagramAgent, defaults to fake_diagram_model()
+        fast_qa_model (FakeChatModel, optional): Fake for the cheaper tiers of a QA model cascade,
+            defaults to fake_fast_qa_model()
+
+    Returns:
+        dict: The installed fakes by agent ("qa", "diagram", and "fast_qa" with a cascade)
+    """
+    fakes = install_fake_qa_models(graph.qa_agent, qa_model, fast_qa_model)
+    graph.diagram_agent.model = diagram_model or fake_diagram_model()
+    fakes["diagram"] = graph.diagram_agent.model
+    return fakes
+
+def install_fake_qa_models(agent: Any, qa_model: Optional[FakeChatModel] = None,
+                           fast_qa_model: Optional[FakeChatModel] = None) -> Dict[str, FakeChatModel]:
+    """
+    Swap the chat models of every tier of a MultimodalAgent for fakes.
+
+    Args:
+        agent: MultimodalAgent whose tiers get the fake models
+        qa_model (FakeChatModel, optional): Fake for the strongest model, defaults to fake_qa_model()
+        fast_qa_model (FakeChatModel, optional): Fake shared by the cheaper tiers, defaults to fake_fast_qa_model()
+
+    Returns:
+        dict: The installed fakes ("qa", and "fast_qa" with a cascade)
+    """
+    agent.model = qa_model or fake_qa_model()
+    fakes = {"qa": agent.model}
+    if len(agent.tiers) > 1:
+        fakes["fast_qa"] = fast_qa_model or fake_fast_qa_model()
+        for tier in agent.tiers[:-1]:
+            tier.model = fakes["fast_qa"]
+    return fakes
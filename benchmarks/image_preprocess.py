@@ -0,0 +1,149 @@
+"""
+Compare image preprocessing modes over the images in test_data.
+
+For every image, reports the encoded payload size, the preprocessing time
+and the image tokens each provider bills for the result.
+
+The test images are mostly small screenshots; --phone rescales each one to
+a 12 megapixel JPEG first to mimic photos taken with a phone camera.
+
+--memory also preprocesses every image once in a fresh process and reports
+its measured peak memory (peak RSS growth plus the upload) next to the
+estimate the image pool admits images with. This needs Linux, where the
+peak RSS of a process can be reset.
+
+Usage:
+    python -m benchmarks.image_preprocess [--dir test_data] [--repeat 3] [--phone] [--memory]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import io
+import math
+import multiprocessing
+import statistics
+import time
+from PIL import Image
+from image_utils import (
+    process_image_bytes,
+    inspect_image,
+    estimate_peak_bytes,
+    find_images,
+    PREPROCESS_FULL,
+    PREPROCESS_BUDGET
+)
+
+def openai_image_tokens(width: int, height: int) -> int:
+    """Tokens GPT-4o bills for a high detail image of the given size."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def anthropic_image_tokens(width: int, height: int) -> int:
+    """Tokens Claude bills for an image of the given size."""
+    scale = min(1.0, 1568 / max(width, height), math.sqrt(1_150_000 / (width * height)))
+    return math.ceil(width * scale * height * scale / 750)
+
+def as_phone_photo(contents: bytes) -> bytes:
+    """Rescale an image to a 4032 pixel long edge and encode it like a phone camera."""
+    img = Image.open(io.BytesIO(contents)).convert("RGB")
+    scale = 4032 / max(img.size)
+    img = img.resize((round(img.width * scale), round(img.height * scale)), Image.BICUBIC)
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=92)
+    return buffered.getvalue()
+
+def _rss_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} missing from /proc/self/status")
+
+def _peak_memory(contents: bytes, mode: str) -> int:
+    """Peak RSS growth of preprocessing one image, run in a fresh process."""
+    # Warm up the decoders and encoders so their one-off allocations are not counted
+    warmup = io.BytesIO()
+    Image.new("RGB", (64, 64)).save(warmup, format="PNG")
+    process_image_bytes(warmup.getvalue(), "warmup.png", mode)
+    # Writing 5 to clear_refs resets the peak RSS (VmHWM) to the current RSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = _rss_kb("VmRSS")
+    process_image_bytes(contents, "image", mode)
+    return (_rss_kb("VmHWM") - before) * 1024
+
+def measure_memory(contents: bytes, mode: str) -> int:
+    """Measured peak memory of preprocessing an image, including the upload itself."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_peak_memory, contents, mode).result() + len(contents)
+
+def measure(path: str, mode: str, repeat: int, phone: bool, memory: bool = False) -> dict:
+    with open(path, "rb") as f:
+        contents = f.read()
+    if phone:
+        contents = as_phone_photo(contents)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        processed = process_image_bytes(contents, path, mode)
+        timings.append(time.perf_counter() - start)
+    return {
+        "upload_bytes": len(contents),
+        "payload_bytes": len(processed.data_url),
+        "seconds": statistics.median(timings),
+        "openai_tokens": openai_image_tokens(processed.width, processed.height),
+        "anthropic_tokens": anthropic_image_tokens(processed.width, processed.height),
+        "format": processed.format,
+        "memory_bytes": measure_memory(contents, mode) if memory else 0,
+        "memory_estimate_bytes": estimate_peak_bytes(inspect_image(contents), len(contents), mode)
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default="test_data", help="Directory of test images")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image, the median time is reported")
+    parser.add_argument("--phone", action="store_true", help="Upscale every image to phone camera resolution first")
+    parser.add_argument("--memory", action="store_true", help="Measure peak memory per image in a fresh process")
+    args = parser.parse_args()
+
+    paths = find_images(args.dir)
+
+    totals = {}
+    for mode in (PREPROCESS_FULL, PREPROCESS_BUDGET):
+        results = [measure(path, mode, args.repeat, args.phone, args.memory) for path in paths]
+        totals[mode] = {
+            "payload_bytes": sum(r["payload_bytes"] for r in results),
+            "seconds": sum(r["seconds"] for r in results),
+            "openai_tokens": sum(r["openai_tokens"] for r in results),
+            "anthropic_tokens": sum(r["anthropic_tokens"] for r in results),
+            "png": sum(1 for r in results if r["format"] == "PNG"),
+            "memory_bytes": max(r["memory_bytes"] for r in results),
+            "memory_estimate_bytes": max(r["memory_estimate_bytes"] for r in results),
+            "underestimated": sum(1 for r in results if r["memory_bytes"] > r["memory_estimate_bytes"])
+        }
+
+    print(f"{len(paths)} images from {args.dir}")
+    print(f"{'mode':<8}{'payload MB':>12}{'time s':>10}{'openai tok':>12}{'claude tok':>12}{'png':>6}")
+    for mode, total in totals.items():
+        print(
+            f"{mode:<8}{total['payload_bytes'] / 1e6:>12.2f}{total['seconds']:>10.3f}"
+            f"{total['openai_tokens']:>12}{total['anthropic_tokens']:>12}{total['png']:>6}"
+        )
+    if args.memory:
+        print(f"{'mode':<8}{'peak MB':>12}{'estimate MB':>14}{'underestimated':>16}")
+        for mode, total in totals.items():
+            print(
+                f"{mode:<8}{total['memory_bytes'] / 1e6:>12.1f}"
+                f"{total['memory_estimate_bytes'] / 1e6:>14.1f}{total['underestimated']:>16}"
+            )
+    full, budget = totals[PREPROCESS_FULL], totals[PREPROCESS_BUDGET]
+    print(
+        f"budget vs full: payload {1 - budget['payload_bytes'] / full['payload_bytes']:.0%} smaller, "
+        f"preprocessing {1 - budget['seconds'] / full['seconds']:.0%} faster"
+    )
+
+if __name__ == "__main__":
+    main()
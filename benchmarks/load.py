@@ -0,0 +1,396 @@
+"""
+Closed-loop HTTP load test of /ask against local mock upstreams.
+
+Starts the mock OpenAI and Bedrock server (see mock_upstreams.py) and the
+app with uvicorn (or gunicorn with uvicorn workers) pointed at it, then
+sweeps concurrency levels. At every level that many virtual users send
+/ask requests back to back for --duration seconds after a --warmup, and
+the level reports:
+
+- rps: completed requests per second
+- p50/p95/p99 ms: request latency
+- errors: share of requests that failed or were answered with the error answer
+- cpu: CPU cores used by the server processes (workers and image pool)
+- rss MB: peak summed resident memory of the server processes
+- openai/req, bedrock/req: upstream calls per request seen by the mocks
+
+The requests replay a JSON lines traffic log in the format batch.py reads
+("question" or "title" and "body", an optional "image" path relative to the
+file, an optional "want_diagram"), or a synthetic mix of the images of a
+directory with text-only questions. The response cache, the near-duplicate
+index and call coalescing are disabled unless --keep-caches is given, so
+repeated traffic reaches the upstreams; state files go to a scratch
+directory. With --url an already running server is loaded instead, and
+--server-pid names the process to measure.
+
+--output writes the results as JSON. With --baseline, a previous output
+file, the run exits with status 1 when a level's throughput fell or its p95
+rose by more than --max-regression, or its error rate rose by more than 1
+point.
+
+Usage:
+    python -m benchmarks.load [--concurrency 1,2,4,8,16,32] [--duration 30] [--workers 1]
+        [--traffic traffic.jsonl | --images test_data --text-share 0.3]
+        [--profile profile.json | --metrics scrape.txt] [--latency-scale 1.0]
+        [--output load.json] [--baseline previous.json --max-regression 0.2]
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import itertools
+import json
+import mimetypes
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from batch import load_items, DEFAULT_QUESTION
+from image_utils import find_images
+from graph import ERROR_ANSWER
+from benchmarks.startup import PLACEHOLDER_ENV, free_port, wait_for
+
+# Text-only questions of the synthetic mix, with and without a diagram
+TEXT_QUESTIONS = [
+    "Solve 2x + 3 = 11.",
+    "What is the derivative of x^3 - 2x?",
+    "Find the area of a triangle with base 6 and height 4.",
+    "Draw a triangle with angles 30 and 60 degrees and find the third angle.",
+    "Sketch the graph of y = x^2 - 4 and find its roots.",
+    "What is the capital of France?"
+]
+
+# Environment that makes repeated traffic reach the upstreams
+NO_CACHE_ENV = {
+    "RESPONSE_CACHE_ENABLED": "false",
+    "SIMILARITY_INDEX_ENABLED": "false",
+    "COALESCE_ENABLED": "false"
+}
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def synthetic_items(directory: str, text_share: float, count: int, seed: int) -> List[Dict[str, Any]]:
+    """A seeded mix of the directory's images with the default question and text-only questions."""
+    rng = random.Random(seed)
+    images = find_images(directory)
+    items = []
+    for index in range(count):
+        if not images or rng.random() < text_share:
+            items.append({"id": str(index), "question": rng.choice(TEXT_QUESTIONS), "image_path": None})
+        else:
+            items.append({"id": str(index), "question": DEFAULT_QUESTION, "image_path": rng.choice(images)})
+    return items
+
+def request_body(item: Dict[str, Any], images: Dict[str, bytes]) -> Dict[str, Any]:
+    """Form fields and files of an item's /ask request, with the image bytes read up front."""
+    data = {"question": item["question"]}
+    if item.get("want_diagram") is not None:
+        data["want_diagram"] = str(bool(item["want_diagram"])).lower()
+    files = None
+    path = item.get("image_path")
+    if path:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        files = {"image": (os.path.basename(path), images[path], content_type)}
+    return {"data": data, "files": files}
+
+def process_tree(pid: int) -> List[int]:
+    """A process and all its descendants, from /proc."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="utf-8") as f:
+                # The command name may contain spaces, the fields after it do not
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+def cpu_seconds(pids: List[int]) -> float:
+    """User and system CPU time of the processes."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            continue
+    return total / CLOCK_TICKS
+
+def rss_bytes(pids: List[int]) -> int:
+    """Summed resident memory of the processes; pages shared after a fork are counted once per process."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+async def mock_calls(client: httpx.AsyncClient, mock_url: Optional[str]) -> Dict[str, int]:
+    if mock_url is None:
+        return {}
+    stats = (await client.get(f"{mock_url}/mock/stats")).json()
+    return {provider: counters["calls"] for provider, counters in stats.items()}
+
+async def run_level(client: httpx.AsyncClient, bodies: List[Dict[str, Any]], concurrency: int,
+                    duration: float, warmup: float, server_pid: Optional[int],
+                    mock_url: Optional[str]) -> Dict[str, Any]:
+    """
+    Run one concurrency level: every virtual user sends its next request as soon as the last one is answered.
+
+    Requests started during the warmup are not measured; requests in flight
+    when the duration ends are awaited and measured.
+    """
+    order = itertools.count()
+    started_at = time.perf_counter()
+    measure_from = started_at + warmup
+    stop_at = measure_from + duration
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    rss_peak = 0
+
+    async def user() -> None:
+        while time.perf_counter() < stop_at:
+            body = bodies[next(order) % len(bodies)]
+            started = time.perf_counter()
+            try:
+                response = await client.post("/ask", **body)
+                if response.status_code != 200:
+                    error = f"http_{response.status_code}"
+                elif response.json().get("answer") == ERROR_ANSWER:
+                    error = "error_answer"
+                else:
+                    error = None
+            except httpx.HTTPError as e:
+                error = type(e).__name__
+            if started >= measure_from:
+                latencies.append(time.perf_counter() - started)
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+
+    async def sample_rss() -> None:
+        nonlocal rss_peak
+        while time.perf_counter() < stop_at:
+            if server_pid and time.perf_counter() >= measure_from:
+                rss_peak = max(rss_peak, rss_bytes(process_tree(server_pid)))
+            await asyncio.sleep(0.5)
+
+    async def measure() -> tuple:
+        await asyncio.sleep(max(0.0, measure_from - time.perf_counter()))
+        calls = await mock_calls(client, mock_url)
+        return cpu_seconds(process_tree(server_pid)) if server_pid else 0.0, calls, time.perf_counter()
+
+    users = [asyncio.create_task(user()) for _ in range(concurrency)]
+    sampler = asyncio.create_task(sample_rss())
+    cpu_before, calls_before, cpu_from = await measure()
+    await asyncio.gather(*users, sampler)
+    ended_at = time.perf_counter()
+    cpu_after = cpu_seconds(process_tree(server_pid)) if server_pid else 0.0
+    calls_after = await mock_calls(client, mock_url)
+
+    count = len(latencies)
+    result = {
+        "concurrency": concurrency,
+        "requests": count,
+        "rps": count / (ended_at - measure_from) if count else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "error_rate": sum(errors.values()) / count if count else 0.0,
+        "errors": errors,
+        "cpu_cores": (cpu_after - cpu_before) / (ended_at - cpu_from) if server_pid else None,
+        "rss_mb": rss_peak / 2 ** 20 if server_pid else None
+    }
+    for provider, calls in calls_after.items():
+        # Calls started during the warmup and answered later are counted too, a slight overestimate
+        result[f"{provider}_per_request"] = (calls - calls_before.get(provider, 0)) / count if count else 0.0
+    return result
+
+def start_process(command: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_process(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def server_command(server: str, port: int, workers: int) -> List[str]:
+    if server == "gunicorn":
+        return [
+            sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}", "--workers", str(workers)
+        ]
+    return [
+        sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning"
+    ]
+
+def regressions(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Levels that got slower, answer fewer requests per second or fail more often than in the baseline."""
+    previous = {level["concurrency"]: level for level in baseline}
+    found = []
+    for level in results:
+        before = previous.get(level["concurrency"])
+        if before is None:
+            continue
+        concurrency = level["concurrency"]
+        if level["rps"] < before["rps"] * (1 - tolerance):
+            found.append(f"concurrency {concurrency}: {before['rps']:.2f} -> {level['rps']:.2f} rps")
+        if level["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            found.append(f"concurrency {concurrency}: p95 {before['p95_ms']:.0f} -> {level['p95_ms']:.0f} ms")
+        if level["error_rate"] > before["error_rate"] + 0.01:
+            found.append(f"concurrency {concurrency}: errors {before['error_rate']:.1%} -> {level['error_rate']:.1%}")
+    return found
+
+async def sweep(args: argparse.Namespace, url: str, server_pid: Optional[int],
+                mock_url: Optional[str]) -> List[Dict[str, Any]]:
+    if args.traffic:
+        items = load_items(args.traffic)
+    else:
+        items = synthetic_items(args.images, args.text_share, args.items, args.seed)
+    images = {}
+    for item in items:
+        path = item.get("image_path")
+        if path and path not in images:
+            with open(path, "rb") as f:
+                images[path] = f.read()
+    bodies = [request_body(item, images) for item in items]
+    with_image = sum(1 for item in items if item.get("image_path"))
+    print(f"{len(items)} requests ({with_image} with an image), {args.warmup:g} s warmup and "
+          f"{args.duration:g} s per level against {url}")
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    results = []
+    async with httpx.AsyncClient(base_url=url, timeout=args.request_timeout, limits=limits) as client:
+        print(f"{'users':>6}{'requests':>9}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+              f"{'cpu':>6}{'rss MB':>8}{'openai/req':>11}{'bedrock/req':>12}")
+        for concurrency in levels:
+            level = await run_level(client, bodies, concurrency, args.duration, args.warmup, server_pid, mock_url)
+            results.append(level)
+            cpu = "-" if level["cpu_cores"] is None else f"{level['cpu_cores']:.2f}"
+            rss = "-" if level["rss_mb"] is None else f"{level['rss_mb']:.0f}"
+            openai = f"{level['openai_per_request']:.2f}" if "openai_per_request" in level else "-"
+            bedrock = f"{level['bedrock_per_request']:.2f}" if "bedrock_per_request" in level else "-"
+            print(f"{concurrency:>6}{level['requests']:>9}{level['rps']:>8.2f}{level['p50_ms']:>9.0f}"
+                  f"{level['p95_ms']:>9.0f}{level['p99_ms']:>9.0f}{level['error_rate']:>8.1%}"
+                  f"{cpu:>6}{rss:>8}{openai:>11}{bedrock:>12}")
+    # Where adding users stops adding throughput, latency only grows from there
+    for previous, level in zip(results, results[1:]):
+        if level["rps"] < previous["rps"] * 1.1:
+            print(f"throughput stops scaling at {previous['concurrency']} users ({previous['rps']:.2f} rps)")
+            break
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="Comma separated numbers of virtual users")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Unmeasured seconds before every level")
+    parser.add_argument("--traffic", help="JSON lines traffic log to replay")
+    parser.add_argument("--images", default="test_data", help="Image directory of the synthetic mix")
+    parser.add_argument("--text-share", type=float, default=0.3, help="Share of text-only questions in the synthetic mix")
+    parser.add_argument("--items", type=int, default=200, help="Requests in the synthetic mix, replayed in a loop")
+    parser.add_argument("--url", help="Load an already running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="Process of the server given with --url, for CPU and RSS")
+    parser.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn", help="Server to start")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the started server")
+    parser.add_argument("--keep-caches", action="store_true", help="Keep the response cache, index and coalescing")
+    parser.add_argument("--profile", help="Latency profile of the mock upstreams, see mock_upstreams.py")
+    parser.add_argument("--metrics", help="Production /metrics scrape to take the mock latencies from")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Factor applied to the mock latencies")
+    parser.add_argument("--request-timeout", type=float, default=120.0, help="Client timeout of a request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic mix and the mock latencies")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative throughput and p95 change")
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        if args.url:
+            url, server_pid, mock_url = args.url, args.server_pid, None
+        else:
+            scratch = tempfile.mkdtemp(prefix="load-")
+            mock_port, app_port = free_port(), free_port()
+            mock_command = [
+                sys.executable, "-m", "benchmarks.mock_upstreams", "--port", str(mock_port),
+                "--latency-scale", str(args.latency_scale), "--seed", str(args.seed)
+            ]
+            for option in ("profile", "metrics"):
+                if getattr(args, option):
+                    mock_command += [f"--{option}", getattr(args, option)]
+            processes.append(start_process(mock_command, dict(os.environ), os.path.join(scratch, "mock.log")))
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            env = {
+                **PLACEHOLDER_ENV,
+                # State of this run only, so runs do not warm each other up
+                "RESPONSE_CACHE_PATH": os.path.join(scratch, "responses.sqlite3"),
+                "SIMILARITY_INDEX_PATH": os.path.join(scratch, "similarity.jsonl"),
+                "DIAGRAM_ASSETS_DIR": os.path.join(scratch, "diagrams"),
+                "IMAGE_STORE_DIR": os.path.join(scratch, "images"),
+                "JOB_QUEUE_PATH": os.path.join(scratch, "jobs.sqlite3"),
+                **os.environ,
+                **({} if args.keep_caches else NO_CACHE_ENV),
+                "OPENAI_BASE_URL": f"{mock_url}/v1",
+                "AWS_ENDPOINT_URL_BEDROCK_RUNTIME": mock_url,
+                "AGENT_INIT": "eager",
+                "LOG_LEVEL": "WARNING"
+            }
+            server = start_process(
+                server_command(args.server, app_port, args.workers), env, os.path.join(scratch, "server.log")
+            )
+            processes.append(server)
+            url, server_pid = f"http://127.0.0.1:{app_port}", server.pid
+            with httpx.Client(timeout=1.0) as client:
+                started = time.perf_counter()
+                try:
+                    wait_for(client, f"{mock_url}/mock/stats", started, 60.0)
+                    wait_for(client, f"{url}/ready", started, 120.0)
+                except TimeoutError as e:
+                    raise SystemExit(f"{e}, see the logs in {scratch}")
+            print(f"{args.server} with {args.workers} worker(s), mock upstreams at latency scale "
+                  f"{args.latency_scale:g}, logs in {scratch}")
+        results = asyncio.run(sweep(args, url, server_pid, mock_url))
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(results, json.load(f)["levels"], args.max_regression)
+        if found:
+            print("Regressions against the baseline:")
+            for regression in found:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+Local HTTP stand-ins for the OpenAI and Bedrock runtime APIs.
+
+One server answers both APIs, so the app runs unchanged against it when
+pointed there with the standard SDK settings:
+
+    OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+    AWS_ENDPOINT_URL_BEDROCK_RUNTIME=http://127.0.0.1:<port>
+
+- POST /v1/chat/completions: OpenAI chat completions, streamed as
+  server-sent events when asked to
+- POST /model/{model_id}/invoke and /model/{model_id}/invoke-with-response-stream:
+  Bedrock InvokeModel for Anthropic messages, the stream in the AWS event
+  stream encoding
+- GET /mock/stats: calls, failures and tokens per provider
+
+Answers are the canned outputs of fake_models.py. The duration of every
+call is drawn from a log-normal distribution fitted to a p50 and p95 per
+provider, and streamed output arrives at a token rate towards its end, so
+a streamed call takes as long as an unstreamed one. The percentiles come
+from --profile, a JSON file like
+{"openai": {"p50": 1.4, "p95": 2.2}, "bedrock": {"p50": 4.0, "p95": 6.0, "error_rate": 0.01}},
+or from --metrics, a Prometheus scrape of the app's /metrics in
+production, whose openai_call and bedrock_call stage histograms are used.
+Failures are answered with a 503 like the providers' overload errors.
+
+Usage:
+    python -m benchmarks.mock_upstreams [--port 8100] [--profile profile.json | --metrics scrape.txt]
+        [--latency-scale 1.0] [--seed 0]
+"""
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+import re
+import struct
+import time
+import uuid
+import zlib
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from benchmarks.fake_models import CANNED_ANSWERS, CANNED_FAST_ANSWERS, CANNED_DIAGRAMS, CHARS_PER_TOKEN
+
+# Fitted to the latencies of fake_models.py when no production percentiles are given
+DEFAULT_PROFILE = {
+    "openai": {"p50": 1.4, "p95": 2.2, "tokens_per_second": 80.0, "error_rate": 0.0},
+    "bedrock": {"p50": 4.0, "p95": 6.0, "tokens_per_second": 60.0, "error_rate": 0.0}
+}
+
+# Stage histograms of the app's /metrics holding the duration of each provider call
+METRICS_STAGES = {"openai": "openai_call", "bedrock": "bedrock_call"}
+
+# z-score of the 95th percentile of a normal distribution
+Z95 = 1.6449
+
+# Tokens sent per streamed chunk, fewer wakeups than one chunk per token
+TOKENS_PER_CHUNK = 4
+
+BUCKET_LINE = re.compile(r'^qa_stage_seconds_bucket\{stage="([^"]+)",le="([^"]+)"\} ([0-9.e+]+)$')
+
+def histogram_quantile(buckets: List[Tuple[float, float]], fraction: float) -> float:
+    """Quantile of a cumulative histogram, interpolated linearly within its bucket like Prometheus does."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1]
+    rank = fraction * total
+    lower_bound = lower_count = 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+def profile_from_metrics(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    Provider call percentiles from a Prometheus scrape of the app.
+
+    Scrapes of several workers may be concatenated, their buckets are added.
+
+    Args:
+        path (str): File with the text of /metrics
+
+    Returns:
+        dict: Profile with p50 and p95 of the providers found in the scrape
+    """
+    series: Dict[str, Dict[float, float]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            match = BUCKET_LINE.match(line.strip())
+            if match:
+                stage, bound, count = match.groups()
+                buckets = series.setdefault(stage, {})
+                bound = float(bound)
+                buckets[bound] = buckets.get(bound, 0.0) + float(count)
+    profile = {}
+    for provider, stage in METRICS_STAGES.items():
+        buckets = list(series.get(stage, {}).items())
+        if buckets and max(count for _, count in buckets) > 0:
+            profile[provider] = {
+                "p50": histogram_quantile(buckets, 0.5),
+                "p95": histogram_quantile(buckets, 0.95)
+            }
+    return profile
+
+class LatencyModel:
+    """Log-normal call durations with a given median and 95th percentile, and a token rate."""
+
+    def __init__(self, p50: float, p95: float, tokens_per_second: float = 50.0,
+                 error_rate: float = 0.0, scale: float = 1.0, seed: int = 0):
+        self.mu = math.log(p50 * scale)
+        self.sigma = max(math.log(p95 / p50), 0.0) / Z95
+        self.tokens_per_second = tokens_per_second / scale
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+
+    def next_call(self, tokens: int) -> Tuple[float, float, bool]:
+        """Time to the first token, seconds between streamed chunks and whether the call fails."""
+        duration = self._rng.lognormvariate(self.mu, self.sigma)
+        # Output is streamed at the token rate, as late as the call's duration allows
+        decode = min(tokens / self.tokens_per_second, duration)
+        failed = self.error_rate > 0 and self._rng.random() < self.error_rate
+        chunks = max(1, math.ceil(tokens / TOKENS_PER_CHUNK))
+        return duration - decode, decode / chunks, failed
+
+def chunks(text: str) -> List[str]:
+    size = TOKENS_PER_CHUNK * CHARS_PER_TOKEN
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+def tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def event_message(payload: Dict[str, Any]) -> bytes:
+    """One chunk event of a Bedrock response stream in the AWS event stream encoding."""
+    body = json.dumps({"bytes": base64.b64encode(json.dumps(payload).encode()).decode()}).encode()
+    headers = b"".join(
+        bytes([len(name)]) + name + b"\x07" + struct.pack(">H", len(value)) + value
+        for name, value in (
+            (b":event-type", b"chunk"),
+            (b":content-type", b"application/json"),
+            (b":message-type", b"event")
+        )
+    )
+    prelude = struct.pack(">II", 12 + len(headers) + len(body) + 4, len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack(">I", zlib.crc32(message))
+
+def create_app(profile: Dict[str, Dict[str, float]], scale: float = 1.0, seed: int = 0) -> FastAPI:
+    """
+    Build the mock server.
+
+    Args:
+        profile (dict): Percentiles, token rate and error rate per provider,
+            missing values default to DEFAULT_PROFILE
+        scale (float): Factor applied to every duration
+        seed (int): Seed of the latency and failure sequences
+
+    Returns:
+        FastAPI: The mock app
+    """
+    models = {
+        provider: LatencyModel(**{**defaults, **profile.get(provider, {})}, scale=scale, seed=seed + offset)
+        for offset, (provider, defaults) in enumerate(DEFAULT_PROFILE.items())
+    }
+    stats = {provider: {"calls": 0, "failed": 0, "streamed": 0, "input_tokens": 0, "output_tokens": 0}
+             for provider in models}
+    outputs = {"openai": 0, "bedrock": 0}
+    app = FastAPI(title="Mock upstreams")
+
+    def start_call(provider: str, output: str, body: bytes, stream: bool) -> Tuple[float, float, bool]:
+        ttft, interval, failed = models[provider].next_call(tokens(output))
+        counters = stats[provider]
+        counters["calls"] += 1
+        counters["streamed"] += stream
+        counters["failed"] += failed
+        if not failed:
+            # Images dominate the request body, a rough count is all the reports need
+            counters["input_tokens"] += len(body) // CHARS_PER_TOKEN
+            counters["output_tokens"] += tokens(output)
+        return ttft, interval, failed
+
+    def next_output(provider: str, candidates: List[str]) -> str:
+        index = outputs[provider]
+        outputs[provider] += 1
+        return candidates[index % len(candidates)]
+
+    async def delayed(ttft: float, interval: float, parts: List[bytes]) -> AsyncIterator[bytes]:
+        await asyncio.sleep(ttft)
+        for part in parts:
+            yield part
+            await asyncio.sleep(interval)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request) -> Response:
+        body = await request.body()
+        payload = json.loads(body)
+        model = payload.get("model", "gpt-4o")
+        answers = CANNED_FAST_ANSWERS if "mini" in model else [json.dumps(answer) for answer in CANNED_ANSWERS]
+        output = next_output("openai", answers)
+        stream = bool(payload.get("stream"))
+        ttft, interval, failed = start_call("openai", output, body, stream)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        usage = {"prompt_tokens": len(body) // CHARS_PER_TOKEN, "completion_tokens": tokens(output)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if failed:
+            await asyncio.sleep(ttft)
+            return JSONResponse(
+                {"error": {"message": "Injected fault: service unavailable", "type": "server_error"}},
+                status_code=503
+            )
+        if not stream:
+            await asyncio.sleep(ttft + interval * len(chunks(output)))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": output},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+        def event(choices: List[Dict[str, Any]], **extra: Any) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra
+            }
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        def delta(content: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+            return event([{"index": 0, "delta": content, "finish_reason": finish_reason}])
+
+        parts = [delta({"role": "assistant", "content": chunks(output)[0]})]
+        parts += [delta({"content": chunk}) for chunk in chunks(output)[1:]]
+        parts.append(delta({}, "stop"))
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            parts.append(event([], usage=usage))
+        parts.append(b"data: [DONE]\n\n")
+        return StreamingResponse(delayed(ttft, interval, parts), media_type="text/event-stream")
+
+    async def bedrock_call(model_id: str, request: Request, stream: bool) -> Response:
+        body = await request.body()
+        output = next_output("bedrock", CANNED_DIAGRAMS)
+        ttft, interval, failed = start_call("bedrock", output, body, stream)
+        input_tokens, output_tokens = len(body) // CHARS_PER_TOKEN, tokens(output)
+        if failed:
+            await asyncio.sleep(ttft)
+            return JSONResponse(
+                {"message": "Injected fault: service unavailable"},
+                status_code=503,
+                headers={"x-amzn-ErrorType": "ServiceUnavailableException"}
+            )
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": model_id
+        }
+        if not stream:
+            await asyncio.sleep(ttft + interval * len(chunks(output)))
+            return JSONResponse(
+                {
+                    **message,
+                    "content": [{"type": "text", "text": output}],
+                    "stop_reason": "end_turn",
+                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}
+                },
+                headers={
+                    "x-amzn-bedrock-input-token-count": str(input_tokens),
+                    "x-amzn-bedrock-output-token-count": str(output_tokens)
+                }
+            )
+
+        parts = [
+            event_message({
+                "type": "message_start",
+                "message": {**message, "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 1}}
+            }),
+            event_message({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        ]
+        parts += [
+            event_message({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}})
+            for chunk in chunks(output)
+        ]
+        parts += [
+            event_message({"type": "content_block_stop", "index": 0}),
+            event_message({
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn"},
+                "usage": {"output_tokens": output_tokens}
+            }),
+            event_message({
+                "type": "message_stop",
+                "amazon-bedrock-invocationMetrics": {
+                    "inputTokenCount": input_tokens,
+                    "outputTokenCount": output_tokens
+                }
+            })
+        ]
+        return StreamingResponse(delayed(ttft, interval, parts), media_type="application/vnd.amazon.eventstream")
+
+    @app.post("/model/{model_id}/invoke")
+    async def invoke(model_id: str, request: Request) -> Response:
+        return await bedrock_call(model_id, request, stream=False)
+
+    @app.post("/model/{model_id}/invoke-with-response-stream")
+    async def invoke_stream(model_id: str, request: Request) -> Response:
+        return await bedrock_call(model_id, request, stream=True)
+
+    @app.get("/mock/stats")
+    async def mock_stats() -> Dict[str, Any]:
+        return {
+            provider: {
+                **stats[provider],
+                "p50_seconds": math.exp(model.mu),
+                "p95_seconds": math.exp(model.mu + Z95 * model.sigma)
+            }
+            for provider, model in models.items()
+        }
+
+    return app
+
+def load_profile(profile_path: Optional[str], metrics_path: Optional[str]) -> Dict[str, Dict[str, float]]:
+    """Profile from a JSON file and/or a metrics scrape, the scrape's percentiles winning."""
+    profile: Dict[str, Dict[str, float]] = {}
+    if profile_path:
+        with open(profile_path, encoding="utf-8") as f:
+            profile = json.load(f)
+    if metrics_path:
+        for provider, percentiles in profile_from_metrics(metrics_path).items():
+            profile[provider] = {**profile.get(provider, {}), **percentiles}
+    return profile
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8100, help="Port to listen on")
+    parser.add_argument("--profile", help="JSON file with p50, p95, tokens_per_second and error_rate per provider")
+    parser.add_argument("--metrics", help="Prometheus scrape of the app's /metrics to take the percentiles from")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Factor applied to every duration")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency and failure sequences")
+    args = parser.parse_args()
+
+    import uvicorn
+    profile = load_profile(args.profile, args.metrics)
+    uvicorn.run(
+        create_app(profile, args.latency_scale, args.seed),
+        host=args.host, port=args.port, log_level="warning"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Tail latency of the QA graph when a provider degrades, with and without
+the resilience layer.
+
+The graph runs on the fake models (see fake_models.py) with faults
+injected into one provider per scenario:
+
+- healthy: no faults
+- bedrock_stalls: a share of diagram calls stalls before the first token
+- bedrock_down: every diagram call fails
+- openai_errors: a share of answer calls fails with a retryable 503
+- openai_tail: answer latency with a long tail (high log-normal sigma)
+
+Every scenario is run under three policies: "none" (no call timeouts,
+retries or breakers, like the agents before the resilience layer),
+"default" (call timeouts, retries and circuit breakers) and "hedged"
+(default plus hedged duplicate calls). Each run reports the share of
+requests answered and answered with a diagram, p50/p95/p99 latency and
+the retries, timeouts, rejected calls and hedges of the resilience layer.
+Times given on the command line are at the real model scale and are
+multiplied by --latency-scale like the fake latencies.
+
+Usage:
+    python -m benchmarks.resilience [--requests 200] [--concurrency 16]
+        [--scenarios healthy,bedrock_stalls,bedrock_down,openai_errors,openai_tail]
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import logging
+import time
+from graph import MultimodalQAGraph, ERROR_ANSWER
+from resilience import Resilience
+from scheduler import ProviderScheduler, request_deadline, SchedulerOverloaded
+from benchmarks.fake_models import install_fake_models, fake_qa_model, fake_diagram_model
+
+QUESTIONS = [
+    "Draw a triangle with angles 30 and 60 degrees and find the third angle.",
+    "Solve 2x + 3 = 11.",
+    "Find the area of a triangle with base 6 and height 4.",
+    "Sketch the graph of y = x^2 - 4."
+]
+
+# Faults of the answer and diagram models, and whether requests want a diagram;
+# the answer scenarios skip it, its latency would hide the answer's
+SCENARIOS = {
+    "healthy": ({}, {}, True),
+    "bedrock_stalls": ({}, {"stall_rate": 0.2}, True),
+    "bedrock_down": ({}, {"error_rate": 1.0}, True),
+    "openai_errors": ({"error_rate": 0.2}, {}, False),
+    "openai_tail": ({"ttft_sigma": 1.2}, {}, False)
+}
+
+POLICIES = ["none", "default", "hedged"]
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def build_graph(scenario: str, policy: str, args: argparse.Namespace) -> MultimodalQAGraph:
+    """Graph on fresh fakes with the scenario's faults and a fresh resilience layer with the policy."""
+    scale = args.latency_scale
+    qa_faults, diagram_faults, _ = SCENARIOS[scenario]
+    graph = MultimodalQAGraph("offline", "offline", "offline", "us-east-1", "offline")
+    install_fake_models(
+        graph,
+        fake_qa_model(**{
+            "ttft_median": 0.8 * scale, "tokens_per_second": 80 / scale, "seed": args.seed,
+            "stall_seconds": args.stall_seconds * scale, **qa_faults
+        }),
+        fake_diagram_model(
+            ttft_median=1.5 * scale, tokens_per_second=60 / scale, seed=args.seed + 1,
+            stall_seconds=args.stall_seconds * scale, **diagram_faults
+        )
+    )
+    # Fresh scheduler lanes too, their average service time must not carry over between runs
+    graph.qa_agent.scheduler = graph.diagram_agent.scheduler = ProviderScheduler()
+    resilience = Resilience()
+    graph.qa_agent.resilience = graph.diagram_agent.resilience = resilience
+    for provider in [*graph.qa_agent.providers, graph.diagram_agent.provider]:
+        if policy == "none":
+            resilience.configure(provider, call_timeout=10 ** 9, max_attempts=1, failure_threshold=10 ** 9)
+        else:
+            resilience.configure(
+                provider,
+                call_timeout=args.call_timeout * scale,
+                backoff_base=0.25 * scale,
+                backoff_max=4 * scale,
+                open_seconds=args.open_seconds * scale,
+                hedge=policy == "hedged"
+            )
+    return graph
+
+async def run(graph: MultimodalQAGraph, requests: int, concurrency: int,
+              budget: Optional[float], want_diagram: bool) -> Dict[str, Any]:
+    """Send every request through the graph with bounded concurrency."""
+    chain = graph.build()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    answered = with_diagram = 0
+
+    async def one(index: int) -> None:
+        nonlocal answered, with_diagram
+        async with semaphore:
+            if budget is not None:
+                request_deadline.set(time.monotonic() + budget)
+            started = time.perf_counter()
+            try:
+                result = await chain.ainvoke({
+                    "question": QUESTIONS[index % len(QUESTIONS)],
+                    "image": None,
+                    "answer": None,
+                    "diagram": None,
+                    "subject": None,
+                    "want_diagram": want_diagram
+                })
+            except SchedulerOverloaded:
+                result = None
+            latencies.append(time.perf_counter() - started)
+            if result is not None and result["answer"] != ERROR_ANSWER:
+                answered += 1
+                with_diagram += bool(result["diagram"]) and result["diagram"].startswith("<svg")
+
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    counts: Dict[str, int] = {}
+    for provider_stats in graph.qa_agent.resilience.stats().values():
+        for key in ("retries", "timeouts", "rejected", "hedged"):
+            counts[key] = counts.get(key, 0) + provider_stats[key]
+    return {
+        "answered": answered / requests,
+        "with_diagram": with_diagram / requests if want_diagram else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        **counts
+    }
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and policy")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Scale of the fake model latencies")
+    parser.add_argument("--call-timeout", type=float, default=30.0, help="Call timeout of both providers")
+    parser.add_argument("--request-budget", type=float, default=60.0, help="Deadline of every request")
+    parser.add_argument("--stall-seconds", type=float, default=60.0, help="Duration of an injected stall")
+    parser.add_argument("--open-seconds", type=float, default=30.0, help="Time an open circuit rejects calls")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake latency and fault sequences")
+    args = parser.parse_args()
+    # Injected faults are logged by the agents on every call
+    logging.basicConfig(level=logging.CRITICAL)
+
+    scale = args.latency_scale
+    print(f"{args.requests} requests at concurrency {args.concurrency}, latency scale {scale}")
+    print(f"{'scenario':<16}{'policy':<9}{'answered':>9}{'diagram':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'retries':>9}{'timeouts':>9}{'rejected':>9}{'hedged':>8}")
+    for scenario in args.scenarios.split(","):
+        for policy in POLICIES:
+            graph = build_graph(scenario, policy, args)
+            # Without the resilience layer nothing bounded a request but the scheduler
+            budget = None if policy == "none" else args.request_budget * scale
+            result = await run(graph, args.requests, args.concurrency, budget, SCENARIOS[scenario][2])
+            diagram = "-" if result["with_diagram"] is None else f"{result['with_diagram']:.2f}"
+            print(
+                f"{scenario:<16}{policy:<9}{result['answered']:>9.2f}{diagram:>9}"
+                f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+                f"{result['retries']:>9}{result['timeouts']:>9}{result['rejected']:>9}{result['hedged']:>8}"
+            )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Measure how fast a fresh server process is ready for traffic.
+
+Reports the seconds it takes to import main in a fresh interpreter, then
+starts the app with uvicorn (or gunicorn with uvicorn workers, see
+gunicorn.conf.py) in every AGENT_INIT mode and reports:
+
+- health: seconds from process start until GET /health answers
+- ready: seconds from process start until GET /ready answers 200, i.e. the
+  agents and clients of the worker are built
+
+Nothing is sent upstream, so placeholder credentials are used when none are
+configured. Exits with status 1 when /health takes longer than --max-seconds
+with AGENT_INIT background or lazy; eager waits for the agents by design.
+
+Usage:
+    python -m benchmarks.startup [--runs 3] [--workers 1] [--server uvicorn] [--max-seconds 1.0]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+MODES = ("background", "lazy", "eager")
+
+# Placeholders for the credentials main.py requires, no request reaches the providers
+PLACEHOLDER_ENV = {
+    "OPENAI_API_KEY": "startup-benchmark",
+    "AWS_ACCESS_KEY_ID": "startup-benchmark",
+    "AWS_SECRET_ACCESS_KEY": "startup-benchmark",
+    "AWS_SESSION_TOKEN": "startup-benchmark"
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def benchmark_env(mode: str) -> dict:
+    return {**PLACEHOLDER_ENV, **os.environ, "AGENT_INIT": mode, "LOG_LEVEL": "WARNING"}
+
+def measure_import() -> float:
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=benchmark_env("lazy"), capture_output=True, text=True, check=True
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+def wait_for(client: httpx.Client, url: str, started: float, timeout: float) -> float:
+    """Poll a URL until it answers 200, returning the seconds since started."""
+    while time.perf_counter() - started < timeout:
+        try:
+            if client.get(url).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{url} not ready after {timeout} seconds")
+
+def measure_server(mode: str, server: str, workers: int, timeout: float) -> dict:
+    port = free_port()
+    if server == "gunicorn":
+        command = [
+            sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}", "--workers", str(workers)
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning"
+        ]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=benchmark_env(mode), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1.0) as client:
+            health = wait_for(client, "/health", started, timeout)
+            ready = wait_for(client, "/ready", started, timeout)
+    except TimeoutError:
+        process.kill()
+        raise SystemExit(process.communicate()[1].decode(errors="replace"))
+    finally:
+        process.terminate()
+        process.wait()
+    return {"health": health, "ready": ready}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Server starts per mode, the median is reported")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes")
+    parser.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn", help="Server to start")
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="Allowed seconds until /health answers")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for a server")
+    args = parser.parse_args()
+
+    print(f"{args.server} with {args.workers} worker(s), median of {args.runs} runs")
+    print(f"import main: {statistics.median(measure_import() for _ in range(args.runs)):.2f} s")
+    print(f"{'AGENT_INIT':<12}{'health s':>10}{'ready s':>10}")
+    slow = []
+    for mode in MODES:
+        starts = [measure_server(mode, args.server, args.workers, args.timeout) for _ in range(args.runs)]
+        health = statistics.median(start["health"] for start in starts)
+        ready = statistics.median(start["ready"] for start in starts)
+        print(f"{mode:<12}{health:>10.2f}{ready:>10.2f}")
+        if mode != "eager" and health > args.max_seconds:
+            slow.append(mode)
+
+    if slow:
+        print(f"/health took longer than {args.max_seconds} s with AGENT_INIT {', '.join(slow)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Offline benchmark suite for the QA graph and the FastAPI app.
+
+Both chat models are replaced with the deterministic fakes from
+benchmarks.fake_models, so results depend only on this code and machine,
+not on GPT-4o or Bedrock. The images under test_data/{geometry, algebra,
+diagram-generation, text-only-questions} are driven through three scenarios:
+
+- preprocess: image preprocessing alone, CPU time per stage
+- graph: the compiled graph with preprocessed images, N requests at a fixed concurrency
+- app: multipart uploads to POST /ask through the ASGI app, including preprocessing
+
+Each scenario reports throughput, p50/p95/p99 latency, CPU time per
+request and peak Python memory (traced in a separate, shorter pass). The
+response cache and near-duplicate index are disabled so every request does
+the full work.
+
+Results are compared against benchmarks/baselines.json and the run exits
+with status 1 when a metric regresses by more than the tolerance. Baselines
+are machine specific; record them for your machine with --save-baseline.
+
+Usage:
+    python -m benchmarks.suite [--requests 200] [--concurrency 16] [--runs 3] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Callable, Awaitable
+
+# Configure the app for offline runs before it is imported
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "offline")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "offline")
+os.environ.setdefault("AWS_SESSION_TOKEN", "offline")
+os.environ["RESPONSE_CACHE_ENABLED"] = "false"
+os.environ["SIMILARITY_INDEX_ENABLED"] = "false"
+os.environ["DEFER_DIAGRAM"] = "false"
+# Thread workers keep preprocessing CPU time inside this process where it is measured
+os.environ["IMAGE_POOL_KIND"] = "thread"
+# Keep per request logging out of the report
+os.environ["LOG_LEVEL"] = "WARNING"
+
+import httpx
+from benchmarks.fake_models import install_fake_models, fake_qa_model, fake_diagram_model
+from image_utils import ImageHandle, process_image_bytes, find_images
+from graph import ERROR_ANSWER
+
+DATA_DIRS = ["geometry", "algebra", "diagram-generation", "text-only-questions"]
+QUESTION = "Solve the problem shown in the image."
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# Metrics compared against the baseline and whether a higher value is better;
+# p99 is reported but too noisy over a few hundred requests to gate on
+COMPARED_METRICS = {
+    "throughput_rps": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "cpu_ms_per_request": False,
+    "peak_memory_mb": False
+}
+
+def load_images(root: str) -> List[Dict[str, Any]]:
+    images = []
+    for directory in DATA_DIRS:
+        for path in find_images(os.path.join(root, directory)):
+            with open(path, "rb") as f:
+                images.append({"path": path, "contents": f.read()})
+    return images
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def drive(request: Callable[[int], Awaitable[None]], requests: int, concurrency: int) -> Dict[str, Any]:
+    """Run request(0..requests-1) with bounded concurrency and collect timings."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(index: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await request(index)
+            latencies.append(time.perf_counter() - start)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    return {
+        "requests": requests,
+        "throughput_rps": round(requests / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "cpu_ms_per_request": round(cpu / requests * 1000, 2)
+    }
+
+async def peak_memory(request: Callable[[int], Awaitable[None]], concurrency: int) -> float:
+    """Peak traced Python memory in MB over a short pass at the same concurrency."""
+    tracemalloc.start()
+    try:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(index: int) -> None:
+            async with semaphore:
+                await request(index)
+
+        await asyncio.gather(*(one(index) for index in range(concurrency * 2)))
+        return round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+    finally:
+        tracemalloc.stop()
+
+def run_preprocess(images: List[Dict[str, Any]], mode: str, repeat: int = 5) -> Dict[str, Any]:
+    stage_seconds: Dict[str, float] = {}
+    latencies = []
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for image in images:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            processed = process_image_bytes(image["contents"], image["path"], mode)
+            timings.append(time.perf_counter() - start)
+            for stage, seconds in processed.timings.items():
+                stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds / repeat
+        # The median of a few runs per image keeps the percentiles stable
+        latencies.append(statistics.median(timings))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    cpu, wall = cpu / repeat, wall / repeat
+
+    tracemalloc.start()
+    for image in images:
+        process_image_bytes(image["contents"], image["path"], mode)
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "requests": len(images),
+        "throughput_rps": round(len(images) / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "cpu_ms_per_request": round(cpu / len(images) * 1000, 2),
+        "peak_memory_mb": round(memory / 1e6, 1),
+        "stage_ms": {stage: round(seconds / len(images) * 1000, 2) for stage, seconds in stage_seconds.items()}
+    }
+
+async def run_graph(main: Any, images: List[Dict[str, Any]], requests: int, concurrency: int) -> Dict[str, Any]:
+    states = []
+    for image in images:
+        processed = process_image_bytes(image["contents"], image["path"], main.IMAGE_PREPROCESS_MODE)
+        states.append({
+            "question": QUESTION,
+            "image": processed,
+            "answer": None,
+            "diagram": None,
+            "subject": None
+        })
+
+    async def request(index: int) -> None:
+        state = dict(states[index % len(states)])
+        # A fresh handle per request, so each one pays for encoding its image like a real request
+        state["image"] = ImageHandle.restore(state["image"].data, state["image"].meta())
+        result = await main.chain.ainvoke(state)
+        if result["answer"] == ERROR_ANSWER:
+            raise RuntimeError("Graph returned an error answer")
+
+    result = await drive(request, requests, concurrency)
+    result["peak_memory_mb"] = await peak_memory(request, concurrency)
+    return result
+
+async def run_app(main: Any, images: List[Dict[str, Any]], requests: int, concurrency: int) -> Dict[str, Any]:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+
+        async def request(index: int) -> None:
+            image = images[index % len(images)]
+            response = await client.post(
+                "/ask",
+                data={"question": QUESTION},
+                files={"image": (os.path.basename(image["path"]), image["contents"], "image/jpeg")}
+            )
+            if response.status_code != 200 or response.json()["status"] != "success":
+                raise RuntimeError(f"/ask failed with {response.status_code}: {response.text[:200]}")
+
+        result = await drive(request, requests, concurrency)
+        result["peak_memory_mb"] = await peak_memory(request, concurrency)
+    return result
+
+def median_results(runs: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Per scenario median of every metric over several runs."""
+    def median(values: List[Any]) -> Any:
+        if isinstance(values[0], dict):
+            return {key: median([value[key] for value in values]) for key in values[0]}
+        return statistics.median(values)
+    return {scenario: median([run[scenario] for run in runs]) for scenario in runs[0]}
+
+def compare(results: Dict[str, Dict[str, Any]], baselines: Dict[str, Dict[str, Any]],
+            tolerance: float) -> List[str]:
+    """Describe every metric that is worse than its baseline by more than the tolerance."""
+    regressions = []
+    for scenario, result in results.items():
+        baseline = baselines.get(scenario, {})
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in baseline or metric not in result or not baseline[metric]:
+                continue
+            if metric == "p95_ms" and result["requests"] < 100:
+                # With few samples the p95 is a single image, too coarse to gate on
+                continue
+            change = result[metric] / baseline[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{scenario} {metric}: {result[metric]} vs baseline {baseline[metric]} ({change:+.0%})"
+                )
+    return regressions
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="test_data", help="Root of the test_data directories")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per graph and app scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--latency-scale", type=float, default=0.1,
+                        help="Multiplier on fake model latencies, 1.0 mimics the real models")
+    parser.add_argument("--runs", type=int, default=3, help="Runs of every scenario, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake latency distributions")
+    parser.add_argument("--scenarios", default="preprocess,graph,app", help="Comma separated scenarios to run")
+    parser.add_argument("--baseline", default=BASELINES, help="Baseline file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression per metric")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    import main as app_main
+    app_main.build_graph()
+    scale = args.latency_scale
+    images = load_images(args.data)
+    scenarios = args.scenarios.split(",")
+    print(f"{len(images)} images, {args.requests} requests at concurrency {args.concurrency}, "
+          f"latency scale {scale}, median of {args.runs} runs")
+
+    runs: List[Dict[str, Dict[str, Any]]] = []
+    for _ in range(args.runs):
+        # Fresh fakes so every run sees the same latency sequence
+        install_fake_models(
+            app_main.graph,
+            fake_qa_model(ttft_median=0.8 * scale, tokens_per_second=80 / scale, seed=args.seed),
+            fake_diagram_model(ttft_median=1.5 * scale, tokens_per_second=60 / scale, seed=args.seed + 1)
+        )
+        results: Dict[str, Dict[str, Any]] = {}
+        if "preprocess" in scenarios:
+            results["preprocess"] = run_preprocess(images, app_main.IMAGE_PREPROCESS_MODE)
+        if "graph" in scenarios:
+            results["graph"] = await run_graph(app_main, images, args.requests, args.concurrency)
+        if "app" in scenarios:
+            results["app"] = await run_app(app_main, images, args.requests, args.concurrency)
+        runs.append(results)
+    app_main.image_pool.shutdown()
+    results = median_results(runs)
+
+    print(f"{'scenario':<12}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cpu ms/req':>12}{'peak MB':>9}")
+    for scenario, result in results.items():
+        print(
+            f"{scenario:<12}{result['throughput_rps']:>9}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+            f"{result['p99_ms']:>9}{result['cpu_ms_per_request']:>12}{result['peak_memory_mb']:>9}"
+        )
+    if "preprocess" in results:
+        stages = ", ".join(f"{stage} {ms}" for stage, ms in results["preprocess"]["stage_ms"].items())
+        print(f"preprocess ms per image by stage: {stages}")
+
+    run = {"settings": vars(args) | {"images": len(images)}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, record one with --save-baseline")
+        return 0
+    with open(args.baseline, "r") as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print(f"Regressions beyond {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"No regressions beyond {args.tolerance:.0%} of the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,62 @@
+"""
+Bulk-build the near-duplicate problem index from a directory of images.
+
+Every image is answered once through the QA graph, which adds the result to
+the index configured by SIMILARITY_INDEX_PATH. A sidecar text file next to an
+image (problem1.jpeg -> problem1.txt) overrides the default question.
+
+Usage:
+    python build_index.py test_data/geometry --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+from image_utils import process_image_bytes, find_images
+
+DEFAULT_QUESTION = "Solve the problem shown in the image."
+
+def question_for(path: str, default: str) -> str:
+    """Read the sidecar question of an image, falling back to the default."""
+    sidecar = os.path.splitext(path)[0] + ".txt"
+    if os.path.exists(sidecar):
+        with open(sidecar, "r") as f:
+            return f.read().strip() or default
+    return default
+
+async def build(directory: str, question: str, concurrency: int) -> None:
+    # Imported here so the graph, agents and index come from the server configuration
+    import main
+    _, chain = main.build_graph()
+    similarity_index = main.similarity_index
+
+    if similarity_index is None:
+        raise SystemExit("SIMILARITY_INDEX_ENABLED is false, nothing to build")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def index_one(path: str) -> None:
+        async with semaphore:
+            with open(path, "rb") as f:
+                processed = await asyncio.to_thread(
+                    process_image_bytes, f.read(), path, main.IMAGE_PREPROCESS_MODE
+                )
+            await chain.ainvoke({
+                "question": question_for(path, question),
+                "image": processed,
+                "answer": None,
+                "diagram": None,
+                "subject": None
+            })
+            print(f"Indexed {path}")
+
+    paths = find_images(directory)
+    await asyncio.gather(*(index_one(path) for path in paths))
+    print(f"Indexed {len(paths)} images, index stats: {similarity_index.stats()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="Directory of PNG/JPEG problem images")
+    parser.add_argument("--question", default=DEFAULT_QUESTION, help="Question asked for images without a sidecar file")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of images answered at once")
+    args = parser.parse_args()
+    asyncio.run(build(args.directory, args.question, args.concurrency))
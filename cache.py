@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+def normalize_question(question: str) -> str:
+    """
+    Normalize question text so trivial variations share a cache entry.
+
+    Args:
+        question (str): Raw question text
+
+    Returns:
+        str: Case-folded question with collapsed whitespace
+    """
+    return " ".join(question.split()).casefold()
+
+class ResponseCache:
+    """
+    Two tier, content-addressed cache for agent responses.
+
+    Entries are looked up in a bounded in-memory LRU first and then in a
+    SQLite database on local disk. Disk entries expire after a TTL and the
+    least recently used ones are evicted once the database grows past
+    its size budget.
+    """
+
+    def __init__(self, path: Optional[str] = None, memory_items: int = 1024,
+                 ttl_seconds: float = 7 * 24 * 3600, max_disk_bytes: int = 256 * 1024 * 1024):
+        """
+        Initialize the ResponseCache.
+
+        Args:
+            path (str, optional): SQLite database file, memory tier only when None
+            memory_items (int): Maximum number of entries in the memory tier
+            ttl_seconds (float): Time to live of an entry
+            max_disk_bytes (int): Total payload size budget of the disk tier
+        """
+        self.memory_items = memory_items
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._db = None
+        self._disk_bytes = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL,"
+                " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._purge_expired()
+            row = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            self._disk_bytes = row[0]
+
+    @staticmethod
+    def make_key(kind: str, question: str, image_hash: Optional[str],
+                 model_id: str, prompt_version: str) -> str:
+        """
+        Build the content address of a response.
+
+        Args:
+            kind (str): Entry kind, e.g. "answer" or "diagram"
+            question (str): Question text
+            image_hash (str, optional): Hash of the decoded image pixels
+            model_id (str): Model that produces the response
+            prompt_version (str): Version of the prompt template
+
+        Returns:
+            str: Hex encoded SHA-256 cache key
+        """
+        material = json.dumps(
+            [kind, normalize_question(question), image_hash or "", model_id, prompt_version]
+        )
+        return f"{kind}:{hashlib.sha256(material.encode()).hexdigest()}"
+
+    def _count(self, kind: str, outcome: str) -> None:
+        counters = self._stats.setdefault(kind, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    def _remember(self, key: str, value: Any, expires: float) -> None:
+        self._memory[key] = (value, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _purge_expired(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        self._db.execute("DELETE FROM entries WHERE created < ?", (cutoff,))
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a cached response.
+
+        Args:
+            key (str): Key returned by make_key
+
+        Returns:
+            Any: Cached value, or None on a miss
+        """
+        kind = key.split(":", 1)[0]
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self._count(kind, "memory_hits")
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] + self.ttl_seconds > now:
+                    self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1] + self.ttl_seconds)
+                    self._count(kind, "disk_hits")
+                    return value
+
+            self._count(kind, "misses")
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Store a response in both tiers.
+
+        Args:
+            key (str): Key returned by make_key
+            value (Any): JSON serializable response
+        """
+        kind = key.split(":", 1)[0]
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now + self.ttl_seconds)
+            if self._db is None:
+                return
+
+            payload = json.dumps(value)
+            size = len(payload.encode())
+            row = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._disk_bytes -= row[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, kind, value, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, payload, size, now, now)
+            )
+            self._disk_bytes += size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drop expired entries, then least recently used ones until under budget."""
+        self._purge_expired()
+        cursor = self._db.execute("SELECT key, size FROM entries ORDER BY accessed ASC")
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        doomed = []
+        for key, size in cursor:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            doomed.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        self._disk_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get hit and miss counters of the cache.
+
+        Returns:
+            dict: Counters per entry kind plus the size of each tier
+        """
+        with self._lock:
+            return {
+                "kinds": {kind: dict(counters) for kind, counters in self._stats.items()},
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes if self._db is not None else None
+            }
@@ -0,0 +1,149 @@
+from collections import deque
+from typing import Optional, Dict, Any, Tuple
+import re
+import statistics
+import threading
+
+# Bump whenever check_answer accepts different answers, so that cached cascade
+# answers accepted by older checks are no longer reused
+CASCADE_CHECKS_VERSION = "2"
+
+# Self-reported confidence below which a cheaper tier's answer is escalated
+DEFAULT_MIN_CONFIDENCE = 0.7
+
+# Answers shorter than this are treated as not answering the question
+MIN_ANSWER_CHARS = 2
+
+# The prompt asks for step by step math solutions, a bare result is shorter than this
+MIN_MATH_ANSWER_CHARS = 30
+MATH_SUBJECT = re.compile(
+    r"math|algebra|geometry|calculus|arithmetic|trigonometry|statistic|probability", re.IGNORECASE
+)
+
+# Phrases of an answer that gives up or hedges instead of answering
+HEDGING = re.compile(
+    r"\b(i('| a)m not (sure|certain)|i cannot (determine|see|read|tell)|i can't (determine|see|read|tell)|"
+    r"unable to (determine|see|read|solve)|not enough information|unclear from the image)\b",
+    re.IGNORECASE
+)
+
+# Formulas, which the prompt asks to enclose in $$; a single $ is as often a price
+DISPLAY_MATH = re.compile(r"\$\$(.*?)\$\$", re.DOTALL)
+ENVIRONMENT = re.compile(r"\\(begin|end)\{([^}]*)\}")
+
+def latex_problem(text: str) -> Optional[str]:
+    """
+    Find obviously broken LaTeX in an answer.
+
+    Only checks that are cheap and unambiguous: unclosed $$ delimiters,
+    unbalanced braces in a formula, \\left without \\right and unmatched
+    \\begin/\\end environments.
+
+    Args:
+        text (str): Answer text
+
+    Returns:
+        str: Description of the first problem found, None when the LaTeX looks sane
+    """
+    if text.count("$$") % 2:
+        return "unclosed $$"
+    for segment in DISPLAY_MATH.findall(text):
+        depth = 0
+        for match in re.finditer(r"(?<!\\)[{}]", segment):
+            depth += 1 if match.group(0) == "{" else -1
+            if depth < 0:
+                return "unbalanced braces"
+        if depth:
+            return "unbalanced braces"
+        if len(re.findall(r"\\left\b", segment)) != len(re.findall(r"\\right\b", segment)):
+            return "unmatched \\left"
+        environments = []
+        for kind, name in ENVIRONMENT.findall(segment):
+            if kind == "begin":
+                environments.append(name)
+            elif not environments or environments.pop() != name:
+                return "unmatched environment"
+        if environments:
+            return "unmatched environment"
+    return None
+
+def check_answer(response: Optional[Dict[str, Any]], truncated: bool = False,
+                 min_confidence: float = DEFAULT_MIN_CONFIDENCE) -> Tuple[bool, str]:
+    """
+    Decide locally whether an answer of a cheaper model can be returned as is.
+
+    Args:
+        response (dict, optional): Parsed answer, subject and confidence, None when parsing failed
+        truncated (bool): Whether the model stopped at its token limit
+        min_confidence (float): Lowest self-reported confidence accepted
+
+    Returns:
+        tuple: Whether to accept the answer and the reason for the decision
+    """
+    if response is None:
+        return False, "parse"
+    if truncated:
+        return False, "truncated"
+    confidence = response.get("confidence")
+    if confidence is not None and confidence > 1:
+        # Reported as a percentage
+        confidence /= 100
+    if confidence is None or confidence < min_confidence:
+        return False, "confidence"
+    answer = response["answer"].strip()
+    min_chars = MIN_MATH_ANSWER_CHARS if MATH_SUBJECT.search(response.get("subject") or "") else MIN_ANSWER_CHARS
+    if len(answer) < min_chars:
+        return False, "length"
+    if HEDGING.search(answer):
+        return False, "hedging"
+    if latex_problem(answer) is not None:
+        return False, "latex"
+    return True, "accepted"
+
+class CascadeStats:
+    """Per-tier answer counters and latencies of a model cascade."""
+
+    def __init__(self, window: int = 1000):
+        """
+        Initialize the CascadeStats.
+
+        Args:
+            window (int): Recent calls per tier the latency percentiles are computed over
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._tiers: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, model_id: str, seconds: float, accepted: bool, reason: str) -> None:
+        with self._lock:
+            tier = self._tiers.setdefault(model_id, {
+                "calls": 0, "accepted": 0, "escalated": 0, "reasons": {},
+                "latencies": deque(maxlen=self.window)
+            })
+            tier["calls"] += 1
+            tier["accepted" if accepted else "escalated"] += 1
+            tier["reasons"][reason] = tier["reasons"].get(reason, 0) + 1
+            tier["latencies"].append(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get per-tier counters.
+
+        Returns:
+            dict: Calls, accepted and escalated answers, the reasons, the share
+                of answers the tier served and its latency percentiles, by model
+        """
+        with self._lock:
+            tiers = {}
+            for model_id, tier in self._tiers.items():
+                latencies = sorted(tier["latencies"])
+                tiers[model_id] = {
+                    "calls": tier["calls"],
+                    "accepted": tier["accepted"],
+                    "escalated": tier["escalated"],
+                    "hit_rate": round(tier["accepted"] / tier["calls"], 3),
+                    "reasons": dict(tier["reasons"]),
+                    "p50_ms": round(statistics.median(latencies) * 1000, 1),
+                    "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1)
+                }
+            return tiers
@@ -0,0 +1,216 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Tuple, Iterator, List
+import httpx
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PoolSettings:
+    """Connection pool settings of the upstream HTTP clients."""
+    openai_max_connections: int = 100
+    openai_max_keepalive: int = 100
+    openai_keepalive_expiry: float = 60.0
+    openai_connect_timeout: float = 5.0
+    openai_read_timeout: float = 60.0
+    openai_http2: bool = False
+    bedrock_max_connections: int = 50
+    bedrock_connect_timeout: float = 5.0
+    bedrock_read_timeout: float = 120.0
+
+# Settings used by clients created from now on, see configure_pools
+pool_settings = PoolSettings()
+
+_lock = threading.Lock()
+_openai_clients: Optional[Tuple[httpx.Client, httpx.AsyncClient]] = None
+_bedrock_clients: Dict[tuple, Any] = {}
+
+class _CountingAsyncTransport(httpx.AsyncHTTPTransport):
+    """Async transport that tracks how many requests are in flight."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests += 1
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            self.in_flight -= 1
+
+def configure_pools(**settings) -> None:
+    """
+    Override connection pool settings before the clients are first created.
+
+    Args:
+        **settings: PoolSettings fields to change
+    """
+    global pool_settings
+    pool_settings = PoolSettings(**{**pool_settings.__dict__, **settings})
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def openai_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """
+    Get the process-wide HTTP clients used for OpenAI calls.
+
+    Both clients are created once and shared by every ChatOpenAI instance, so
+    TLS connections are kept alive and reused across requests.
+
+    Returns:
+        tuple: Sync and async httpx clients
+    """
+    global _openai_clients
+    with _lock:
+        if _openai_clients is None:
+            settings = pool_settings
+            http2 = settings.openai_http2
+            if http2 and not _http2_available():
+                logger.warning("HTTP/2 requested for OpenAI but the h2 package is not installed, using HTTP/1.1")
+                http2 = False
+            limits = httpx.Limits(
+                max_connections=settings.openai_max_connections,
+                max_keepalive_connections=settings.openai_max_keepalive,
+                keepalive_expiry=settings.openai_keepalive_expiry
+            )
+            timeout = httpx.Timeout(
+                settings.openai_read_timeout,
+                connect=settings.openai_connect_timeout
+            )
+            _openai_clients = (
+                httpx.Client(limits=limits, timeout=timeout, http2=http2),
+                httpx.AsyncClient(
+                    transport=_CountingAsyncTransport(limits=limits, http2=http2),
+                    timeout=timeout
+                )
+            )
+        return _openai_clients
+
+# Response streams opened by Bedrock calls in the current context, see bedrock_response_streams
+_bedrock_response_streams: ContextVar[Optional[List[Any]]] = ContextVar("bedrock_response_streams", default=None)
+
+def _remember_response_stream(parsed: Dict[str, Any], **kwargs) -> None:
+    streams = _bedrock_response_streams.get()
+    if streams is not None and parsed.get("body") is not None:
+        streams.append(parsed["body"])
+
+@contextmanager
+def bedrock_response_streams() -> Iterator[List[Any]]:
+    """
+    Collect the response streams that Bedrock streaming calls open in this context.
+
+    LangChain reads a Bedrock stream in executor threads and never closes it
+    when the reader stops early, so the connection stays open and the model
+    keeps generating. Closing a collected stream drops the connection, which
+    makes Bedrock stop. Executor threads run in a copy of the caller's
+    context, so streams they open are collected too.
+
+    Yields:
+        list: botocore EventStreams opened so far
+    """
+    streams: List[Any] = []
+    token = _bedrock_response_streams.set(streams)
+    try:
+        yield streams
+    finally:
+        _bedrock_response_streams.reset(token)
+
+def bedrock_runtime_client(aws_access_key: str, aws_secret_key: str, region: str,
+                           session_token: Optional[str] = None) -> Any:
+    """
+    Get the process-wide bedrock-runtime client for a set of credentials.
+
+    The client keeps a pool of up to bedrock_max_connections keep-alive
+    connections instead of botocore's default of 10.
+
+    Args:
+        aws_access_key (str): AWS access key
+        aws_secret_key (str): AWS secret key
+        region (str): AWS region
+        session_token (str, optional): AWS session token
+
+    Returns:
+        botocore client for bedrock-runtime
+    """
+    # boto3 takes a while to import, only pay for it once Bedrock is used
+    import boto3
+    from botocore.config import Config
+
+    key = (aws_access_key, aws_secret_key, region, session_token)
+    with _lock:
+        if key not in _bedrock_clients:
+            settings = pool_settings
+            _bedrock_clients[key] = boto3.client(
+                service_name='bedrock-runtime',
+                aws_access_key_id=aws_access_key,
+                aws_secret_access_key=aws_secret_key,
+                aws_session_token=session_token,
+                region_name=region,
+                config=Config(
+                    max_pool_connections=settings.bedrock_max_connections,
+                    connect_timeout=settings.bedrock_connect_timeout,
+                    read_timeout=settings.bedrock_read_timeout,
+                    tcp_keepalive=True,
+                    # Retried by the resilience layer, within the request deadline
+                    retries={"total_max_attempts": 1}
+                )
+            )
+            _bedrock_clients[key].meta.events.register(
+                "after-call.bedrock-runtime.InvokeModelWithResponseStream", _remember_response_stream
+            )
+        return _bedrock_clients[key]
+
+def _openai_pool_stats() -> Optional[Dict[str, Any]]:
+    if _openai_clients is None:
+        return None
+    transport = _openai_clients[1]._transport
+    connections = transport._pool.connections
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "max_connections": pool_settings.openai_max_connections,
+        "open_connections": len(connections),
+        "idle_connections": idle,
+        "in_flight_requests": transport.in_flight,
+        "total_requests": transport.requests
+    }
+
+def _bedrock_pool_stats(client: Any) -> Dict[str, Any]:
+    # botocore does not expose its urllib3 pools publicly, read them defensively
+    manager = getattr(getattr(client._endpoint, "http_session", None), "_manager", None)
+    open_connections = idle = 0
+    if manager is not None:
+        for pool_key in list(manager.pools.keys()):
+            pool = manager.pools.get(pool_key)
+            if pool is not None:
+                open_connections += pool.num_connections
+                # The queue is pre-filled with None placeholders for unopened slots
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+    return {
+        "max_connections": client.meta.config.max_pool_connections,
+        "connections_created": open_connections,
+        "idle_connections": idle
+    }
+
+def pool_stats() -> Dict[str, Any]:
+    """
+    Get connection pool utilization of the upstream clients.
+
+    Returns:
+        dict: OpenAI and Bedrock pool statistics
+    """
+    with _lock:
+        return {
+            "openai": _openai_pool_stats(),
+            "bedrock": [_bedrock_pool_stats(client) for client in _bedrock_clients.values()]
+        }
@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+import gzip
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it diagrams are stored and served gzip compressed and as is
+    brotli = None
+
+# Content codings a diagram is stored in, from most to least preferred
+ENCODING_BROTLI = "br"
+ENCODING_GZIP = "gzip"
+ENCODING_IDENTITY = "identity"
+
+_SUFFIXES = {ENCODING_BROTLI: ".svg.br", ENCODING_GZIP: ".svg.gz", ENCODING_IDENTITY: ".svg"}
+
+GZIP_LEVEL = 9
+# Close to the ratio of quality 11 at a fraction of its time; diagrams are compressed while a request waits
+BROTLI_QUALITY = 9
+
+def diagram_hash(svg: str) -> str:
+    """Content hash a diagram is addressed by."""
+    return hashlib.sha256(svg.encode()).hexdigest()
+
+def is_diagram_hash(value: str) -> bool:
+    """Whether a path segment is a diagram content hash rather than a deferred diagram id."""
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+def accepted_encodings(accept_encoding: Optional[str]) -> set:
+    """
+    Content codings a client accepts.
+
+    Args:
+        accept_encoding (str, optional): Accept-Encoding request header
+
+    Returns:
+        set: Accepted codings, identity included unless it is refused explicitly
+    """
+    accepted = {ENCODING_IDENTITY}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().lower().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                pass
+        codings = [ENCODING_BROTLI, ENCODING_GZIP, ENCODING_IDENTITY] if coding == "*" else [coding.strip()]
+        for coding in codings:
+            if quality > 0:
+                accepted.add(coding)
+            else:
+                accepted.discard(coding)
+    return accepted
+
+def preferred_encoding(accept_encoding: Optional[str]) -> str:
+    """
+    Coding a diagram is served in to a client, without looking the diagram up.
+
+    Args:
+        accept_encoding (str, optional): Accept-Encoding request header
+
+    Returns:
+        str: The most preferred coding that is stored and accepted, identity when none is
+    """
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in (ENCODING_BROTLI, ENCODING_GZIP):
+        if encoding in accepted and (encoding != ENCODING_BROTLI or brotli is not None):
+            return encoding
+    return ENCODING_IDENTITY
+
+def diagram_etag(digest: str, encoding: str) -> str:
+    """Strong entity tag of a diagram in a coding; every coding is its own representation."""
+    return f'"{digest}"' if encoding == ENCODING_IDENTITY else f'"{digest}-{encoding}"'
+
+class DiagramAssets:
+    """
+    Content-addressed store of finished diagrams, kept compressed.
+
+    Every diagram is compressed once when it is stored, with gzip and (when
+    the brotli package is installed) brotli, so serving it never compresses
+    anything. Entries live in a directory shared by all workers, with the
+    most recently served ones also kept in a bounded memory tier. Diagrams
+    never change under their hash; stored ones expire after a TTL.
+    """
+
+    def __init__(self, directory: Optional[str] = None, memory_bytes: int = 32 * 1024 * 1024,
+                 ttl_seconds: float = 30 * 24 * 3600, purge_seconds: float = 3600):
+        """
+        Initialize the DiagramAssets.
+
+        Args:
+            directory (str, optional): Directory of the stored diagrams, memory tier only when None
+            memory_bytes (int): Size budget of the memory tier, all codings included
+            ttl_seconds (float): Time a stored diagram stays available after it was last stored
+            purge_seconds (float): Minimum interval between removals of expired diagrams
+        """
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.purge_seconds = purge_seconds
+        self._memory: "OrderedDict[str, Dict[str, bytes]]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {"stored": 0, "known": 0, "missing": 0, "expired": 0,
+                       "served": {ENCODING_BROTLI: 0, ENCODING_GZIP: 0, ENCODING_IDENTITY: 0},
+                       "bytes_served": 0, "bytes_uncompressed": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def _path(self, digest: str, encoding: str) -> str:
+        return os.path.join(self.directory, f"{digest}{_SUFFIXES[encoding]}")
+
+    def _remember(self, digest: str, bodies: Dict[str, bytes]) -> None:
+        with self._lock:
+            previous = self._memory.pop(digest, None)
+            if previous is not None:
+                self._memory_size -= sum(len(body) for body in previous.values())
+            self._memory[digest] = bodies
+            self._memory_size += sum(len(body) for body in bodies.values())
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= sum(len(body) for body in evicted.values())
+
+    @staticmethod
+    def _compress(svg: bytes) -> Dict[str, bytes]:
+        bodies = {ENCODING_IDENTITY: svg, ENCODING_GZIP: gzip.compress(svg, GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            bodies[ENCODING_BROTLI] = brotli.compress(svg, quality=BROTLI_QUALITY)
+        return bodies
+
+    def put(self, svg: str) -> str:
+        """
+        Store a diagram unless it is stored already. Blocking, run it off the event loop.
+
+        Args:
+            svg (str): SVG document
+
+        Returns:
+            str: Content hash to fetch the diagram with
+        """
+        digest = diagram_hash(svg)
+        if self.directory:
+            # Other workers serve from the directory, so it decides what is stored
+            identity = self._path(digest, ENCODING_IDENTITY)
+            known = os.path.exists(identity)
+            if known:
+                # Refreshed so the TTL counts from the last time the diagram was produced
+                os.utime(identity)
+        else:
+            with self._lock:
+                known = digest in self._memory
+        if known:
+            self._count("known")
+            return digest
+
+        bodies = self._compress(svg.encode())
+        if self.directory:
+            # The uncompressed file goes last: once it exists, every coding does
+            for encoding in (ENCODING_BROTLI, ENCODING_GZIP, ENCODING_IDENTITY):
+                if encoding not in bodies:
+                    continue
+                path = self._path(digest, encoding)
+                temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(bodies[encoding])
+                os.replace(temporary, path)
+            self._maybe_purge()
+        self._remember(digest, bodies)
+        self._count("stored")
+        return digest
+
+    def get(self, digest: str, accept_encoding: Optional[str] = None) -> Optional[Tuple[str, bytes]]:
+        """
+        Look up a diagram in the best coding the client accepts. Blocking, run it off the event loop.
+
+        Args:
+            digest (str): Content hash returned by put
+            accept_encoding (str, optional): Accept-Encoding request header
+
+        Returns:
+            tuple: Content coding and body, None for unknown or expired diagrams
+        """
+        accepted = accepted_encodings(accept_encoding)
+        with self._lock:
+            bodies = self._memory.get(digest)
+            if bodies is not None:
+                self._memory.move_to_end(digest)
+        if bodies is None and self.directory:
+            bodies = self._load(digest)
+        if bodies is None:
+            self._count("missing")
+            return None
+        for encoding in (ENCODING_BROTLI, ENCODING_GZIP, ENCODING_IDENTITY):
+            if encoding in accepted and encoding in bodies:
+                with self._lock:
+                    self._stats["served"][encoding] += 1
+                    self._stats["bytes_served"] += len(bodies[encoding])
+                    self._stats["bytes_uncompressed"] += len(bodies[ENCODING_IDENTITY])
+                return encoding, bodies[encoding]
+        return None
+
+    def _load(self, digest: str) -> Optional[Dict[str, bytes]]:
+        """Read every stored coding of a diagram into the memory tier."""
+        bodies = {}
+        for encoding in (ENCODING_BROTLI, ENCODING_GZIP, ENCODING_IDENTITY):
+            try:
+                with open(self._path(digest, encoding), "rb") as f:
+                    bodies[encoding] = f.read()
+            except FileNotFoundError:
+                continue
+        if ENCODING_IDENTITY not in bodies:
+            # Unknown, expired, or still being written by another worker
+            return None
+        self._remember(digest, bodies)
+        return bodies
+
+    def _maybe_purge(self) -> None:
+        now = time.time()
+        if now - self._last_purge < self.purge_seconds:
+            return
+        self._last_purge = now
+        cutoff = now - self.ttl_seconds
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(_SUFFIXES[ENCODING_IDENTITY]):
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                digest = entry.name[:-len(_SUFFIXES[ENCODING_IDENTITY])]
+                # The uncompressed file goes first, so a half removed diagram is never served
+                for encoding in (ENCODING_IDENTITY, ENCODING_GZIP, ENCODING_BROTLI):
+                    try:
+                        os.remove(self._path(digest, encoding))
+                    except FileNotFoundError:
+                        pass
+                self._count("expired")
+            except OSError:
+                continue
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get store and serving counters.
+
+        Returns:
+            dict: Diagrams stored, served per coding with the bytes saved by
+                compression, and the memory tier occupancy
+        """
+        with self._lock:
+            return {
+                "brotli": brotli is not None,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                **{key: dict(value) if isinstance(value, dict) else value for key, value in self._stats.items()},
+                "bytes_saved": self._stats["bytes_uncompressed"] - self._stats["bytes_served"]
+            }
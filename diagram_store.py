@@ -0,0 +1,241 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Awaitable
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# States of a deferred diagram
+DIAGRAM_PENDING = "pending"
+DIAGRAM_READY = "ready"
+DIAGRAM_FAILED = "failed"
+
+CANCELLED_MESSAGE = "Diagram generation was cancelled"
+
+class _Job:
+    """A diagram being generated in the background and its outcome."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.created = time.monotonic()
+        self.finished: Optional[float] = None
+        self.diagram: Optional[str] = None
+        self.error: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        if self.finished is None:
+            return DIAGRAM_PENDING
+        return DIAGRAM_FAILED if self.error is not None else DIAGRAM_READY
+
+class DiagramStore:
+    """
+    Bounded, expiring store of diagrams generated in the background.
+
+    Diagrams are generated by tasks on the event loop and looked up by id.
+    Finished diagrams expire after a TTL, and once the store is full the
+    oldest finished diagram is evicted first; pending diagrams are only
+    evicted (and their generation cancelled) when nothing else is left.
+
+    A diagram is generated by the worker that answered the question, but
+    the client may poll any worker. With a directory shared by all workers,
+    every diagram's status and result are also written there, and workers
+    that do not generate a diagram themselves poll its file.
+    """
+
+    def __init__(self, max_items: int = 1024, ttl_seconds: float = 600,
+                 directory: Optional[str] = None, poll_seconds: float = 0.25,
+                 purge_seconds: float = 300):
+        """
+        Initialize the DiagramStore.
+
+        Args:
+            max_items (int): Maximum number of pending and finished diagrams
+            ttl_seconds (float): Time a finished diagram stays available
+            directory (str, optional): Directory shared by all workers, this worker only when None
+            poll_seconds (float): Interval at which a diagram of another worker is polled
+            purge_seconds (float): Minimum interval between removals of expired diagrams from disk
+        """
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self.purge_seconds = purge_seconds
+        self._jobs: "OrderedDict[str, _Job]" = OrderedDict()
+        self._last_purge = 0.0
+        self._stats = {"submitted": 0, "ready": 0, "failed": 0, "expired": 0, "evicted": 0,
+                       "shared_lookups": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def submit(self, generation: Awaitable[str]) -> str:
+        """
+        Start generating a diagram in the background.
+
+        Args:
+            generation: Awaitable producing the SVG diagram
+
+        Returns:
+            str: Id to fetch the diagram with
+        """
+        self._purge_expired()
+        while len(self._jobs) >= self.max_items:
+            self._evict_one()
+
+        diagram_id = uuid.uuid4().hex
+        if self.directory:
+            # Written before the id is handed out, so no worker ever reports it unknown
+            self._write(diagram_id, {"status": DIAGRAM_PENDING})
+            generation = self._generate_shared(diagram_id, generation)
+        job = _Job(asyncio.ensure_future(generation))
+        job.task.add_done_callback(lambda task: self._finish(job, task))
+        self._jobs[diagram_id] = job
+        self._stats["submitted"] += 1
+        return diagram_id
+
+    async def _generate_shared(self, diagram_id: str, generation: Awaitable[str]) -> str:
+        """Generate a diagram and publish its outcome in the shared directory."""
+        try:
+            diagram = await generation
+        except asyncio.CancelledError:
+            # The thread finishes the write even if the task is cancelled again meanwhile. A task
+            # cancelled before it ever ran leaves the pending record, which expires with the TTL
+            await asyncio.to_thread(
+                self._write, diagram_id, {"status": DIAGRAM_FAILED, "message": CANCELLED_MESSAGE}
+            )
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self._write, diagram_id, {"status": DIAGRAM_FAILED, "message": str(e)})
+            raise
+        await asyncio.to_thread(self._write, diagram_id, {"status": DIAGRAM_READY, "diagram": diagram})
+        return diagram
+
+    def _path(self, diagram_id: str) -> str:
+        return os.path.join(self.directory, f"{diagram_id}.json")
+
+    def _write(self, diagram_id: str, record: Dict[str, Any]) -> None:
+        path = self._path(diagram_id)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+            os.replace(temporary, path)
+        except OSError as e:
+            # Other workers cannot see this diagram, this one still serves it
+            logger.warning("Could not store deferred diagram %s: %s", diagram_id, e)
+        if record["status"] != DIAGRAM_PENDING:
+            self._maybe_purge(time.time())
+
+    def _read(self, diagram_id: str) -> Optional[Dict[str, Any]]:
+        """Read a diagram another worker generates. Blocking, run it off the event loop."""
+        if not all(c in "0123456789abcdef" for c in diagram_id):
+            return None
+        path = self._path(diagram_id)
+        try:
+            # A pending diagram this old lost the worker generating it
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge < self.purge_seconds:
+            return
+        self._last_purge = now
+        cutoff = now - self.ttl_seconds
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    async def _wait_shared(self, diagram_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        self._stats["shared_lookups"] += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            record = await asyncio.to_thread(self._read, diagram_id)
+            if record is None or record["status"] != DIAGRAM_PENDING or time.monotonic() >= deadline:
+                return record
+            await asyncio.sleep(min(self.poll_seconds, deadline - time.monotonic()))
+
+    def _finish(self, job: _Job, task: asyncio.Task) -> None:
+        job.finished = time.monotonic()
+        if task.cancelled():
+            job.error = CANCELLED_MESSAGE
+        elif task.exception() is not None:
+            job.error = str(task.exception())
+        else:
+            job.diagram = task.result()
+        self._stats["failed" if job.error is not None else "ready"] += 1
+
+    def _purge_expired(self) -> None:
+        now = time.monotonic()
+        expired = [
+            diagram_id for diagram_id, job in self._jobs.items()
+            if job.finished is not None and now - job.finished > self.ttl_seconds
+        ]
+        for diagram_id in expired:
+            del self._jobs[diagram_id]
+        self._stats["expired"] += len(expired)
+
+    def _evict_one(self) -> None:
+        victim = next(
+            (diagram_id for diagram_id, job in self._jobs.items() if job.finished is not None),
+            next(iter(self._jobs))
+        )
+        job = self._jobs.pop(victim)
+        job.task.cancel()
+        self._stats["evicted"] += 1
+
+    async def wait(self, diagram_id: str, timeout: float = 0) -> Optional[Dict[str, Any]]:
+        """
+        Look up a diagram, waiting up to timeout seconds for it to finish.
+
+        Args:
+            diagram_id (str): Id returned by submit
+            timeout (float): Seconds to wait while the diagram is still pending
+
+        Returns:
+            dict: "status" ("pending", "ready" or "failed") with "diagram" or
+                "message", None for unknown or expired ids
+        """
+        self._purge_expired()
+        job = self._jobs.get(diagram_id)
+        if job is None:
+            return await self._wait_shared(diagram_id, timeout) if self.directory else None
+        if job.finished is None and timeout > 0:
+            # asyncio.wait never cancels the task, a client giving up leaves it running
+            await asyncio.wait({job.task}, timeout=timeout)
+        if job.status == DIAGRAM_READY:
+            return {"status": DIAGRAM_READY, "diagram": job.diagram}
+        if job.status == DIAGRAM_FAILED:
+            return {"status": DIAGRAM_FAILED, "message": job.error}
+        return {"status": DIAGRAM_PENDING}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get occupancy and outcome counters.
+
+        Returns:
+            dict: Store statistics
+        """
+        self._purge_expired()
+        pending = sum(1 for job in self._jobs.values() if job.finished is None)
+        return {
+            "max_items": self.max_items,
+            "pending": pending,
+            "finished": len(self._jobs) - pending,
+            **self._stats
+        }
+
+    def shutdown(self) -> None:
+        """Cancel diagrams still being generated."""
+        for job in self._jobs.values():
+            job.task.cancel()
@@ -1,33 +1,232 @@
 from langgraph.graph import StateGraph, END
-from typing import Dict, TypedDict, List, Any, Optional
-from agents import MultimodalAgent, DiagramAgent, QAResponse
+from typing import Dict, TypedDict, List, Any, Optional, AsyncIterator
+from agents import MultimodalAgent, DiagramAgent, QAResponse, DIAGRAM_ERROR_PREFIX
+from cascade import DEFAULT_MIN_CONFIDENCE
+from cache import ResponseCache
+from similarity import SimilarityIndex
+from scheduler import SchedulerOverloaded
+from diagram_store import DiagramStore
+from singleflight import SingleFlight
+from routing import needs_diagram, RoutingStats
+from metrics import record_outcome
+from image_utils import ImageHandle
 import asyncio
-import concurrent.futures
+import logging
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
+# Answer placed in the state when processing a question fails
+ERROR_ANSWER = "Error processing question"
+
 # Define the state type as a TypedDict instead of Pydantic model
 class GraphState(TypedDict):
     question: str
-    image: str | None
+    image: ImageHandle | None
     answer: str | None
     diagram: str | None
     subject: str | None
+    defer_diagram: bool | None
+    diagram_id: str | None
+    want_diagram: bool | None
 
 class MultimodalQAGraph:
     def __init__(self, openai_api_key: str, aws_access_key: str, aws_secret_key: str, 
-                 aws_region: str, aws_session_token: str):
-        """Initialize the graph with both agents."""
-        self.qa_agent = MultimodalAgent(openai_api_key)
+                 aws_region: str, aws_session_token: str,
+                 cache: Optional[ResponseCache] = None,
+                 similarity_index: Optional[SimilarityIndex] = None,
+                 diagram_store: Optional[DiagramStore] = None,
+                 flights: Optional[SingleFlight] = None,
+                 qa_models: Optional[List[str]] = None,
+                 cascade_min_confidence: float = DEFAULT_MIN_CONFIDENCE):
+        """Initialize the graph with both agents (the QA agent optionally as a model cascade), an optional response cache, near-duplicate index, deferred diagram store and in-flight call coalescing."""
+        self.qa_agent = MultimodalAgent(
+            openai_api_key, models=qa_models, min_confidence=cascade_min_confidence
+        )
         self.diagram_agent = DiagramAgent(
             aws_access_key, 
             aws_secret_key, 
             aws_region,
             aws_session_token
         )
+        self.cache = cache
+        self.similarity_index = similarity_index
+        self.diagram_store = diagram_store
+        self.flights = flights
+        self.routing = RoutingStats()
 
-    def process_question(self, state: Dict[str, Any]) -> Dict[str, Any]:
+    async def _cached(self, kind: str, agent: Any, question: str,
+                      image_hash: Optional[str], call, cacheable=lambda value: True) -> Any:
         """
-        Process input using both agents with true parallelism.
+        Run an agent call through the response cache and in-flight coalescing.
+        
+        On a cache miss, concurrent requests for the same content share one
+        upstream call, which also fills the cache for later requests.
+        
+        Args:
+            kind (str): Cache entry kind ("answer" or "diagram")
+            agent (Any): Agent providing model_id and prompt_version
+            question (str): Question text
+            image_hash (str, optional): Hash of the decoded image pixels
+            call: Coroutine function producing the response on a miss
+            cacheable: Predicate deciding whether a fresh response is stored
+            
+        Returns:
+            Any: Cached or freshly produced response
+        """
+        key = self._cache_key(kind, agent, question, image_hash)
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            record_outcome(f"cache_{kind}", "miss" if cached is None else "hit")
+            if cached is not None:
+                return cached
+
+        async def fill() -> Any:
+            value = await call()
+            if self.cache is not None and cacheable(value):
+                await asyncio.to_thread(self.cache.set, key, value)
+            return value
+
+        if self.flights is None:
+            return await fill()
+        return await self.flights.run(kind, key, fill)
+
+    @staticmethod
+    def _cache_key(kind: str, agent: Any, question: str, image_hash: Optional[str]) -> str:
+        """Cache key of an agent response."""
+        return ResponseCache.make_key(
+            kind, question, image_hash, agent.model_id, agent.prompt_version
+        )
+
+    @staticmethod
+    def _image_hashes(state: Dict[str, Any]) -> tuple:
+        """Exact pixel hash and perceptual hash of the image in the state."""
+        image = state.get("image")
+        if image is None:
+            return None, None
+        return image.pixel_hash, image.phash
+
+    def _index_model_key(self) -> str:
+        """Models and prompt versions behind indexed answers and diagrams, like the cache keys."""
+        return "|".join(
+            f"{agent.model_id}:{agent.prompt_version}" for agent in (self.qa_agent, self.diagram_agent)
+        )
+
+    async def _near_duplicate(self, question: str, phash: Optional[str],
+                              want_diagram: bool) -> Optional[Dict[str, Any]]:
+        """Look up a near-duplicate problem whose answer can be reused, without its diagram when none is wanted."""
+        if self.similarity_index is None:
+            return None
+        # The lookup first reads what other workers appended to the index file
+        match = await asyncio.to_thread(
+            self.similarity_index.lookup, question, phash, self._index_model_key()
+        )
+        record_outcome("near_duplicate", "miss" if match is None else "hit")
+        if match is not None:
+            logger.info("Near-duplicate hit (image distance %s)", match["image_distance"])
+            if not want_diagram:
+                match["diagram"] = ""
+        return match
+
+    async def _index_answer(self, question: str, phash: Optional[str], answer: str,
+                            subject: str, diagram: str) -> None:
+        """Index a fresh answer for future near-duplicate lookups."""
+        # A near-duplicate that wants a diagram must not reuse a missing one
+        if self.similarity_index is not None and diagram:
+            await asyncio.to_thread(
+                self.similarity_index.add, question, phash, answer, subject, diagram,
+                self._index_model_key()
+            )
+
+    async def _generate_diagram(self, question: str, image: Optional[ImageHandle],
+                                image_hash: Optional[str]) -> str:
+        """
+        Produce the (possibly cached) diagram of a question.
+        
+        A failed diagram (Bedrock down, timed out or its circuit open) is
+        returned as an empty one, so the answer goes out without it.
+        """
+        diagram = await self._cached(
+            "diagram", self.diagram_agent, question, image_hash,
+            lambda: self.diagram_agent.generate_diagram_description(
+                context=question,
+                image=image
+            ),
+            cacheable=lambda diagram: not diagram.startswith(DIAGRAM_ERROR_PREFIX)
+        )
+        if diagram.startswith(DIAGRAM_ERROR_PREFIX):
+            record_outcome("diagram", "degraded")
+            return ""
+        return diagram
+
+    def _want_diagram(self, state: Dict[str, Any]) -> bool:
+        """Decide whether a question gets a diagram and record the decision."""
+        override = state.get("want_diagram")
+        if override is not None:
+            want, reason = bool(override), "override"
+        else:
+            want, reason = needs_diagram(state["question"], state.get("image"))
+        self.routing.record(want, reason, overridden=override is not None)
+        record_outcome("route", "diagram" if want else "no_diagram")
+        logger.info("Routing question %s diagram (%s)", "with" if want else "without", reason)
+        return want
+
+    def route_question(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Routing node deciding whether the diagram agent is called at all.
+        
+        A want_diagram value in the input state overrides the local classifier.
+        
+        Args:
+            state (Dict[str, Any]): Input state containing question and image
+            
+        Returns:
+            Dict[str, Any]: State update with the want_diagram decision
+        """
+        return {"want_diagram": self._want_diagram(state)}
+
+    @staticmethod
+    def _next_node(state: Dict[str, Any]) -> str:
+        """Conditional edge following the routing node."""
+        return "process_question" if state["want_diagram"] else "answer_question"
+
+    def routing_stats(self) -> Dict[str, Any]:
+        """
+        Get routing decisions and an estimate of the diagram calls avoided.
+        
+        Returns:
+            dict: Routing counters, the diagram output tokens avoided at most
+                and the Bedrock time avoided at the current average call time
+        """
+        stats = self.routing.stats()
+        lane = self.diagram_agent.scheduler.stats().get(self.diagram_agent.provider, {})
+        stats["max_diagram_tokens_avoided"] = stats["without_diagram"] * self.diagram_agent.max_tokens
+        stats["est_diagram_seconds_avoided"] = round(
+            stats["without_diagram"] * lane.get("avg_service_ms", 0.0) / 1000, 1
+        )
+        return stats
+
+    async def _deferred_diagram(self, question: str, image: Optional[ImageHandle], image_hash: Optional[str],
+                                phash: Optional[str], answer: asyncio.Future) -> str:
+        """Generate a diagram in the background and index it with the answer once both are known."""
+        diagram = await self._generate_diagram(question, image, image_hash)
+        # asyncio.wait does not raise if the answer failed or was cancelled with its request
+        await asyncio.wait({answer})
+        if not answer.cancelled() and answer.exception() is None:
+            qa_response = answer.result()
+            await self._index_answer(
+                question, phash, qa_response.get("answer", "No answer provided"),
+                qa_response.get("subject", "General"), diagram
+            )
+        return diagram
+
+    async def process_question(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Process input using both agents concurrently on the event loop.
+        
+        With defer_diagram set in the state, only the answer is waited for:
+        the diagram keeps generating in the background and the returned
+        state carries a diagram_id to fetch it from the diagram store.
         
         Args:
             state (Dict[str, Any]): Input state containing question and image
@@ -38,45 +237,225 @@ class MultimodalQAGraph:
         try:
             question = state["question"]
             image = state["image"]
+            image_hash, phash = self._image_hashes(state)
             
-            # Use concurrent.futures to run both agents in parallel
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                # Submit tasks
-                qa_future = executor.submit(
-                    self.qa_agent.process_query, 
-                    question=question, 
-                    image=image
-                )
-                diagram_future = executor.submit(
-                    self.diagram_agent.generate_diagram_description, 
-                    context=question, 
-                    image=image
+            # Reuse the answer of a near-duplicate problem when one is indexed
+            match = await self._near_duplicate(question, phash, want_diagram=True)
+            if match is not None:
+                return {
+                    "question": state["question"],
+                    "image": state["image"],
+                    "answer": match["answer"],
+                    "subject": match["subject"],
+                    "diagram": match["diagram"],
+                    "diagram_id": None
+                }
+            
+            if state.get("defer_diagram") and self.diagram_store is not None:
+                answer = asyncio.ensure_future(self._cached(
+                    "answer", self.qa_agent, question, image_hash,
+                    lambda: self.qa_agent.process_query(question=question, image=image)
+                ))
+                diagram_id = self.diagram_store.submit(
+                    self._deferred_diagram(question, image, image_hash, phash, answer)
                 )
-                
-                # Get results (blocking)
-                qa_response = qa_future.result()  # This is a dictionary
-                diagram = diagram_future.result()
+                qa_response = await answer
+                return {
+                    "question": state["question"],
+                    "image": state["image"],
+                    "answer": qa_response.get("answer", "No answer provided"),
+                    "subject": qa_response.get("subject", "General"),
+                    "diagram": None,
+                    "diagram_id": diagram_id
+                }
+            
+            # Run both agents concurrently without blocking the event loop
+            qa_response, diagram = await asyncio.gather(
+                self._cached(
+                    "answer", self.qa_agent, question, image_hash,
+                    lambda: self.qa_agent.process_query(question=question, image=image)
+                ),
+                self._generate_diagram(question, image, image_hash)
+            )
+            
+            answer = qa_response.get("answer", "No answer provided")
+            subject = qa_response.get("subject", "General")
+            
+            # Index the fresh answer for future near-duplicate lookups
+            await self._index_answer(question, phash, answer, subject, diagram)
             
             # Create a new state dictionary with the updates
             return {
                 "question": state["question"],  # Preserve the original question
                 "image": state["image"],        # Preserve the original image
-                "answer": qa_response.get("answer", "No answer provided"),
-                "subject": qa_response.get("subject", "General"),
-                "diagram": diagram
+                "answer": answer,
+                "subject": subject,
+                "diagram": diagram,
+                "diagram_id": None
             }
             
+        except SchedulerOverloaded:
+            # Let the caller turn load shedding into a 429/503 response
+            raise
         except Exception as e:
-            print(f"Error in parallel processing: {str(e)}")
+            logger.error("Error in concurrent processing: %s", e)
             # Return a complete state dictionary with error values
             return {
                 "question": state["question"],  # Preserve the original question
                 "image": state["image"],        # Preserve the original image
-                "answer": "Error processing question",
+                "answer": ERROR_ANSWER,
                 "diagram": "Error generating diagram",
-                "subject": "General"
+                "subject": "General",
+                "diagram_id": None
             }
 
+    async def answer_question(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Process input with the QA agent only, for questions a diagram would not help.
+        
+        Args:
+            state (Dict[str, Any]): Input state containing question and image
+            
+        Returns:
+            Dict[str, Any]: Updated state with the answer and an empty diagram
+        """
+        try:
+            question = state["question"]
+            image = state["image"]
+            image_hash, phash = self._image_hashes(state)
+            
+            match = await self._near_duplicate(question, phash, want_diagram=False)
+            if match is not None:
+                return {
+                    "question": state["question"],
+                    "image": state["image"],
+                    "answer": match["answer"],
+                    "subject": match["subject"],
+                    "diagram": match["diagram"],
+                    "diagram_id": None
+                }
+            
+            qa_response = await self._cached(
+                "answer", self.qa_agent, question, image_hash,
+                lambda: self.qa_agent.process_query(question=question, image=image)
+            )
+            
+            # Not indexed: a near-duplicate that wants a diagram must not reuse an empty one
+            return {
+                "question": state["question"],
+                "image": state["image"],
+                "answer": qa_response.get("answer", "No answer provided"),
+                "subject": qa_response.get("subject", "General"),
+                "diagram": "",
+                "diagram_id": None
+            }
+            
+        except SchedulerOverloaded:
+            raise
+        except Exception as e:
+            logger.error("Error answering question: %s", e)
+            return {
+                "question": state["question"],
+                "image": state["image"],
+                "answer": ERROR_ANSWER,
+                "diagram": "",
+                "subject": "General",
+                "diagram_id": None
+            }
+
+    async def stream_question(self, state: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Process input like process_question, emitting results as they arrive.
+        
+        Answer tokens are streamed from the QA model while the diagram is
+        generated concurrently. The subject and the diagram are emitted as
+        soon as each one is known, in whichever order they complete. Questions
+        routed without a diagram get an empty diagram right away.
+        
+        Args:
+            state (Dict[str, Any]): Input state containing question and image
+            
+        Yields:
+            dict: Events with an "event" name ("token", "subject", "diagram"
+                or "error") and a "data" payload
+        """
+        question = state["question"]
+        image = state["image"]
+        image_hash, phash = self._image_hashes(state)
+        
+        want_diagram = self._want_diagram(state)
+        
+        match = await self._near_duplicate(question, phash, want_diagram)
+        if match is not None:
+            yield {"event": "token", "data": {"text": match["answer"]}}
+            yield {"event": "subject", "data": {"subject": match["subject"]}}
+            yield {"event": "diagram", "data": {"diagram": match["diagram"]}}
+            return
+        
+        events: asyncio.Queue = asyncio.Queue()
+        results: Dict[str, Any] = {}
+        
+        async def produce_answer() -> None:
+            key = self._cache_key("answer", self.qa_agent, question, image_hash)
+            cached = None
+            if self.cache is not None:
+                cached = await asyncio.to_thread(self.cache.get, key)
+                record_outcome("cache_answer", "miss" if cached is None else "hit")
+            if cached is not None:
+                qa_response = cached
+                await events.put({"event": "token", "data": {"text": qa_response["answer"]}})
+            else:
+                # Not coalesced: every stream gets the tokens of its own call
+                async for item in self.qa_agent.stream_query(question=question, image=image):
+                    if item["type"] == "token":
+                        await events.put({"event": "token", "data": {"text": item["text"]}})
+                    else:
+                        qa_response = {"answer": item["answer"], "subject": item["subject"]}
+                if self.cache is not None:
+                    await asyncio.to_thread(self.cache.set, key, qa_response)
+            results["answer"] = qa_response
+            await events.put({"event": "subject", "data": {"subject": qa_response["subject"]}})
+        
+        async def produce_diagram() -> None:
+            if not want_diagram:
+                await events.put({"event": "diagram", "data": {"diagram": ""}})
+                return
+            diagram = await self._generate_diagram(question, image, image_hash)
+            results["diagram"] = diagram
+            await events.put({"event": "diagram", "data": {"diagram": diagram}})
+        
+        async def run(stage: str, producer) -> None:
+            try:
+                await producer()
+            except Exception as e:
+                logger.error("Error streaming %s: %s", stage, e)
+                await events.put({"event": "error", "data": {"stage": stage, "message": str(e)}})
+            finally:
+                await events.put(None)
+        
+        tasks = [
+            asyncio.create_task(run("answer", produce_answer)),
+            asyncio.create_task(run("diagram", produce_diagram))
+        ]
+        try:
+            pending = len(tasks)
+            while pending:
+                event = await events.get()
+                if event is None:
+                    pending -= 1
+                    continue
+                yield event
+        finally:
+            # The client may disconnect mid-stream, stop any upstream work still running
+            for task in tasks:
+                task.cancel()
+        
+        if "answer" in results and "diagram" in results:
+            await self._index_answer(
+                question, phash, results["answer"]["answer"],
+                results["answer"]["subject"], results["diagram"]
+            )
+
     def build(self) -> Any:
         """
         Build the graph workflow.
@@ -87,13 +466,25 @@ class MultimodalQAGraph:
         # Create graph with state definition
         workflow = StateGraph(GraphState)
         
-        # Add processing node that handles true parallel execution
+        # Add routing node deciding whether a diagram is worth generating
+        workflow.add_node("route_question", self.route_question)
+        
+        # Add async processing node that runs both agents concurrently
         workflow.add_node("process_question", self.process_question)
         
-        # Add edge to END
+        # Add async processing node that runs the QA agent only
+        workflow.add_node("answer_question", self.answer_question)
+        
+        # Route to one of the processing nodes, both end the graph
+        workflow.add_conditional_edges(
+            "route_question",
+            self._next_node,
+            {"process_question": "process_question", "answer_question": "answer_question"}
+        )
         workflow.add_edge("process_question", END)
+        workflow.add_edge("answer_question", END)
         
         # Set entry point
-        workflow.set_entry_point("process_question")
+        workflow.set_entry_point("route_question")
         
         return workflow.compile() 
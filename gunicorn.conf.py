@@ -0,0 +1,32 @@
+"""
+Multi-worker deployment with gunicorn and uvicorn workers.
+
+    pip install gunicorn
+    gunicorn main:app -c gunicorn.conf.py
+
+The master imports the app once, before forking; every worker then builds
+its own agents, clients, cache connection and image pool (AGENT_INIT, see
+main.py), so nothing that holds a connection or a thread crosses a fork.
+
+With PRELOAD_AGENT_MODULES=true the master also imports the agent stack
+before forking. Workers then share those modules and build their agents in
+a fraction of a second, but the first workers start seconds later.
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import main in the master; it creates no clients or connections at import time
+preload_app = True
+
+# Replace a worker whose agents cannot start instead of waiting forever
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+
+def when_ready(server):
+    """Import the agent stack in the master before the workers are forked, if enabled."""
+    if os.getenv("PRELOAD_AGENT_MODULES", "false").lower() == "true":
+        import main
+        main.preload_agent_modules()
@@ -0,0 +1,221 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Dict, Any
+from image_utils import (
+    ImageHandle, ImageTooLarge, process_image_bytes, inspect_image, estimate_peak_bytes,
+    PREPROCESS_BUDGET, MAX_IMAGE_PIXELS, MAX_IMAGE_SIDE
+)
+from metrics import record_image_bytes
+import asyncio
+import multiprocessing
+import threading
+import time
+
+class ImagePoolFull(Exception):
+    """Raised when the image pool queue is full and a request is rejected."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Image preprocessing queue is full, retry later")
+        self.retry_after = retry_after
+
+class ImagePool:
+    """
+    Runs image preprocessing off the event loop in a bounded worker pool.
+
+    Decoding, resizing, encoding and hashing are CPU bound and hold
+    the GIL for most of their runtime, so by default they run in a pool of
+    worker processes. At most workers + queue_limit images are in flight;
+    anything beyond that is rejected immediately instead of queueing up.
+
+    Images are also admitted against a memory budget: each one reserves its
+    estimated peak preprocessing memory, computed from the image header
+    before anything is decoded, until its worker is done with it, even if
+    the request already timed out.
+    """
+
+    def __init__(self, workers: int = 2, queue_limit: int = 16, kind: str = "process",
+                 timeout: Optional[float] = 30.0, memory_limit: Optional[int] = None,
+                 max_pixels: int = MAX_IMAGE_PIXELS, max_side: int = MAX_IMAGE_SIDE):
+        """
+        Initialize the ImagePool.
+
+        Args:
+            workers (int): Number of worker processes or threads
+            queue_limit (int): Images allowed to wait for a free worker
+            kind (str): "process" for a process pool, "thread" for a thread pool
+            timeout (float, optional): Seconds an image may take including queueing
+            memory_limit (int, optional): Bytes of estimated peak memory all in-flight images may
+                reserve together, no limit if None
+            max_pixels (int): Maximum width * height of an image
+            max_side (int): Maximum width or height of an image
+        """
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.kind = kind
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_pixels = max_pixels
+        self.max_side = max_side
+        self._executor: Optional[Executor] = None
+        # Startup may create the executor in another thread than the first request
+        self._executor_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._memory_reserved = 0
+        self._stats: Dict[str, Any] = {
+            "processed": 0,
+            "rejected": 0,
+            "too_large": 0,
+            "memory_peak_reserved": 0,
+            "max_image_memory": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "stage_seconds": {}
+        }
+
+    def _get_executor(self) -> Executor:
+        with self._executor_lock:
+            if self._executor is None:
+                if self.kind == "thread":
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="image-pool"
+                    )
+                else:
+                    # Workers only need image_utils, not the server module
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload(["image_utils"])
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def start(self) -> None:
+        """
+        Start the workers ahead of the first request so it does not pay the startup cost.
+
+        Blocks while the workers start; call it from a thread to keep startup fast.
+        """
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(time.sleep, 0)
+
+    def _record(self, outcome: str, timings: Optional[Dict[str, float]] = None) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+            for stage, seconds in (timings or {}).items():
+                self._stats["stage_seconds"][stage] = self._stats["stage_seconds"].get(stage, 0.0) + seconds
+
+    async def process(self, contents: bytes, filename: str,
+                      mode: str = PREPROCESS_BUDGET) -> ImageHandle:
+        """
+        Preprocess an uploaded image in the pool.
+
+        Args:
+            contents (bytes): Raw bytes of the uploaded file
+            filename (str): Original file name
+            mode (str): Preprocessing mode, "budget" or "full"
+
+        Returns:
+            ImageHandle: Processed image, its timings include the time spent queueing
+
+        Raises:
+            ImageTooLarge: When the image exceeds the pixel limits or alone needs more
+                than the memory budget
+            ImagePoolFull: When too many images or too much memory are already in flight
+            asyncio.TimeoutError: When the image is not processed within the timeout
+        """
+        # Only the header is parsed here, so oversized images never reach a worker
+        try:
+            info = inspect_image(contents, self.max_pixels, self.max_side)
+        except ImageTooLarge:
+            self._record("too_large")
+            raise
+        memory = estimate_peak_bytes(info, len(contents), mode)
+        record_image_bytes("peak_estimate", memory)
+
+        with self._lock:
+            if self.memory_limit is not None and memory > self.memory_limit:
+                self._stats["too_large"] += 1
+                raise ImageTooLarge(
+                    f"Image needs about {memory} bytes to preprocess, more than the "
+                    f"limit of {self.memory_limit} bytes"
+                )
+            if (self._in_flight >= self.workers + self.queue_limit or
+                    (self.memory_limit is not None and
+                     self._memory_reserved + memory > self.memory_limit)):
+                self._stats["rejected"] += 1
+                raise ImagePoolFull(retry_after=1.0)
+            self._in_flight += 1
+            self._memory_reserved += memory
+            self._stats["memory_peak_reserved"] = max(self._stats["memory_peak_reserved"], self._memory_reserved)
+            self._stats["max_image_memory"] = max(self._stats["max_image_memory"], memory)
+
+        def release(_future=None) -> None:
+            with self._lock:
+                self._in_flight -= 1
+                self._memory_reserved -= memory
+
+        submitted = time.perf_counter()
+        try:
+            task = self._get_executor().submit(
+                _timed_process, contents, filename, mode, submitted, self.max_pixels, self.max_side
+            )
+        except Exception:
+            release()
+            self._record("failed")
+            raise
+        # A timeout only cancels the task while it is still queued; once a worker
+        # runs it, the image holds its slot and memory until the worker is done
+        task.add_done_callback(release)
+        try:
+            processed = await asyncio.wait_for(asyncio.wrap_future(task), self.timeout)
+        except asyncio.TimeoutError:
+            self._record("timed_out")
+            raise
+        except Exception:
+            self._record("failed")
+            raise
+
+        processed.timings["total"] = time.perf_counter() - submitted
+        self._record("processed", processed.timings)
+        return processed
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get pool occupancy, outcome counters and average time per stage.
+
+        Returns:
+            dict: Pool statistics
+        """
+        with self._lock:
+            processed = self._stats["processed"]
+            return {
+                "kind": self.kind,
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._in_flight,
+                "processed": processed,
+                "rejected": self._stats["rejected"],
+                "too_large": self._stats["too_large"],
+                "memory_limit_bytes": self.memory_limit,
+                "memory_reserved_bytes": self._memory_reserved,
+                "memory_peak_reserved_bytes": self._stats["memory_peak_reserved"],
+                "max_image_memory_bytes": self._stats["max_image_memory"],
+                "failed": self._stats["failed"],
+                "timed_out": self._stats["timed_out"],
+                "avg_stage_ms": {
+                    stage: seconds / processed * 1000
+                    for stage, seconds in self._stats["stage_seconds"].items()
+                } if processed else {}
+            }
+
+    def shutdown(self) -> None:
+        """Stop the workers."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+def _timed_process(contents: bytes, filename: str, mode: str, submitted: float,
+                   max_pixels: int = MAX_IMAGE_PIXELS, max_side: int = MAX_IMAGE_SIDE) -> ImageHandle:
+    """Worker entry point, records how long the image waited for a worker."""
+    queued = time.perf_counter() - submitted
+    processed = process_image_bytes(contents, filename, mode, max_pixels, max_side)
+    processed.timings["queue"] = queued
+    return processed
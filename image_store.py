@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from image_utils import ImageHandle
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+def handle_memory_bytes(image: ImageHandle) -> int:
+    """Memory an image holds once both provider encodings are built: its bytes and two base64 copies."""
+    return image.byte_size * 11 // 3
+
+class ImageStore:
+    """
+    Store of preprocessed images uploaded once and referenced by id.
+
+    Follow-up questions about an uploaded image reuse its ImageHandle, so
+    they skip the upload, decoding, re-encoding and, within a worker, the
+    base64 encoding. Handles are kept in a memory tier bounded by entries
+    and bytes, evicted least recently used first. With a directory shared
+    by all workers, the image bytes and metadata are also stored there, so
+    any worker can answer a follow-up. Images expire when they were not
+    used for a TTL.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_items: int = 1024,
+                 memory_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 3600,
+                 purge_seconds: float = 300):
+        """
+        Initialize the ImageStore.
+
+        Args:
+            directory (str, optional): Directory of the stored images, memory tier only when None
+            max_items (int): Maximum number of images in the memory tier
+            memory_bytes (int): Memory budget of the memory tier, encodings included
+            ttl_seconds (float): Time an image stays available after it was last used
+            purge_seconds (float): Minimum interval between removals of expired images from disk
+        """
+        self.directory = directory
+        self.max_items = max_items
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.purge_seconds = purge_seconds
+        # image_id -> (handle, last used, last refreshed on disk)
+        self._memory: "OrderedDict[str, list]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {"uploads": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0,
+                       "evicted": 0, "expired": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def image_id(image: ImageHandle) -> str:
+        """Id of an image, derived from its content so re-uploads share an entry."""
+        return hashlib.sha256(image.data).hexdigest()[:32]
+
+    def _paths(self, image_id: str) -> tuple:
+        base = os.path.join(self.directory, image_id)
+        return f"{base}.img", f"{base}.json"
+
+    def _count(self, outcome: str, count: int = 1) -> None:
+        with self._lock:
+            self._stats[outcome] += count
+
+    def _remember(self, image_id: str, image: ImageHandle, now: float) -> None:
+        with self._lock:
+            previous = self._memory.pop(image_id, None)
+            if previous is not None:
+                # Keep the handle already in use, with the encodings it has built
+                image = previous[0]
+                self._memory_size -= handle_memory_bytes(image)
+            self._memory[image_id] = [image, now, now]
+            self._memory_size += handle_memory_bytes(image)
+            while len(self._memory) > 1 and (
+                    len(self._memory) > self.max_items or self._memory_size > self.memory_bytes):
+                _, (evicted, _, _) = self._memory.popitem(last=False)
+                self._memory_size -= handle_memory_bytes(evicted)
+                self._stats["evicted"] += 1
+
+    def put(self, image: ImageHandle) -> str:
+        """
+        Store an image. Blocking, run it off the event loop.
+
+        Args:
+            image (ImageHandle): Preprocessed image
+
+        Returns:
+            str: Id to reference the image with
+        """
+        image_id = self.image_id(image)
+        now = time.time()
+        if self.directory:
+            data_path, meta_path = self._paths(image_id)
+            if os.path.exists(meta_path):
+                os.utime(meta_path)
+            else:
+                # Metadata goes last: once it exists, the image is complete
+                for path, content in ((data_path, image.data), (meta_path, json.dumps(image.meta()).encode())):
+                    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+                    with open(temporary, "wb") as f:
+                        f.write(content)
+                    os.replace(temporary, path)
+            self._maybe_purge(now)
+        self._remember(image_id, image, now)
+        self._count("uploads")
+        return image_id
+
+    def get(self, image_id: str) -> Optional[ImageHandle]:
+        """
+        Look up an image and restart its TTL. Blocking, run it off the event loop.
+
+        Args:
+            image_id (str): Id returned by put
+
+        Returns:
+            ImageHandle: The image, None for unknown or expired ids
+        """
+        now = time.time()
+        refresh = False
+        with self._lock:
+            entry = self._memory.get(image_id)
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                del self._memory[image_id]
+                self._memory_size -= handle_memory_bytes(entry[0])
+                self._stats["expired"] += 1
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(image_id)
+                entry[1] = now
+                # Keep the shared copy alive for other workers, without touching it on every hit
+                refresh = now - entry[2] > self.ttl_seconds / 10
+                if refresh:
+                    entry[2] = now
+                self._stats["memory_hits"] += 1
+        if entry is not None:
+            if refresh and self.directory:
+                try:
+                    os.utime(self._paths(image_id)[1])
+                except FileNotFoundError:
+                    pass
+            return entry[0]
+
+        image = self._load(image_id, now) if self.directory else None
+        self._count("misses" if image is None else "disk_hits")
+        return image
+
+    def _load(self, image_id: str, now: float) -> Optional[ImageHandle]:
+        if not all(c in "0123456789abcdef" for c in image_id):
+            return None
+        data_path, meta_path = self._paths(image_id)
+        try:
+            if now - os.path.getmtime(meta_path) > self.ttl_seconds:
+                return None
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(data_path, "rb") as f:
+                image = ImageHandle.restore(f.read(), meta)
+            os.utime(meta_path)
+        except FileNotFoundError:
+            return None
+        self._remember(image_id, image, now)
+        return image
+
+    def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge < self.purge_seconds:
+            return
+        self._last_purge = now
+        cutoff = now - self.ttl_seconds
+        expired = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                data_path, meta_path = self._paths(entry.name[:-len(".json")])
+                # Metadata goes first, so a half removed image is never loaded
+                os.remove(meta_path)
+                os.remove(data_path)
+                expired += 1
+            except OSError:
+                continue
+        self._count("expired", expired)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get occupancy and lookup counters.
+
+        Returns:
+            dict: Memory tier occupancy and counters
+        """
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "ttl_seconds": self.ttl_seconds,
+                **self._stats
+            }
@@ -1,53 +1,716 @@
-from fastapi import UploadFile, HTTPException
-from PIL import Image
+# Starlette rather than FastAPI: image workers import this module, and FastAPI takes far longer to import
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from PIL import Image, ImageOps
 from io import BytesIO
+from dataclasses import dataclass, field
+from typing import Dict, Any, Tuple, Optional, NamedTuple, Callable
+from similarity import perceptual_hash, PHASH_SIZE
 import base64
+import hashlib
+import os
 import sys
+import threading
+import time
 
-def process_image(image_file: UploadFile) -> str:
+# Preprocessing modes: re-encode at full resolution, or fit the provider token budget
+PREPROCESS_FULL = "full"
+PREPROCESS_BUDGET = "budget"
+
+# OpenAI high detail images are fit within 2048x2048, then the short side to 768
+OPENAI_MAX_SIDE = 2048
+OPENAI_MAX_SHORT_SIDE = 768
+
+# Claude downscales images above a 1568 long edge or about 1.15 megapixels
+ANTHROPIC_MAX_LONG_SIDE = 1568
+ANTHROPIC_MAX_PIXELS = 1_150_000
+
+# Largest upload sent as is; Bedrock rejects images over 5 MB once base64 encoded
+MAX_PASSTHROUGH_BYTES = 3_750_000
+
+# Encoding settings of budget mode
+BUDGET_JPEG_QUALITY = 85
+GRAPHIC_MAX_COLORS = 256
+
+EXIF_ORIENTATION = 0x0112
+
+# Luminance quantization table of the JPEG standard (ITU T.81 Annex K), which
+# encoders scale by their quality setting
+JPEG_STANDARD_LUMINANCE = (
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99
+)
+
+# Metadata left out of passed through images: EXIF (GPS included), XMP, ICC
+# profiles, IPTC and comments. JFIF and Adobe segments affect decoding and stay
+JPEG_METADATA_MARKERS = {0xE1, 0xE2, 0xED, 0xFE}
+PNG_METADATA_CHUNKS = {b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"iCCP", b"tIME"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Upload limits: larger files are rejected before they are read completely
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Room for the other form fields of a multipart request next to the image
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+# Pixel limits, checked from the image header before anything is decoded
+MAX_IMAGE_PIXELS = 40_000_000
+MAX_IMAGE_SIDE = 12_000
+
+# Input bytes base64 encoded at a time, a multiple of 3 so slices need no padding
+BASE64_CHUNK_BYTES = 3 * 256 * 1024
+
+# Working memory of the decoders and encoders on top of the image buffers
+PREPROCESS_OVERHEAD_BYTES = 4 * 1024 * 1024
+
+# Rows hashed at a time, bounds the pixel copy made for hashing
+HASH_ROWS = 256
+
+class ImageTooLarge(ValueError):
+    """Raised when an upload exceeds the byte, pixel or memory limits."""
+
+class ImageInfo(NamedTuple):
+    """Header information of an image, available without decoding it."""
+    width: int
+    height: int
+    bands: int
+    format: Optional[str]
+
+@dataclass
+class ImageHandle:
     """
-    Process uploaded image file and convert to base64.
-    Supports PNG and JPG/JPEG formats.
+    A preprocessed image as carried through the graph.
+
+    Holds the encoded image bytes once. The payload each provider expects
+    (an OpenAI data URL, an Anthropic base64 source block) is built on first
+    use and memoized, so an image is base64 encoded once per request and no
+    adapter has to parse a data URL back apart.
+    """
+    data: bytes
+    pixel_hash: str
+    phash: str
+    width: int
+    height: int
+    format: str
+    timings: Dict[str, float] = field(default_factory=dict, repr=False, compare=False)
+    _encodings: Dict[str, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _lock: Any = field(default_factory=threading.RLock, init=False, repr=False, compare=False)
+
+    @classmethod
+    def restore(cls, data: bytes, meta: Dict[str, Any]) -> "ImageHandle":
+        """Rebuild a handle from its bytes and the metadata returned by meta()."""
+        return cls(data, meta["pixel_hash"], meta["phash"], meta["width"], meta["height"], meta["format"])
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Sent back from image workers before any encoding exists; locks do not pickle
+        state = self.__dict__.copy()
+        del state["_lock"], state["_encodings"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state, _encodings={}, _lock=threading.RLock())
+
+    @property
+    def byte_size(self) -> int:
+        return len(self.data)
+
+    @property
+    def media_type(self) -> str:
+        return "image/png" if self.format == 'PNG' else "image/jpeg"
+
+    def _encoded(self, kind: str, build: Callable[[], Any]) -> Any:
+        encoded = self._encodings.get(kind)
+        if encoded is None:
+            # Build every encoding exactly once even if threads share the handle; reentrant
+            # because the Anthropic source is cut from the data URL
+            with self._lock:
+                encoded = self._encodings.get(kind)
+                if encoded is None:
+                    encoded = self._encodings[kind] = build()
+        return encoded
+
+    @property
+    def _data_url_prefix(self) -> str:
+        return f"data:{self.media_type};base64,"
+
+    @property
+    def data_url(self) -> str:
+        """data:image/...;base64,... URL, the image payload of OpenAI."""
+        return self._encoded("data_url", lambda: base64_text(self.data, self._data_url_prefix))
+
+    @property
+    def anthropic_source(self) -> Dict[str, str]:
+        """Base64 image source block of the Anthropic messages API."""
+        # Cut from the data URL, which the QA call needs anyway, instead of encoding twice
+        return self._encoded("anthropic", lambda: {
+            "type": "base64",
+            "media_type": self.media_type,
+            "data": self.data_url[len(self._data_url_prefix):]
+        })
+
+    def meta(self) -> Dict[str, Any]:
+        """Return the image metadata, e.g. to store the image next to its bytes."""
+        return {
+            "pixel_hash": self.pixel_hash,
+            "phash": self.phash,
+            "width": self.width,
+            "height": self.height,
+            "format": self.format,
+            "byte_size": self.byte_size
+        }
+
+class StageTimer:
+    """Records the wall time spent in consecutive preprocessing stages."""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def mark(self, stage: str) -> None:
+        """Attribute the time since the previous mark to a stage."""
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self._last
+        self._last = now
+
+def pixel_hash(img: Image.Image) -> str:
+    """
+    Compute a content hash over the decoded pixels of an image.
+    
+    Two uploads with identical pixels hash the same even when their
+    container bytes (metadata, JPEG encoder settings) differ.
     
     Args:
-        image_file (UploadFile): Uploaded image file
+        img (Image.Image): Decoded image
+        
+    Returns:
+        str: Hex encoded SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{img.mode}:{img.width}x{img.height}:".encode())
+    # Rows are contiguous, so hashing strips gives the digest of the whole buffer
+    for top in range(0, img.height, HASH_ROWS):
+        digest.update(img.crop((0, top, img.width, min(img.height, top + HASH_ROWS))).tobytes())
+    return digest.hexdigest()
+
+def provider_image_size(width: int, height: int, provider: str) -> Tuple[int, int]:
+    """
+    Largest size of an image that a provider actually uses.
+    
+    Anything above this is downscaled by the provider before it is
+    tokenized, so sending more pixels only costs bandwidth and encode time.
+    
+    Args:
+        width (int): Image width
+        height (int): Image height
+        provider (str): "openai" or "anthropic"
         
     Returns:
-        str: Base64 encoded image with data URL format
+        tuple: Target (width, height), never larger than the input
+    """
+    scale = 1.0
+    if provider == "openai":
+        # High detail: fit within 2048x2048, then the short side to 768
+        scale = min(scale, OPENAI_MAX_SIDE / max(width, height))
+        scale = min(scale, OPENAI_MAX_SHORT_SIDE / min(width, height))
+    elif provider == "anthropic":
+        scale = min(scale, ANTHROPIC_MAX_LONG_SIDE / max(width, height))
+        scale = min(scale, (ANTHROPIC_MAX_PIXELS / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def budget_image_size(width: int, height: int) -> Tuple[int, int]:
+    """
+    Size that satisfies every provider the image is sent to.
+    
+    The same image goes to OpenAI and Bedrock, so keep the larger of the
+    two provider sizes.
+    
+    Args:
+        width (int): Image width
+        height (int): Image height
+        
+    Returns:
+        tuple: Target (width, height)
+    """
+    return max(
+        (provider_image_size(width, height, provider) for provider in ("openai", "anthropic")),
+        key=lambda size: size[0] * size[1]
+    )
+
+def check_image_size(width: int, height: int, max_pixels: int = MAX_IMAGE_PIXELS,
+                     max_side: int = MAX_IMAGE_SIDE) -> None:
+    """
+    Reject images too large to decode safely, such as decompression bombs.
+    
+    Args:
+        width (int): Image width from the header
+        height (int): Image height from the header
+        max_pixels (int): Maximum width * height
+        max_side (int): Maximum width or height
+        
+    Raises:
+        ImageTooLarge: When a limit is exceeded
+    """
+    if max(width, height) > max_side or width * height > max_pixels:
+        raise ImageTooLarge(
+            f"Image of {width}x{height} pixels exceeds the limit of "
+            f"{max_pixels} pixels and {max_side} pixels per side"
+        )
+
+def open_image(contents: bytes, max_pixels: int = MAX_IMAGE_PIXELS,
+               max_side: int = MAX_IMAGE_SIDE) -> Image.Image:
+    """
+    Open an image lazily, only its header is parsed, and check its size.
+    
+    Args:
+        contents (bytes): Raw bytes of the uploaded file
+        max_pixels (int): Maximum width * height
+        max_side (int): Maximum width or height
+        
+    Returns:
+        Image.Image: The opened, not yet decoded image
+        
+    Raises:
+        ImageTooLarge: When a limit is exceeded
     """
     try:
-        contents = image_file.file.read()
         img = Image.open(BytesIO(contents))
+    except Image.DecompressionBombError as e:
+        # Pillow's own, higher limit can trigger before ours is checked
+        raise ImageTooLarge(str(e))
+    check_image_size(img.width, img.height, max_pixels, max_side)
+    return img
+
+def inspect_image(contents: bytes, max_pixels: int = MAX_IMAGE_PIXELS,
+                  max_side: int = MAX_IMAGE_SIDE) -> ImageInfo:
+    """
+    Read the size of an image from its header and check it against the limits.
+    
+    Args:
+        contents (bytes): Raw bytes of the uploaded file
+        max_pixels (int): Maximum width * height
+        max_side (int): Maximum width or height
+        
+    Returns:
+        ImageInfo: Width, height, bands and format of the image
         
-        # Convert image to RGB if it's in RGBA mode
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1])
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
+    Raises:
+        ImageTooLarge: When a limit is exceeded
+    """
+    with open_image(contents, max_pixels, max_side) as img:
+        return ImageInfo(img.width, img.height, len(img.getbands()), img.format)
+
+def estimate_peak_bytes(info: ImageInfo, upload_bytes: int, mode: str = PREPROCESS_BUDGET) -> int:
+    """
+    Estimate the peak memory of preprocessing an image.
+    
+    Counts a fixed codec overhead, the upload, the decoded pixels with one converted copy of them
+    (one more for the background of transparent images), the resized copy,
+    and the encoded image with its copy held by the ImageHandle (base64
+    encoding happens later, outside the worker). JPEG
+    drafts decode budget mode images at no more than twice the target size
+    per side, and Pillow keeps multi-band pixels in 32 bits.
+    
+    Args:
+        info (ImageInfo): Header information of the image
+        upload_bytes (int): Size of the upload
+        mode (str): Preprocessing mode, "budget" or "full"
+        
+    Returns:
+        int: Estimated peak bytes
+    """
+    bytes_per_pixel = 4 if info.bands > 1 else 1
+    copies = 3 if info.bands in (2, 4) else 2
+    pixels = info.width * info.height
+    if mode == PREPROCESS_BUDGET:
+        target_width, target_height = budget_image_size(info.width, info.height)
+        output_pixels = target_width * target_height
+        decoded_pixels = min(pixels, 4 * output_pixels) if info.format == 'JPEG' else pixels
+        resized = output_pixels * bytes_per_pixel if output_pixels < pixels else 0
+        encoded = output_pixels * 3 // 2
+    else:
+        decoded_pixels = pixels
+        resized = 0
+        encoded = min(pixels * 3, 2 * upload_bytes)
+    return PREPROCESS_OVERHEAD_BYTES + upload_bytes + decoded_pixels * bytes_per_pixel * copies + resized + encoded * 2
+
+async def read_upload(upload: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Read an uploaded file in chunks, stopping as soon as it exceeds the limit.
+    
+    Args:
+        upload (UploadFile): Uploaded file
+        max_bytes (int): Maximum accepted size
         
-        # Keep original format
-        file_ext = image_file.filename.lower().split('.')[-1]
-        img_format = 'PNG' if file_ext == 'png' else 'JPEG'
+    Returns:
+        bytes: Contents of the file
         
+    Raises:
+        ImageTooLarge: When the file is larger than max_bytes
+    """
+    too_large = ImageTooLarge(f"Upload exceeds the limit of {max_bytes} bytes")
+    if getattr(upload, "size", None) is not None and upload.size > max_bytes:
+        raise too_large
+    chunks = []
+    total = 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise too_large
+        chunks.append(chunk)
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware rejecting oversized multipart and JSON requests with 413.
+    
+    Starlette spools the whole multipart body, and FastAPI reads the whole
+    JSON body, before an endpoint runs, so the limit is enforced here: from
+    Content-Length before anything is read, or while reading for chunked
+    bodies without one.
+    """
+    
+    def __init__(self, app: Any, max_bytes: int = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES,
+                 json_max_bytes: Optional[int] = None):
+        """
+        Args:
+            app: The wrapped ASGI application
+            max_bytes (int): Largest multipart body
+            json_max_bytes (int, optional): Largest JSON body, not limited when None
+        """
+        self.app = app
+        self.max_bytes = max_bytes
+        self.json_max_bytes = json_max_bytes
         
-        # Save image to buffer
-        buffered = BytesIO()
-        if img_format == 'PNG':
-            img.save(buffered, format='PNG', optimize=True)
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        headers = dict(scope.get("headers") or []) if scope["type"] == "http" else {}
+        content_type = headers.get(b"content-type", b"")
+        if content_type.startswith(b"multipart/"):
+            max_bytes = self.max_bytes
+        elif content_type.startswith(b"application/json"):
+            max_bytes = self.json_max_bytes
         else:
-            img.save(buffered, format='JPEG', quality=95, optimize=True)
+            max_bytes = None
+        if max_bytes is None:
+            await self.app(scope, receive, send)
+            return
+        
+        detail = f"Request body exceeds the limit of {max_bytes} bytes"
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive() -> Dict[str, Any]:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def is_graphic(img: Image.Image) -> bool:
+    """
+    Guess whether an image is a flat-colour graphic rather than a photo.
+    
+    Screenshots and rendered diagrams use few distinct colours and compress
+    far better (and without artefacts around text) as PNG, while photos are
+    much smaller as JPEG.
+    
+    Args:
+        img (Image.Image): Decoded RGB image
+        
+    Returns:
+        bool: True when the image looks like a graphic
+    """
+    sample = img.resize((128, 128), Image.NEAREST)
+    return sample.getcolors(maxcolors=GRAPHIC_MAX_COLORS) is not None
+
+def _flatten(img: Image.Image) -> Image.Image:
+    """Convert an image to RGB, compositing transparency onto white."""
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        # Only the alpha band is needed, split() would copy every band
+        background.paste(img, mask=img.getchannel(img.mode[-1]))
+        return background
+    elif img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+def process_image_bytes(contents: bytes, filename: str, mode: str = PREPROCESS_BUDGET,
+                        max_pixels: int = MAX_IMAGE_PIXELS, max_side: int = MAX_IMAGE_SIDE) -> ImageHandle:
+    """
+    Decode raw image bytes and re-encode them for the models.
+    Supports PNG and JPG/JPEG formats.
+    
+    In "full" mode the image is re-encoded at full resolution in the format
+    of the upload. In "budget" mode it is downscaled to the largest size the
+    providers use and re-encoded in a format picked from its content. An
+    image that already fits is passed through without its metadata instead
+    when re-encoding would not make it smaller: a JPEG of at most the budget
+    quality, judged from its header without decoding it, or a PNG no larger
+    than its re-encoding.
+    
+    Args:
+        contents (bytes): Raw bytes of the uploaded file
+        filename (str): Original file name, used to pick the output format
+        mode (str): Preprocessing mode, "budget" or "full"
+        max_pixels (int): Maximum width * height, checked before decoding
+        max_side (int): Maximum width or height, checked before decoding
+        
+    Returns:
+        ImageHandle: Encoded image together with image metadata
+        
+    Raises:
+        ImageTooLarge: When the image exceeds the pixel limits
+    """
+    timer = StageTimer()
+    img = open_image(contents, max_pixels, max_side)
+    
+    if mode == PREPROCESS_BUDGET:
+        return _process_budget(img, contents, timer)
+    
+    img.load()
+    timer.mark("decode")
+    
+    # Convert image to RGB if it's in RGBA mode
+    img = _flatten(img)
+    timer.mark("convert")
+    
+    # Keep original format
+    file_ext = filename.lower().split('.')[-1]
+    img_format = 'PNG' if file_ext == 'png' else 'JPEG'
+    
+    
+    # Save image to buffer
+    buffered = BytesIO()
+    if img_format == 'PNG':
+        img.save(buffered, format='PNG', optimize=True)
+    else:
+        img.save(buffered, format='JPEG', quality=95, optimize=True)
+    timer.mark("encode")
+    
+    return _build_processed(img, buffered.getvalue(), img_format, timer)
+
+def jpeg_quality(img: Image.Image) -> Optional[float]:
+    """
+    Estimate the quality setting a JPEG was encoded with from its header.
+    
+    Compares the luminance quantization table with the standard table that
+    libjpeg-style encoders scale by quality.
+    
+    Args:
+        img (Image.Image): Opened, not necessarily decoded, JPEG image
         
+    Returns:
+        float: Estimated quality from 1 to 100, None without quantization tables
+    """
+    tables = getattr(img, "quantization", None)
+    if not tables or 0 not in tables:
+        return None
+    scale = 100 * sum(tables[0]) / sum(JPEG_STANDARD_LUMINANCE)
+    return (200 - scale) / 2 if scale <= 100 else 5000 / scale
 
-        buffered.seek(0)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+def strip_metadata(contents: bytes, img_format: str) -> bytes:
+    """
+    Drop metadata from an encoded JPEG or PNG without touching its image data.
+    
+    Args:
+        contents (bytes): Encoded image
+        img_format (str): "JPEG" or "PNG"
         
-        # Return the base64 string with correct mime type
-        mime_type = 'png' if img_format == 'PNG' else 'jpeg'
+    Returns:
+        bytes: The image without metadata, the input when it cannot be parsed
+    """
+    out = bytearray()
+    try:
+        if img_format == 'JPEG':
+            out += contents[:2]
+            position = 2
+            while True:
+                if contents[position] != 0xFF:
+                    return contents
+                marker = contents[position + 1]
+                if marker == 0xFF:
+                    # Fill byte before a marker
+                    position += 1
+                    continue
+                if marker == 0xDA:
+                    # Start of scan: entropy coded data and everything after it stay as they are
+                    out += contents[position:]
+                    return bytes(out)
+                end = position + 2 + int.from_bytes(contents[position + 2:position + 4], "big")
+                if end > len(contents):
+                    return contents
+                if marker not in JPEG_METADATA_MARKERS:
+                    out += contents[position:end]
+                position = end
+        if img_format == 'PNG' and contents.startswith(PNG_SIGNATURE):
+            out += PNG_SIGNATURE
+            position = len(PNG_SIGNATURE)
+            while position < len(contents):
+                # Length, type, data and CRC
+                end = position + 12 + int.from_bytes(contents[position:position + 4], "big")
+                if end > len(contents):
+                    return contents
+                if contents[position + 4:position + 8] not in PNG_METADATA_CHUNKS:
+                    out += contents[position:end]
+                position = end
+            return bytes(out)
+    except IndexError:
+        pass
+    return contents
+
+def _passthrough_jpeg(img: Image.Image, contents: bytes, timer: StageTimer) -> ImageHandle:
+    """Send a JPEG as uploaded, without metadata, decoding only a thumbnail for the perceptual hash."""
+    width, height = img.size
+    encoded = strip_metadata(contents, 'JPEG')
+    timer.mark("encode")
+    # The pixels are never fully decoded: identical image data hashes the same
+    # whatever metadata the upload carried
+    content_hash = hashlib.sha256(b"JPEG:" + encoded).hexdigest()
+    img.draft('L', (PHASH_SIZE, PHASH_SIZE))
+    img.load()
+    timer.mark("decode")
+    phash = f"{perceptual_hash(img):016x}"
+    timer.mark("hash")
+    return ImageHandle(
+        data=encoded,
+        pixel_hash=content_hash,
+        phash=phash,
+        width=width,
+        height=height,
+        format='JPEG',
+        timings=timer.timings
+    )
+
+def _process_budget(img: Image.Image, contents: bytes, timer: StageTimer) -> ImageHandle:
+    """Token-budget preprocessing, see process_image_bytes."""
+    source_format = img.format
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    target = budget_image_size(*img.size)
+    
+    # Already small enough and in a format both providers accept as is
+    fits = (source_format in ('JPEG', 'PNG') and img.mode in ('RGB', 'L')
+            and orientation == 1 and target == img.size
+            and len(contents) <= MAX_PASSTHROUGH_BYTES)
+    # Re-encoding a JPEG of at most the budget quality would not make it smaller,
+    # which the header tells without decoding it
+    if fits and source_format == 'JPEG':
+        quality = jpeg_quality(img)
+        if quality is not None and quality <= BUDGET_JPEG_QUALITY:
+            return _passthrough_jpeg(img, contents, timer)
+    
+    # Let the JPEG decoder downscale by a power of two while decoding
+    if source_format == 'JPEG' and target != img.size:
+        img.draft('RGB', target)
+    img.load()
+    timer.mark("decode")
+    
+    # exif_transpose copies the image even when there is nothing to rotate
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    img = _flatten(img)
+    timer.mark("convert")
+    target = budget_image_size(*img.size)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    timer.mark("resize")
+    
+    buffered = BytesIO()
+    if is_graphic(img):
+        img_format = 'PNG'
+        img.save(buffered, format='PNG')
+    else:
+        img_format = 'JPEG'
+        img.save(buffered, format='JPEG', quality=BUDGET_JPEG_QUALITY)
+    encoded = buffered.getvalue()
+    # A PNG upload is lossless already, keep it when it is no larger than the re-encoding
+    if fits and source_format == 'PNG':
+        stripped = strip_metadata(contents, 'PNG')
+        if len(stripped) <= len(encoded):
+            img_format, encoded = 'PNG', stripped
+    timer.mark("encode")
+    
+    return _build_processed(img, encoded, img_format, timer)
 
-        return f"data:image/{mime_type};base64,{img_str}"
+def base64_text(encoded: Any, prefix: str = "") -> str:
+    """
+    Base64 encode image bytes, e.g. into a data URL.
+    
+    The base64 text is written slice by slice into one preallocated buffer,
+    so the only full-size copies are that buffer and the final string.
+    
+    Args:
+        encoded: Encoded image as bytes or a buffer such as a memoryview
+        prefix (str): ASCII text put in front of the base64 text
         
+    Returns:
+        str: Prefix followed by the base64 text
+    """
+    head = prefix.encode("ascii")
+    view = memoryview(encoded)
+    out = bytearray(len(head) + (len(view) + 2) // 3 * 4)
+    out[:len(head)] = head
+    position = len(head)
+    for start in range(0, len(view), BASE64_CHUNK_BYTES):
+        chunk = base64.b64encode(view[start:start + BASE64_CHUNK_BYTES])
+        out[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    view.release()
+    return out.decode("ascii")
+
+def _build_processed(img: Image.Image, encoded: bytes, img_format: str,
+                     timer: StageTimer) -> ImageHandle:
+    """Wrap encoded image bytes in an ImageHandle together with image metadata."""
+    content_hash = pixel_hash(img)
+    phash = f"{perceptual_hash(img):016x}"
+    timer.mark("hash")
+
+    return ImageHandle(
+        data=encoded,
+        pixel_hash=content_hash,
+        phash=phash,
+        width=img.width,
+        height=img.height,
+        format=img_format,
+        timings=timer.timings
+    )
+
+def process_image(image_file: UploadFile, mode: str = PREPROCESS_BUDGET) -> ImageHandle:
+    """
+    Process uploaded image file and convert to base64.
+    Supports PNG and JPG/JPEG formats.
+    
+    Args:
+        image_file (UploadFile): Uploaded image file
+        mode (str): Preprocessing mode, "budget" or "full"
+        
+    Returns:
+        ImageHandle: Encoded image with its metadata
+    """
+    try:
+        if getattr(image_file, "size", None) is not None and image_file.size > MAX_UPLOAD_BYTES:
+            raise ImageTooLarge(f"Upload exceeds the limit of {MAX_UPLOAD_BYTES} bytes")
+        contents = image_file.file.read(MAX_UPLOAD_BYTES + 1)
+        if len(contents) > MAX_UPLOAD_BYTES:
+            raise ImageTooLarge(f"Upload exceeds the limit of {MAX_UPLOAD_BYTES} bytes")
+        return process_image_bytes(contents, image_file.filename, mode)
+        
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -70,6 +733,23 @@ def validate_image_format(filename: str) -> bool:
     file_ext = filename.lower().split('.')[-1]
     return file_ext in allowed_extensions
 
+def find_images(directory: str) -> list:
+    """
+    Find the supported image files below a directory.
+    
+    Args:
+        directory (str): Directory to search recursively
+        
+    Returns:
+        list: Image paths sorted by path
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if validate_image_format(name):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
 def verify_image(file_path):
     try:
         with Image.open(file_path) as img:
@@ -0,0 +1,219 @@
+"""
+Run queued /jobs questions through the QA graph.
+
+Workers claim jobs from the durable queue shared with the API (see jobs.py),
+renew their lease while a job runs and store its result. They can run inside
+the API processes (JOB_WORKER_CONCURRENCY) or as separate processes started
+with this script, on any machine that shares the queue's disk, so workers
+scale independently of the API.
+
+Jobs wait for upstream capacity instead of being shed: a job that the
+scheduler cannot admit, or whose provider's circuit is open, is put back
+without counting as an attempt. An upstream call that times out is a
+failed attempt like any other error.
+
+Usage:
+    python job_worker.py --processes 2 --concurrency 8
+"""
+from typing import Optional, Dict, Any
+from jobs import JobQueue
+from scheduler import SchedulerOverloaded, request_deadline
+from resilience import DeadlineExceeded
+from metrics import record_outcome
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class JobWorker:
+    """Claims jobs from a JobQueue and runs a bounded number of them at once."""
+
+    def __init__(self, queue: JobQueue, chain: Any, concurrency: int = 4,
+                 lease_seconds: float = 60, poll_seconds: float = 0.5,
+                 purge_seconds: float = 600, worker_id: Optional[str] = None):
+        """
+        Initialize the JobWorker.
+
+        Args:
+            queue (JobQueue): Queue to claim jobs from
+            chain: Compiled QA graph
+            concurrency (int): Jobs run at once
+            lease_seconds (float): Lease of a claimed job, renewed at a third of it
+            poll_seconds (float): Pause between claims while the queue is empty
+            purge_seconds (float): Interval of dropping expired jobs and images
+            worker_id (str, optional): Lease owner, unique per process when None
+        """
+        self.queue = queue
+        self.chain = chain
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.purge_seconds = purge_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stopping = asyncio.Event()
+        self._stats = {"running": 0, "succeeded": 0, "retried": 0, "released": 0, "failed": 0, "lost": 0}
+
+    async def run(self) -> None:
+        """Run jobs until stop is called; running jobs finish first."""
+        # Jobs queue for upstream capacity instead of inheriting a request deadline
+        request_deadline.set(None)
+        slots = [asyncio.create_task(self._slot()) for _ in range(self.concurrency)]
+        purger = asyncio.create_task(self._purge())
+        try:
+            await asyncio.gather(*slots)
+        finally:
+            purger.cancel()
+            for slot in slots:
+                slot.cancel()
+
+    def stop(self) -> None:
+        """Stop claiming jobs."""
+        self._stopping.set()
+
+    async def _pause(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _slot(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = await asyncio.to_thread(self.queue.claim, self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logger.error("Claiming a job failed: %s", e)
+                job = None
+            if job is None:
+                await self._pause(self.poll_seconds)
+                continue
+            await self._run_job(job)
+
+    async def _purge(self) -> None:
+        while True:
+            await asyncio.sleep(self.purge_seconds)
+            try:
+                await asyncio.to_thread(self.queue.purge)
+            except Exception as e:
+                logger.error("Purging the job queue failed: %s", e)
+
+    async def _renew(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not await asyncio.to_thread(self.queue.renew, job_id, self.worker_id, self.lease_seconds):
+                logger.warning("Lost the lease of job %s", job_id)
+                return
+
+    def _finish(self, outcome: str, stored: bool) -> None:
+        outcome = outcome if stored else "lost"
+        self._stats[outcome] += 1
+        record_outcome("job", outcome)
+
+    async def _fail(self, job: Dict[str, Any], error: Exception) -> None:
+        logger.error("Job %s attempt %d failed: %s", job["job_id"], job["attempts"], error)
+        stored = await asyncio.to_thread(
+            self.queue.fail, job["job_id"], self.worker_id, str(error), job["attempts"]
+        )
+        self._finish("failed" if job["attempts"] >= self.queue.max_attempts else "retried", stored)
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        # Imported here so the queue can be used without loading the agents
+        from graph import ERROR_ANSWER
+
+        job_id = job["job_id"]
+        renewal = asyncio.create_task(self._renew(job_id))
+        self._stats["running"] += 1
+        started = time.perf_counter()
+        try:
+            image = None
+            if job["image_ref"] is not None:
+                image = await asyncio.to_thread(self.queue.load_image, job["image_ref"], job["image_meta"])
+            result = await self.chain.ainvoke({
+                "question": job["question"],
+                "image": image,
+                "answer": None,
+                "diagram": None,
+                "subject": None,
+                "want_diagram": job["want_diagram"]
+            })
+            if result["answer"] == ERROR_ANSWER:
+                raise RuntimeError(ERROR_ANSWER)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job to another worker right away. The thread finishes
+            # the release even if this task is cancelled again while waiting for it
+            await asyncio.to_thread(self.queue.release, job_id, self.worker_id)
+            self._stats["released"] += 1
+            raise
+        except DeadlineExceeded as e:
+            # The provider was tried and did not answer: unlike shedding, this uses up an attempt
+            await self._fail(job, e)
+        except SchedulerOverloaded as overloaded:
+            stored = await asyncio.to_thread(
+                self.queue.release, job_id, self.worker_id, overloaded.retry_after
+            )
+            self._finish("released", stored)
+        except Exception as e:
+            await self._fail(job, e)
+        else:
+            stored = await asyncio.to_thread(self.queue.complete, job_id, self.worker_id, {
+                "answer": result["answer"],
+                "diagram": result["diagram"],
+                "subject": result["subject"]
+            })
+            self._finish("succeeded", stored)
+            logger.info("Job %s finished in %.1fs", job_id, time.perf_counter() - started)
+        finally:
+            renewal.cancel()
+            self._stats["running"] -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the jobs running in this worker and its outcome counters.
+
+        Returns:
+            dict: Worker statistics
+        """
+        return {"worker_id": self.worker_id, "concurrency": self.concurrency, **self._stats}
+
+async def serve(concurrency: int, lease_seconds: float) -> None:
+    """Run one worker process until SIGTERM or SIGINT."""
+    # Imported here so the graph and agents come from the server configuration
+    from main import build_graph, open_job_queue
+    _, chain = await asyncio.to_thread(build_graph)
+    worker = JobWorker(open_job_queue(), chain, concurrency=concurrency, lease_seconds=lease_seconds)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, worker.stop)
+    logger.info("Worker %s running %d jobs at once", worker.worker_id, concurrency)
+    await worker.run()
+
+def run_process(concurrency: int, lease_seconds: float) -> None:
+    asyncio.run(serve(concurrency, lease_seconds))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="Jobs each process runs at once")
+    parser.add_argument("--lease-seconds", type=float, default=60.0, help="Lease of a claimed job")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_process, args=(args.concurrency, args.lease_seconds), name=f"job-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    # Ctrl-C reaches the workers directly; forward SIGTERM so running jobs can finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    for process in processes:
+        try:
+            process.join()
+        except KeyboardInterrupt:
+            process.join()
@@ -0,0 +1,405 @@
+from typing import Optional, Dict, Any
+from image_utils import ImageHandle
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# States of a queued job
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_FINISHED = (JOB_SUCCEEDED, JOB_FAILED)
+
+_COLUMNS = ("id, fingerprint, status, question, image_ref, image_meta, want_diagram, attempts,"
+            " lease_owner, result, error, created, updated")
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while too many jobs are waiting."""
+
+    def __init__(self, pending: int, retry_after: float):
+        super().__init__(f"Job queue is full ({pending} jobs waiting)")
+        self.pending = pending
+        self.retry_after = retry_after
+
+class IdempotencyConflict(ValueError):
+    """Raised when an idempotency key is reused for a different job."""
+
+class JobQueue:
+    """
+    Durable job queue in a local SQLite database.
+
+    Jobs survive restarts of the API and of the workers. A worker claims a
+    job with a lease that it renews while the job runs; a job whose lease
+    expires, e.g. because its worker died, is handed to another worker until
+    it has been attempted max_attempts times. Failed attempts are retried
+    with exponential backoff.
+
+    Preprocessed images are stored once per content hash in a directory next
+    to the database, so a job row only refers to its image. Any number of
+    processes may open the same queue; claims are serialized by SQLite.
+    """
+
+    def __init__(self, path: str = ".cache/jobs.sqlite3", images_dir: Optional[str] = None,
+                 max_attempts: int = 3, retry_backoff_seconds: float = 5,
+                 max_pending: int = 10000, ttl_seconds: float = 24 * 3600):
+        """
+        Initialize the JobQueue.
+
+        Args:
+            path (str): SQLite database file
+            images_dir (str, optional): Directory of stored images, "<path>.images" when None
+            max_attempts (int): Attempts of a job before it fails for good
+            retry_backoff_seconds (float): Delay before the first retry, doubled on every further one
+            max_pending (int): Queued jobs beyond which submissions are refused
+            ttl_seconds (float): Time a finished job and its result stay available
+        """
+        self.path = path
+        self.images_dir = images_dir or f"{path}.images"
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        os.makedirs(self.images_dir, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, fingerprint TEXT NOT NULL,"
+            " status TEXT NOT NULL, question TEXT NOT NULL, image_ref TEXT, image_meta TEXT,"
+            " want_diagram INTEGER, attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL,"
+            " lease_owner TEXT, lease_expires REAL, result TEXT, error TEXT,"
+            " created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at)")
+
+    def _image_path(self, image_ref: str) -> str:
+        return os.path.join(self.images_dir, f"{image_ref}.img")
+
+    def store_image(self, image: ImageHandle) -> str:
+        """
+        Store the bytes of a preprocessed image once per content.
+
+        Args:
+            image (ImageHandle): Preprocessed image
+
+        Returns:
+            str: Reference of the stored image
+        """
+        image_ref = hashlib.sha256(image.data).hexdigest()
+        path = self._image_path(image_ref)
+        if os.path.exists(path):
+            # Touched so purge does not remove it before the new job refers to it
+            os.utime(path)
+            return image_ref
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(image.data)
+        os.replace(temporary, path)
+        return image_ref
+
+    def load_image(self, image_ref: str, image_meta: Dict[str, Any]) -> ImageHandle:
+        """
+        Read a stored image.
+
+        Args:
+            image_ref (str): Reference returned by store_image
+            image_meta (dict): Metadata of the image stored with its job
+
+        Returns:
+            ImageHandle: The preprocessed image
+        """
+        with open(self._image_path(image_ref), "rb") as f:
+            return ImageHandle.restore(f.read(), image_meta)
+
+    @staticmethod
+    def _fingerprint(question: str, image_ref: Optional[str], want_diagram: Optional[bool]) -> str:
+        material = json.dumps([question, image_ref or "", want_diagram])
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def submit(self, question: str, image: Optional[ImageHandle] = None,
+               want_diagram: Optional[bool] = None, idempotency_key: Optional[str] = None) -> tuple:
+        """
+        Queue a question.
+
+        Args:
+            question (str): The question to be answered
+            image (ImageHandle, optional): Preprocessed image
+            want_diagram (bool, optional): Diagram override passed to the graph
+            idempotency_key (str, optional): Client key; resubmitting it returns the existing job
+
+        Returns:
+            tuple: The job and whether it was created by this call
+
+        Raises:
+            IdempotencyConflict: When the key belongs to a job with different inputs
+            JobQueueFull: When max_pending jobs are already waiting
+        """
+        image_ref = self.store_image(image) if image is not None else None
+        fingerprint = self._fingerprint(question, image_ref, want_diagram)
+        now = time.time()
+        with self._lock:
+            if idempotency_key is not None:
+                existing = self._existing(idempotency_key, fingerprint)
+                if existing is not None:
+                    return existing, False
+
+            pending = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (JOB_QUEUED,)
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise JobQueueFull(pending, self.retry_backoff_seconds)
+
+            job_id = uuid.uuid4().hex
+            try:
+                self._db.execute(
+                    "INSERT INTO jobs (id, idempotency_key, fingerprint, status, question, image_ref,"
+                    " image_meta, want_diagram, available_at, created, updated)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, idempotency_key, fingerprint, JOB_QUEUED, question, image_ref,
+                     json.dumps(image.meta()) if image is not None else None,
+                     None if want_diagram is None else int(want_diagram), now, now, now)
+                )
+            except sqlite3.IntegrityError:
+                # Another process inserted the same idempotency key first
+                return self._existing(idempotency_key, fingerprint), False
+            job = self._get(job_id)
+        del job["fingerprint"]
+        return job, True
+
+    def _existing(self, idempotency_key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """The job submitted with an idempotency key, if it has the same inputs."""
+        row = self._db.execute(
+            f"SELECT {_COLUMNS} FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = self._row_to_job(row)
+        if job.pop("fingerprint") != fingerprint:
+            raise IdempotencyConflict(f"Idempotency key {idempotency_key!r} was used for a different job")
+        return job
+
+    @staticmethod
+    def _row_to_job(row: tuple) -> Dict[str, Any]:
+        (job_id, fingerprint, status, question, image_ref, image_meta, want_diagram, attempts,
+         lease_owner, result, error, created, updated) = row
+        return {
+            "job_id": job_id,
+            "fingerprint": fingerprint,
+            "status": status,
+            "question": question,
+            "image_ref": image_ref,
+            "image_meta": json.loads(image_meta) if image_meta is not None else None,
+            "want_diagram": None if want_diagram is None else bool(want_diagram),
+            "attempts": attempts,
+            "lease_owner": lease_owner,
+            "result": json.loads(result) if result is not None else None,
+            "error": error,
+            "created": created,
+            "updated": updated
+        }
+
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row is not None else None
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job.
+
+        Args:
+            job_id (str): Id returned by submit
+
+        Returns:
+            dict: The job, None for unknown or purged ids
+        """
+        with self._lock:
+            job = self._get(job_id)
+        if job is not None:
+            del job["fingerprint"]
+        return job
+
+    def _expire_leases(self, now: float) -> None:
+        """Requeue the running jobs whose worker stopped renewing its lease, or fail them when out of attempts."""
+        self._db.execute(
+            "UPDATE jobs SET status = ?, error = 'Worker lease expired', lease_owner = NULL, updated = ?"
+            " WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+            (JOB_FAILED, now, JOB_RUNNING, now, self.max_attempts)
+        )
+        self._db.execute(
+            "UPDATE jobs SET status = ?, lease_owner = NULL, available_at = ?, updated = ?"
+            " WHERE status = ? AND lease_expires < ?",
+            (JOB_QUEUED, now, now, JOB_RUNNING, now)
+        )
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """
+        Take the oldest job that is ready to run.
+
+        Args:
+            worker_id (str): Owner of the lease
+            lease_seconds (float): Time the job is reserved for the worker unless renewed
+
+        Returns:
+            dict: The claimed job, None when nothing is ready
+        """
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so two processes never claim the same job
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire_leases(now)
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE status = ? AND available_at <= ?"
+                    " ORDER BY available_at LIMIT 1",
+                    (JOB_QUEUED, now)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?,"
+                        " lease_expires = ?, updated = ? WHERE id = ?",
+                        (JOB_RUNNING, worker_id, now + lease_seconds, now, row[0])
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            job = self._get(row[0])
+        del job["fingerprint"]
+        return job
+
+    def _update_owned(self, job_id: str, worker_id: str, assignments: str, values: tuple) -> bool:
+        """Update a running job if the worker still holds its lease."""
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE jobs SET {assignments}, updated = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (*values, time.time(), job_id, JOB_RUNNING, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, job_id: str, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Extend the lease of a running job.
+
+        Returns:
+            bool: False when the lease was lost to another worker
+        """
+        return self._update_owned(job_id, worker_id, "lease_expires = ?", (time.time() + lease_seconds,))
+
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        """
+        Store the result of a job.
+
+        Returns:
+            bool: False when the lease was lost and the result discarded
+        """
+        return self._update_owned(
+            job_id, worker_id, "status = ?, result = ?, error = NULL, lease_owner = NULL",
+            (JOB_SUCCEEDED, json.dumps(result))
+        )
+
+    def fail(self, job_id: str, worker_id: str, error: str, attempts: int) -> bool:
+        """
+        Record a failed attempt, retrying with backoff while attempts are left.
+
+        Args:
+            job_id (str): Id of the running job
+            worker_id (str): Owner of the lease
+            error (str): Failure message kept with the job
+            attempts (int): Attempts made so far, including this one
+
+        Returns:
+            bool: False when the lease was lost
+        """
+        if attempts >= self.max_attempts:
+            return self._update_owned(
+                job_id, worker_id, "status = ?, error = ?, lease_owner = NULL", (JOB_FAILED, error)
+            )
+        delay = self.retry_backoff_seconds * 2 ** (attempts - 1)
+        return self._update_owned(
+            job_id, worker_id, "status = ?, error = ?, lease_owner = NULL, available_at = ?",
+            (JOB_QUEUED, error, time.time() + delay)
+        )
+
+    def release(self, job_id: str, worker_id: str, delay: float = 0) -> bool:
+        """
+        Put a running job back without counting the attempt, e.g. on shutdown or upstream overload.
+
+        Returns:
+            bool: False when the lease was lost
+        """
+        return self._update_owned(
+            job_id, worker_id, "status = ?, attempts = attempts - 1, lease_owner = NULL, available_at = ?",
+            (JOB_QUEUED, time.time() + delay)
+        )
+
+    def purge(self, image_grace_seconds: float = 300) -> int:
+        """
+        Drop expired finished jobs and the stored images no job refers to anymore.
+
+        Args:
+            image_grace_seconds (float): Minimum age of an unreferenced image before it is removed
+
+        Returns:
+            int: Number of jobs dropped
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                (*JOB_FINISHED, now - self.ttl_seconds)
+            )
+            referenced = {
+                row[0] for row in self._db.execute("SELECT DISTINCT image_ref FROM jobs WHERE image_ref IS NOT NULL")
+            }
+        for entry in os.scandir(self.images_dir):
+            image_ref = entry.name.split(".", 1)[0]
+            if image_ref in referenced:
+                continue
+            try:
+                if entry.stat().st_mtime < now - image_grace_seconds:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get job counts per status and the age of the oldest waiting job.
+
+        Returns:
+            dict: Queue statistics
+        """
+        now = time.time()
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._db.execute(
+                "SELECT MIN(available_at) FROM jobs WHERE status = ? AND available_at <= ?", (JOB_QUEUED, now)
+            ).fetchone()[0]
+            images = self._db.execute(
+                "SELECT COUNT(DISTINCT image_ref) FROM jobs WHERE image_ref IS NOT NULL"
+            ).fetchone()[0]
+        return {
+            "jobs": {status: counts.get(status, 0) for status in (JOB_QUEUED, JOB_RUNNING, *JOB_FINISHED)},
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest is not None else 0.0,
+            "images": images,
+            "max_pending": self.max_pending,
+            "max_attempts": self.max_attempts
+        }
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
@@ -1,15 +1,48 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Header
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from dotenv import load_dotenv
-from graph import MultimodalQAGraph
-from typing import Optional
-from image_utils import process_image, validate_image_format
+from typing import Optional, Tuple, Dict, Any
+from image_utils import validate_image_format, read_upload, ImageHandle, ImageTooLarge, UploadSizeLimitMiddleware, FORM_OVERHEAD_BYTES
+from image_pool import ImagePool, ImagePoolFull
+from batch import run_batch
+from scheduler import shared_scheduler, request_deadline, SchedulerOverloaded
+from resilience import shared_resilience
+from clients import configure_pools, pool_stats
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, Field
+from typing import List
+import base64
+import asyncio
+import importlib
+import json
+import threading
+import time
+from cache import ResponseCache
+from similarity import SimilarityIndex
+from diagram_store import DiagramStore, DIAGRAM_READY, DIAGRAM_PENDING
+from diagram_assets import DiagramAssets, is_diagram_hash, preferred_encoding, diagram_etag, ENCODING_IDENTITY
+from image_store import ImageStore
+from singleflight import SingleFlight
+from jobs import JobQueue, JobQueueFull, IdempotencyConflict, JOB_SUCCEEDED, JOB_FAILED, JOB_FINISHED
+from job_worker import JobWorker
+from metrics import MetricsMiddleware, configure_tracing, span, record_stage, record_image_bytes, record_outcome, render, CONTENT_TYPE
+import logging
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Logging of the service, one JSON line per request comes from the metrics logger
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Export spans with OpenTelemetry (requires the opentelemetry packages)
+OTEL_TRACING_ENABLED = os.getenv("OTEL_TRACING_ENABLED", "false").lower() == "true"
+
 # Get API keys and AWS credentials
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
@@ -17,7 +50,124 @@ AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_SESSION_TOKEN = os.getenv("AWS_SESSION_TOKEN")
 AWS_REGION = os.getenv("AWS_REGION", "us-west-1")
 
-print (AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION)
+# Image preprocessing mode: "budget" fits provider limits, "full" keeps full resolution
+IMAGE_PREPROCESS_MODE = os.getenv("IMAGE_PREPROCESS_MODE", "budget")
+
+# Image preprocessing pool: "process" or "thread" workers with a bounded queue
+IMAGE_POOL_KIND = os.getenv("IMAGE_POOL_KIND", "process")
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", str(os.cpu_count() or 2)))
+IMAGE_POOL_QUEUE_LIMIT = int(os.getenv("IMAGE_POOL_QUEUE_LIMIT", "32"))
+IMAGE_POOL_TIMEOUT_SECONDS = float(os.getenv("IMAGE_POOL_TIMEOUT_SECONDS", "30"))
+
+# Upload limits: bytes per upload, pixels checked before decoding, and the estimated
+# peak memory all in-flight images may use together (0 disables the memory limit)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "40000000"))
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "12000"))
+IMAGE_POOL_MEMORY_LIMIT_BYTES = int(os.getenv("IMAGE_POOL_MEMORY_LIMIT_BYTES", str(1024 * 1024 * 1024)))
+
+# Per-provider admission control (0 disables a limit) and the default request budget
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+BEDROCK_MAX_CONCURRENCY = int(os.getenv("BEDROCK_MAX_CONCURRENCY", "16"))
+BEDROCK_TOKENS_PER_MINUTE = int(os.getenv("BEDROCK_TOKENS_PER_MINUTE", "0"))
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "60"))
+
+# Upstream connection pools
+OPENAI_POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "100"))
+OPENAI_POOL_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_POOL_KEEPALIVE_SECONDS", "60"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+OPENAI_READ_TIMEOUT_SECONDS = float(os.getenv("OPENAI_READ_TIMEOUT_SECONDS", "60"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "false").lower() == "true"
+BEDROCK_POOL_MAX_CONNECTIONS = int(os.getenv("BEDROCK_POOL_MAX_CONNECTIONS", "50"))
+BEDROCK_CONNECT_TIMEOUT_SECONDS = float(os.getenv("BEDROCK_CONNECT_TIMEOUT_SECONDS", "5"))
+BEDROCK_READ_TIMEOUT_SECONDS = float(os.getenv("BEDROCK_READ_TIMEOUT_SECONDS", "120"))
+
+# Resilience of the upstream calls: a timeout per call attempt (cut short by the request
+# deadline), jittered retries of transient errors, per-provider circuit breakers and
+# optional hedged duplicates of calls slower than the provider's recent p95
+OPENAI_CALL_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CALL_TIMEOUT_SECONDS", "45"))
+BEDROCK_CALL_TIMEOUT_SECONDS = float(os.getenv("BEDROCK_CALL_TIMEOUT_SECONDS", "50"))
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BACKOFF_SECONDS = float(os.getenv("UPSTREAM_RETRY_BACKOFF_SECONDS", "0.25"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "false").lower() == "true"
+BEDROCK_HEDGE = os.getenv("BEDROCK_HEDGE", "false").lower() == "true"
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+
+# Upper bounds on the fan-out, the number of items and the body size of a single
+# /ask/batch request; the body limit applies to every JSON request and defaults to
+# BATCH_MAX_ITEMS images of MAX_UPLOAD_BYTES in base64
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "256"))
+MAX_JSON_BODY_BYTES = int(os.getenv(
+    "MAX_JSON_BODY_BYTES", str(BATCH_MAX_ITEMS * MAX_UPLOAD_BYTES * 4 // 3 + FORM_OVERHEAD_BYTES)
+))
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3")
+RESPONSE_CACHE_MEMORY_ITEMS = int(os.getenv("RESPONSE_CACHE_MEMORY_ITEMS", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Near-duplicate problem index settings
+SIMILARITY_INDEX_ENABLED = os.getenv("SIMILARITY_INDEX_ENABLED", "false").lower() == "true"
+SIMILARITY_INDEX_PATH = os.getenv("SIMILARITY_INDEX_PATH", ".cache/similarity.jsonl")
+SIMILARITY_MAX_HAMMING = int(os.getenv("SIMILARITY_MAX_HAMMING", "10"))
+SIMILARITY_MAX_ENTRIES = int(os.getenv("SIMILARITY_MAX_ENTRIES", "10000"))
+
+# QA model cascade from cheapest to strongest, e.g. "gpt-4o-mini,gpt-4o"; a single
+# model (the default) disables the cascade
+QA_MODELS = [model.strip() for model in os.getenv("QA_MODELS", "gpt-4o").split(",") if model.strip()]
+QA_CASCADE_MIN_CONFIDENCE = float(os.getenv("QA_CASCADE_MIN_CONFIDENCE", "0.7"))
+
+# Coalesce concurrent identical answer and diagram calls into one upstream call
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+
+# Deferred diagram delivery: answer first, fetch the diagram later from /diagram/{id};
+# with DIAGRAM_STORE_DIR set, any worker sharing the directory can serve the poll
+DEFER_DIAGRAM = os.getenv("DEFER_DIAGRAM", "false").lower() == "true"
+DIAGRAM_STORE_DIR = os.getenv("DIAGRAM_STORE_DIR", ".cache/deferred_diagrams")
+DIAGRAM_STORE_MAX_ITEMS = int(os.getenv("DIAGRAM_STORE_MAX_ITEMS", "1024"))
+DIAGRAM_STORE_TTL_SECONDS = float(os.getenv("DIAGRAM_STORE_TTL_SECONDS", "600"))
+DIAGRAM_MAX_WAIT_SECONDS = float(os.getenv("DIAGRAM_MAX_WAIT_SECONDS", "30"))
+
+# Content-addressed diagrams: responses carry a diagram_hash and a /diagram/{hash} URL
+# instead of the SVG unless DIAGRAM_INLINE (or inline_diagram in the request) is set;
+# the diagrams are stored pre-compressed in a directory shared by all workers
+DIAGRAM_INLINE = os.getenv("DIAGRAM_INLINE", "false").lower() == "true"
+DIAGRAM_ASSETS_DIR = os.getenv("DIAGRAM_ASSETS_DIR", ".cache/diagrams")
+DIAGRAM_ASSETS_MEMORY_BYTES = int(os.getenv("DIAGRAM_ASSETS_MEMORY_BYTES", str(32 * 1024 * 1024)))
+DIAGRAM_ASSETS_TTL_SECONDS = float(os.getenv("DIAGRAM_ASSETS_TTL_SECONDS", str(30 * 24 * 3600)))
+DIAGRAM_MAX_AGE_SECONDS = int(os.getenv("DIAGRAM_MAX_AGE_SECONDS", str(365 * 24 * 3600)))
+
+# Images uploaded once to /images and referenced by image_id in follow-up questions;
+# kept preprocessed in memory and, when IMAGE_STORE_DIR is set, in a directory shared
+# by all workers; they expire IMAGE_STORE_TTL_SECONDS after they were last used
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", ".cache/images")
+IMAGE_STORE_MAX_ITEMS = int(os.getenv("IMAGE_STORE_MAX_ITEMS", "1024"))
+IMAGE_STORE_MEMORY_BYTES = int(os.getenv("IMAGE_STORE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+IMAGE_STORE_TTL_SECONDS = float(os.getenv("IMAGE_STORE_TTL_SECONDS", "3600"))
+
+# Durable job queue behind /jobs: where it lives, retries, backpressure and how long
+# results are kept; JOB_WORKER_CONCURRENCY jobs run inside every API worker (0 when
+# only separate job_worker.py processes should run them)
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".cache/jobs.sqlite3")
+JOB_IMAGES_DIR = os.getenv("JOB_IMAGES_DIR", "")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "5"))
+JOB_QUEUE_MAX_PENDING = int(os.getenv("JOB_QUEUE_MAX_PENDING", "10000"))
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", str(24 * 3600)))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+
+# When each worker builds its agents and clients: "background" starts right after
+# startup without delaying it, "eager" finishes before traffic is accepted, "lazy"
+# waits for the first request that needs them
+AGENT_INIT = os.getenv("AGENT_INIT", "background")
 
 if not all([OPENAI_API_KEY, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_SESSION_TOKEN]):
     raise ValueError("Required API keys or AWS credentials not found in environment variables")
@@ -28,6 +178,14 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Reject oversized bodies with 413; added before CORS, so it runs inside it and
+# browsers can read the 413
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES,
+    json_max_bytes=MAX_JSON_BODY_BYTES
+)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -36,20 +194,371 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize graph with OpenAI and AWS credentials
-graph = MultimodalQAGraph(
-    openai_api_key=OPENAI_API_KEY,
-    aws_access_key=AWS_ACCESS_KEY,
-    aws_secret_key=AWS_SECRET_KEY,
-    aws_session_token=AWS_SESSION_TOKEN,
-    aws_region=AWS_REGION
+# Time every request and log its stages, tokens and outcomes
+app.add_middleware(MetricsMiddleware)
+if OTEL_TRACING_ENABLED:
+    configure_tracing()
+
+# Size the upstream connection pools before any client is created
+configure_pools(
+    openai_max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+    openai_max_keepalive=OPENAI_POOL_MAX_CONNECTIONS,
+    openai_keepalive_expiry=OPENAI_POOL_KEEPALIVE_SECONDS,
+    openai_connect_timeout=OPENAI_CONNECT_TIMEOUT_SECONDS,
+    openai_read_timeout=OPENAI_READ_TIMEOUT_SECONDS,
+    openai_http2=OPENAI_HTTP2,
+    bedrock_max_connections=BEDROCK_POOL_MAX_CONNECTIONS,
+    bedrock_connect_timeout=BEDROCK_CONNECT_TIMEOUT_SECONDS,
+    # Bedrock calls run in threads that outlive a timed out call until a read times out
+    bedrock_read_timeout=min(BEDROCK_READ_TIMEOUT_SECONDS, BEDROCK_CALL_TIMEOUT_SECONDS)
 )
-chain = graph.build()
+
+# Initialize the image preprocessing pool shared by all requests
+image_pool = ImagePool(
+    workers=IMAGE_POOL_WORKERS,
+    queue_limit=IMAGE_POOL_QUEUE_LIMIT,
+    kind=IMAGE_POOL_KIND,
+    timeout=IMAGE_POOL_TIMEOUT_SECONDS,
+    memory_limit=IMAGE_POOL_MEMORY_LIMIT_BYTES or None,
+    max_pixels=MAX_IMAGE_PIXELS,
+    max_side=MAX_IMAGE_SIDE
+)
+
+# Initialize the store of diagrams generated after their answer was returned
+diagram_store = DiagramStore(
+    max_items=DIAGRAM_STORE_MAX_ITEMS,
+    ttl_seconds=DIAGRAM_STORE_TTL_SECONDS,
+    directory=DIAGRAM_STORE_DIR or None
+)
+
+# Initialize the store diagrams are served from by content hash
+diagram_assets = DiagramAssets(
+    DIAGRAM_ASSETS_DIR or None,
+    memory_bytes=DIAGRAM_ASSETS_MEMORY_BYTES,
+    ttl_seconds=DIAGRAM_ASSETS_TTL_SECONDS
+)
+
+# Initialize the store of uploaded images follow-up questions refer to
+image_store = ImageStore(
+    IMAGE_STORE_DIR or None,
+    max_items=IMAGE_STORE_MAX_ITEMS,
+    memory_bytes=IMAGE_STORE_MEMORY_BYTES,
+    ttl_seconds=IMAGE_STORE_TTL_SECONDS
+)
+
+# Built per worker by build_graph: they open files and connections that must not
+# be shared with forked workers, and importing the agents takes seconds
+response_cache: Optional[ResponseCache] = None
+similarity_index: Optional[SimilarityIndex] = None
+graph = None
+chain = None
+_graph_build: Optional[asyncio.Future] = None
+
+# Opened per worker at startup, like the graph
+job_queue: Optional[JobQueue] = None
+job_worker: Optional[JobWorker] = None
+_job_worker_task: Optional[asyncio.Task] = None
+
+def build_graph() -> Tuple[Any, Any]:
+    """
+    Build the response cache, the similarity index and the graph with its agents.
+    
+    The LangChain, LangGraph and boto3 imports happen here rather than when
+    the module is imported, so workers start fast and a preforking server can
+    import the app before any client exists.
+    
+    Returns:
+        tuple: The MultimodalQAGraph and its compiled chain
+    """
+    global response_cache, similarity_index, graph, chain
+    if graph is not None:
+        return graph, chain
+    from graph import MultimodalQAGraph
+    
+    # Initialize the response cache shared by all requests
+    cache = ResponseCache(
+        path=RESPONSE_CACHE_PATH or None,
+        memory_items=RESPONSE_CACHE_MEMORY_ITEMS,
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        max_disk_bytes=RESPONSE_CACHE_MAX_BYTES
+    ) if RESPONSE_CACHE_ENABLED else None
+    
+    # Initialize the near-duplicate problem index
+    index = SimilarityIndex(
+        path=SIMILARITY_INDEX_PATH or None,
+        max_hamming=SIMILARITY_MAX_HAMMING,
+        max_entries=SIMILARITY_MAX_ENTRIES
+    ) if SIMILARITY_INDEX_ENABLED else None
+    
+    # Initialize graph with OpenAI and AWS credentials
+    qa_graph = MultimodalQAGraph(
+        openai_api_key=OPENAI_API_KEY,
+        aws_access_key=AWS_ACCESS_KEY,
+        aws_secret_key=AWS_SECRET_KEY,
+        aws_session_token=AWS_SESSION_TOKEN,
+        aws_region=AWS_REGION,
+        cache=cache,
+        similarity_index=index,
+        diagram_store=diagram_store,
+        flights=SingleFlight() if COALESCE_ENABLED else None,
+        qa_models=QA_MODELS,
+        cascade_min_confidence=QA_CASCADE_MIN_CONFIDENCE
+    )
+    
+    # Configure the process-wide scheduler lanes of both agents
+    for provider in qa_graph.qa_agent.providers:
+        shared_scheduler.configure(
+            provider,
+            concurrency=OPENAI_MAX_CONCURRENCY,
+            tokens_per_minute=OPENAI_TOKENS_PER_MINUTE
+        )
+    shared_scheduler.configure(
+        qa_graph.diagram_agent.provider,
+        concurrency=BEDROCK_MAX_CONCURRENCY,
+        tokens_per_minute=BEDROCK_TOKENS_PER_MINUTE
+    )
+    
+    # Configure the deadlines, retries, circuit breakers and hedging of both agents
+    for provider, call_timeout, hedge in (
+        *((provider, OPENAI_CALL_TIMEOUT_SECONDS, OPENAI_HEDGE) for provider in qa_graph.qa_agent.providers),
+        (qa_graph.diagram_agent.provider, BEDROCK_CALL_TIMEOUT_SECONDS, BEDROCK_HEDGE)
+    ):
+        shared_resilience.configure(
+            provider,
+            call_timeout=call_timeout,
+            max_attempts=UPSTREAM_MAX_ATTEMPTS,
+            backoff_base=UPSTREAM_RETRY_BACKOFF_SECONDS,
+            failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+            open_seconds=CIRCUIT_OPEN_SECONDS,
+            hedge=hedge,
+            hedge_budget=HEDGE_BUDGET
+        )
+    
+    response_cache, similarity_index = cache, index
+    graph, chain = qa_graph, qa_graph.build()
+    return graph, chain
+
+def open_job_queue() -> JobQueue:
+    """Open the durable job queue shared by the API and the job workers."""
+    return JobQueue(
+        path=JOB_QUEUE_PATH,
+        images_dir=JOB_IMAGES_DIR or None,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        retry_backoff_seconds=JOB_RETRY_BACKOFF_SECONDS,
+        max_pending=JOB_QUEUE_MAX_PENDING,
+        ttl_seconds=JOB_TTL_SECONDS
+    )
+
+# Modules the agents import while they are built
+AGENT_MODULES = ("graph", "openai.resources", "boto3", "botocore.config", "httpcore")
+
+def preload_agent_modules() -> None:
+    """
+    Import the agent stack without building anything.
+    
+    Meant for the master process of a preforking server (see gunicorn.conf.py):
+    workers forked afterwards share the imported modules and only construct
+    their own clients, which takes a fraction of the import time.
+    """
+    for name in AGENT_MODULES:
+        importlib.import_module(name)
+
+async def get_graph() -> Tuple[Any, Any]:
+    """
+    The graph and chain of this worker, built in a thread on first use.
+    
+    Concurrent callers share one build; the event loop keeps serving
+    other requests meanwhile.
+    
+    Returns:
+        tuple: The MultimodalQAGraph and its compiled chain
+    """
+    global _graph_build
+    if graph is not None:
+        return graph, chain
+    if _graph_build is None:
+        _graph_build = asyncio.ensure_future(asyncio.to_thread(build_graph))
+    try:
+        # Shielded so a cancelled request does not cancel the shared build
+        return await asyncio.shield(_graph_build)
+    except Exception:
+        # Let the next request try again
+        _graph_build = None
+        raise
+
+async def request_budget(x_request_timeout: Optional[float] = Header(None)) -> float:
+    """
+    Set the deadline of the current request for the scheduler.
+    
+    Clients may shorten (but not extend) the default budget with an
+    X-Request-Timeout header in seconds.
+    """
+    budget = REQUEST_DEADLINE_SECONDS
+    if x_request_timeout is not None and 0 < x_request_timeout < budget:
+        budget = x_request_timeout
+    deadline = time.monotonic() + budget
+    request_deadline.set(deadline)
+    return deadline
+
+def overloaded_response(overloaded: SchedulerOverloaded) -> JSONResponse:
+    """Turn a shed upstream call into a 429/503 response with Retry-After."""
+    return JSONResponse(
+        {"status": "error", "message": str(overloaded)},
+        status_code=overloaded.status_code,
+        headers={"Retry-After": str(int(overloaded.retry_after))}
+    )
+
+async def diagram_fields(diagram: Optional[str], inline: bool) -> Dict[str, Any]:
+    """
+    Diagram fields of a response: the SVG itself, or its content hash and URL.
+    
+    Args:
+        diagram (str, optional): Diagram of the result
+        inline (bool): Return the SVG in the response
+        
+    Returns:
+        dict: "diagram", or "diagram_hash" and "diagram_url" once the SVG is stored
+    """
+    # Nothing to address for no diagram, an empty one or an error message
+    if inline or not diagram or not diagram.startswith("<svg"):
+        return {"diagram": diagram}
+    digest = await asyncio.to_thread(diagram_assets.put, diagram)
+    return {"diagram_hash": digest, "diagram_url": f"/diagram/{digest}"}
+
+async def prepare_image(question: str, image: Optional[UploadFile]) -> Optional[ImageHandle]:
+    """
+    Validate and preprocess an optional uploaded image.
+    
+    Args:
+        question (str): The question the image belongs to
+        image (UploadFile, optional): Uploaded image file
+        
+    Returns:
+        ImageHandle: The preprocessed image, None without an image
+    """
+    # Validate image format if provided
+    if not image:
+        return None
+
+    if not validate_image_format(image.filename):
+        raise HTTPException(
+            status_code=400,
+            detail="Only PNG and JPG/JPEG images are supported"
+        )
+    
+    # Process image in the worker pool, off the event loop
+    try:
+        with span("upload_read"):
+            contents = await read_upload(image, MAX_UPLOAD_BYTES)
+        record_image_bytes("upload", len(contents))
+        processed_image = await image_pool.process(
+            contents, image.filename, IMAGE_PREPROCESS_MODE
+        )
+        # Drop the upload before the image travels on through the graph
+        del contents
+    except ImageTooLarge as too_large:
+        raise HTTPException(status_code=413, detail=str(too_large))
+    except ImagePoolFull as full:
+        raise HTTPException(
+            status_code=503,
+            detail=str(full),
+            headers={"Retry-After": str(int(full.retry_after))}
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Timed out processing image"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error processing image: {str(e)}"
+        )
+    finally:
+        await image.close()
+    # Stages ran in a worker, record them for this request
+    for stage, seconds in processed_image.timings.items():
+        record_stage(f"image_{stage}", seconds)
+    record_image_bytes("encoded", processed_image.byte_size)
+    logger.debug("Question: %s, image file name: %s", question, image.filename)
+
+    return processed_image
+
+async def resolve_image(question: str, image: Optional[UploadFile],
+                        image_id: Optional[str]) -> Optional[ImageHandle]:
+    """
+    The image of a question: uploaded with it, or uploaded before to /images.
+    
+    Args:
+        question (str): The question the image belongs to
+        image (UploadFile, optional): Uploaded image file
+        image_id (str, optional): The image_id returned by /images
+        
+    Returns:
+        ImageHandle: The preprocessed image, None without an image
+    """
+    if not image_id:
+        return await prepare_image(question, image)
+    if image:
+        await image.close()
+        raise HTTPException(status_code=400, detail="Send either an image or an image_id, not both")
+    handle = await asyncio.to_thread(image_store.get, image_id)
+    record_outcome("image_store", "miss" if handle is None else "hit")
+    if handle is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id, upload the image again")
+    return handle
+
+@app.post("/images")
+async def upload_image(image: UploadFile = File(...)):
+    """
+    Upload an image once to ask any number of questions about it.
+    
+    The image is preprocessed and stored; questions to /ask, /ask/stream and
+    /jobs then pass the returned image_id instead of the image. It expires
+    when no question used it for IMAGE_STORE_TTL_SECONDS.
+    
+    Args:
+        image (UploadFile): An image file to analyze (PNG or JPG/JPEG)
+    """
+    handle = await prepare_image("", image)
+    image_id = await asyncio.to_thread(image_store.put, handle)
+    return {
+        "status": "success",
+        "image_id": image_id,
+        "width": handle.width,
+        "height": handle.height,
+        "format": handle.format,
+        "byte_size": handle.byte_size,
+        "expires_in": IMAGE_STORE_TTL_SECONDS
+    }
+
+@app.get("/images/stats")
+async def image_store_stats():
+    """Uploaded images held by this worker and the lookups of their ids"""
+    return image_store.stats()
+
+@app.get("/images/{image_id}")
+async def get_image(image_id: str):
+    """
+    Metadata of an uploaded image, which also restarts its TTL.
+    
+    Args:
+        image_id (str): The image_id returned by /images
+    """
+    handle = await asyncio.to_thread(image_store.get, image_id)
+    if handle is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id")
+    return {"image_id": image_id, **handle.meta(), "expires_in": IMAGE_STORE_TTL_SECONDS}
 
 @app.post("/ask")
 async def ask_question(
     question: str = Form(...),
-    image: Optional[UploadFile] = File(None)
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    defer_diagram: bool = Form(DEFER_DIAGRAM),
+    want_diagram: Optional[bool] = Form(None),
+    inline_diagram: bool = Form(DIAGRAM_INLINE),
+    deadline: float = Depends(request_budget)
 ):
     """
     Process a question with an optional image.
@@ -58,60 +567,485 @@ async def ask_question(
     Args:
         question (str): The question to be answered
         image (UploadFile, optional): An image file to analyze (PNG or JPG/JPEG)
+        image_id (str, optional): The image_id of an image uploaded to /images,
+            instead of the image
+        defer_diagram (bool): Return as soon as the answer is ready, with a
+            diagram_id to fetch the diagram from /diagram/{diagram_id}
+        want_diagram (bool, optional): Force (true) or skip (false) the diagram,
+            decided from the question when omitted
+        inline_diagram (bool): Return the SVG in "diagram" instead of a
+            diagram_hash and a diagram_url to fetch it from /diagram/{hash}
     """
     try:
-        # Validate image format if provided
-        if image:
-            if not validate_image_format(image.filename):
-                raise HTTPException(
-                    status_code=400,
-                    detail="Only PNG and JPG/JPEG images are supported"
-                )
-            
-            # Process image
-            image_data = process_image(image)
-            
-            # Debug prints
-            print(f"Question : {question}")
-            print(f"Image file name: {image.filename}")
-            print(f"Base64 string starts with: {image_data[:50]}...")
-
-        else:
-            image_data = None
+        image_data = await resolve_image(question, image, image_id)
 
         # Run the chain
-        result = chain.invoke({
+        _, qa_chain = await get_graph()
+        result = await qa_chain.ainvoke({
             "question": question,
             "image": image_data,
             "answer": None,
             "diagram": None,
-            "subject": None
+            "subject": None,
+            "defer_diagram": defer_diagram,
+            "want_diagram": want_diagram
         })
 
         # override the diagram with the SVG file content
         #with open('3d-svg-source.svg', 'r') as svg_file:
         #    result["diagram"] = svg_file.read()
 
-        return JSONResponse({
+        response = {
             "status": "success",
             "answer": result["answer"],
-            "diagram": result["diagram"],
+            **await diagram_fields(result["diagram"], inline_diagram),
             "subject": result["subject"]
-        })
+        }
+        if result.get("diagram_id"):
+            response["diagram_id"] = result["diagram_id"]
+        return JSONResponse(response)
 
     except HTTPException as he:
         raise he
+    except SchedulerOverloaded as overloaded:
+        return overloaded_response(overloaded)
     except Exception as e:
         return JSONResponse({
             "status": "error",
             "message": str(e)
         }, status_code=500)
 
+@app.post("/ask/stream")
+async def ask_question_stream(
+    question: str = Form(...),
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    want_diagram: Optional[bool] = Form(None),
+    inline_diagram: bool = Form(DIAGRAM_INLINE),
+    deadline: float = Depends(request_budget)
+):
+    """
+    Process a question with an optional image and stream the results
+    as Server-Sent Events.
+    
+    Emits "token" events with pieces of the answer as the model generates
+    them, "subject" and "diagram" events as soon as each one is ready, and a
+    final "done" event. Failures are reported as "error" events.
+    
+    Args:
+        question (str): The question to be answered
+        image (UploadFile, optional): An image file to analyze (PNG or JPG/JPEG)
+        image_id (str, optional): The image_id of an image uploaded to /images,
+            instead of the image
+        want_diagram (bool, optional): Force (true) or skip (false) the diagram,
+            decided from the question when omitted
+        inline_diagram (bool): Send the SVG in the "diagram" event instead of
+            its diagram_hash and diagram_url
+    """
+    image_data = await resolve_image(question, image, image_id)
+    state = {
+        "question": question,
+        "image": image_data,
+        "answer": None,
+        "diagram": None,
+        "subject": None,
+        "want_diagram": want_diagram
+    }
+    qa_graph, _ = await get_graph()
+
+    async def event_stream():
+        try:
+            async for event in qa_graph.stream_question(state):
+                data = event["data"]
+                if event["event"] == "diagram":
+                    data = await diagram_fields(data["diagram"], inline_diagram)
+                yield f"event: {event['event']}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+class BatchItem(BaseModel):
+    """A single problem of a batch request"""
+    id: str = Field(description="Client chosen identifier echoed in the result")
+    question: str = Field(description="The question to be answered")
+    image: Optional[str] = Field(
+        default=None,
+        description="Optional PNG or JPEG image, base64 encoded or as a data URL"
+    )
+    want_diagram: Optional[bool] = Field(
+        default=None,
+        description="Force or skip the diagram, decided from the question when omitted"
+    )
+
+class BatchRequest(BaseModel):
+    """Body of a /ask/batch request"""
+    items: List[BatchItem] = Field(max_length=BATCH_MAX_ITEMS, description="Problems to answer")
+    concurrency: int = Field(default=8, ge=1, description="Problems processed at once")
+
+@app.post("/ask/batch")
+async def ask_batch(request: BatchRequest):
+    """
+    Answer many questions in one request.
+    
+    Results are streamed back as JSON lines in completion order, one per
+    item, each with "status" "success" or "error". Failures of one item do
+    not affect the others; resubmit only the failed ids to retry them.
+    
+    Args:
+        request (BatchRequest): Items to answer and the fan-out to use
+    """
+    concurrency = min(request.concurrency, BATCH_MAX_CONCURRENCY)
+
+    async def load_image(item: Dict[str, Any]):
+        if not item.get("image"):
+            return None
+        header, _, encoded = item["image"].rpartition(",")
+        filename = "image.png" if "image/png" in header else "image.jpeg"
+        if len(encoded) // 4 * 3 > MAX_UPLOAD_BYTES:
+            raise ImageTooLarge(f"Image exceeds the limit of {MAX_UPLOAD_BYTES} bytes")
+        return await image_pool.process(
+            base64.b64decode(encoded), filename, IMAGE_PREPROCESS_MODE
+        )
+
+    async def result_stream():
+        items = [item.model_dump() for item in request.items]
+        _, qa_chain = await get_graph()
+        async for result in run_batch(
+            qa_chain, items, load_image, concurrency, item_timeout=REQUEST_DEADLINE_SECONDS
+        ):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+@app.get("/diagram/stats")
+async def diagram_store_stats():
+    """Deferred diagram store occupancy and outcome counters, and those of the content-addressed diagrams"""
+    return {**diagram_store.stats(), "assets": diagram_assets.stats()}
+
+async def diagram_asset_response(digest: str, if_none_match: Optional[str],
+                                 accept_encoding: Optional[str]) -> Response:
+    """Serve a stored diagram in the best coding the client accepts, or 304 when it has it already."""
+    headers = {
+        "Cache-Control": f"public, max-age={DIAGRAM_MAX_AGE_SECONDS}, immutable",
+        "Vary": "Accept-Encoding",
+        # Opened directly, an SVG is a document of this origin: no scripts, no requests
+        "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+        "X-Content-Type-Options": "nosniff"
+    }
+    # The hash names the content, so any tag carrying it means the client's copy is current
+    if if_none_match is not None and (digest in if_none_match or if_none_match.strip() == "*"):
+        record_outcome("diagram_fetch", "not_modified")
+        # The same tag a 200 would carry for the coding this client gets
+        return Response(
+            status_code=304,
+            headers={**headers, "ETag": diagram_etag(digest, preferred_encoding(accept_encoding))}
+        )
+    found = await asyncio.to_thread(diagram_assets.get, digest, accept_encoding)
+    if found is None:
+        record_outcome("diagram_fetch", "missing")
+        raise HTTPException(status_code=404, detail="Unknown or expired diagram")
+    encoding, body = found
+    record_outcome("diagram_fetch", encoding)
+    headers["ETag"] = diagram_etag(digest, encoding)
+    if encoding != ENCODING_IDENTITY:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="image/svg+xml", headers=headers)
+
+@app.get("/diagram/{diagram_id}")
+async def get_diagram(diagram_id: str, wait: float = 0, inline_diagram: bool = DIAGRAM_INLINE,
+                      if_none_match: Optional[str] = Header(None),
+                      accept_encoding: Optional[str] = Header(None)):
+    """
+    Fetch a diagram by content hash, or a diagram deferred by /ask.
+    
+    A content hash (the diagram_hash of a response) returns the SVG itself,
+    compressed when the client accepts it, cacheable forever and revalidated
+    with If-None-Match.
+    
+    A diagram_id returns 200 with the diagram once it is ready and 202 while
+    it is still being generated. With wait, the request is held open up to
+    that many seconds (capped at DIAGRAM_MAX_WAIT_SECONDS) for the diagram
+    to finish.
+    
+    Args:
+        diagram_id (str): The diagram_hash or the diagram_id returned by /ask
+        wait (float): Seconds to long poll for a pending diagram
+        inline_diagram (bool): Return a deferred diagram's SVG instead of its hash and URL
+    """
+    if is_diagram_hash(diagram_id):
+        return await diagram_asset_response(diagram_id, if_none_match, accept_encoding)
+    result = await diagram_store.wait(diagram_id, min(max(wait, 0), DIAGRAM_MAX_WAIT_SECONDS))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired diagram id")
+    if result["status"] == DIAGRAM_READY:
+        return JSONResponse({"status": "success", **await diagram_fields(result["diagram"], inline_diagram)})
+    if result["status"] == DIAGRAM_PENDING:
+        return JSONResponse(
+            {"status": "pending", "diagram_id": diagram_id},
+            status_code=202,
+            headers={"Retry-After": "1"}
+        )
+    return JSONResponse({"status": "error", "message": result["message"]}, status_code=500)
+
+async def job_response(job: Dict[str, Any], inline_diagram: bool = DIAGRAM_INLINE) -> JSONResponse:
+    """Turn a job into a response: 200 with the result, 202 while it waits or runs, 500 once it failed."""
+    if job["status"] == JOB_SUCCEEDED:
+        result = dict(job["result"])
+        diagram = await diagram_fields(result.pop("diagram"), inline_diagram)
+        return JSONResponse({
+            "status": "success",
+            "job_id": job["job_id"],
+            "attempts": job["attempts"],
+            **result,
+            **diagram
+        })
+    if job["status"] == JOB_FAILED:
+        return JSONResponse(
+            {"status": "error", "job_id": job["job_id"], "attempts": job["attempts"], "message": job["error"]},
+            status_code=500
+        )
+    response = {"status": job["status"], "job_id": job["job_id"], "attempts": job["attempts"]}
+    if job["error"] is not None:
+        response["last_error"] = job["error"]
+    return JSONResponse(
+        response,
+        status_code=202,
+        headers={"Location": f"/jobs/{job['job_id']}", "Retry-After": "1"}
+    )
+
+@app.post("/jobs")
+async def submit_job(
+    question: str = Form(...),
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    want_diagram: Optional[bool] = Form(None),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """
+    Queue a question with an optional image and return at once.
+    
+    The image is preprocessed and stored before this returns; a worker then
+    answers the question and the result is fetched from /jobs/{job_id}.
+    Submitting again with the same Idempotency-Key header returns the
+    existing job instead of queueing a second one.
+    
+    Args:
+        question (str): The question to be answered
+        image (UploadFile, optional): An image file to analyze (PNG or JPG/JPEG)
+        image_id (str, optional): The image_id of an image uploaded to /images,
+            instead of the image
+        want_diagram (bool, optional): Force (true) or skip (false) the diagram,
+            decided from the question when omitted
+        idempotency_key (str, optional): Client chosen key of the job
+    """
+    image_data = await resolve_image(question, image, image_id)
+    try:
+        job, created = await asyncio.to_thread(
+            job_queue.submit, question, image_data, want_diagram, idempotency_key
+        )
+    except IdempotencyConflict as conflict:
+        raise HTTPException(status_code=409, detail=str(conflict))
+    except JobQueueFull as full:
+        raise HTTPException(
+            status_code=503,
+            detail=str(full),
+            headers={"Retry-After": str(int(full.retry_after))}
+        )
+    if created:
+        logger.info("Queued job %s", job["job_id"])
+    return await job_response(job)
+
+@app.get("/jobs/stats")
+async def job_queue_stats():
+    """Jobs per status in the shared queue and the outcomes of this worker's job runner"""
+    stats = await asyncio.to_thread(job_queue.stats)
+    stats["worker"] = job_worker.stats() if job_worker is not None else None
+    return stats
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0, inline_diagram: bool = DIAGRAM_INLINE):
+    """
+    Fetch the status or the result of a job queued with /jobs.
+    
+    Returns 200 with the answer, diagram and subject once the job succeeded,
+    202 while it is queued or running and 500 once it failed for good. With
+    wait, the request is held open up to that many seconds (capped at
+    JOB_MAX_WAIT_SECONDS) for the job to finish.
+    
+    Args:
+        job_id (str): The job_id returned by /jobs
+        wait (float): Seconds to long poll for an unfinished job
+        inline_diagram (bool): Return the SVG instead of its hash and URL
+    """
+    deadline = time.monotonic() + min(max(wait, 0), JOB_MAX_WAIT_SECONDS)
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    # Workers may run in other processes, so the queue is polled rather than notified
+    while job is not None and job["status"] not in JOB_FINISHED and time.monotonic() < deadline:
+        await asyncio.sleep(min(0.25, max(0.0, deadline - time.monotonic())))
+        job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job id")
+    return await job_response(job, inline_diagram)
+
+@app.on_event("startup")
+def start_image_pool():
+    """Start the image preprocessing workers in the background, without delaying startup"""
+    threading.Thread(target=image_pool.start, name="image-pool-start", daemon=True).start()
+
+@app.on_event("startup")
+async def size_default_executor():
+    """
+    Give blocking upstream calls enough threads.
+    
+    Bedrock calls run boto3 in the event loop's default executor, which only
+    has min(32, CPU count + 4) threads. Size it to the Bedrock connection
+    pool so neither limits the other.
+    """
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BEDROCK_POOL_MAX_CONNECTIONS + 8, thread_name_prefix="upstream")
+    )
+
+@app.on_event("startup")
+def open_jobs():
+    """Open the job queue of this worker, before the agent build competes for the CPU"""
+    global job_queue
+    job_queue = open_job_queue()
+
+@app.on_event("startup")
+async def init_agents():
+    """Build the agents of this worker according to AGENT_INIT"""
+    if AGENT_INIT == "eager":
+        await get_graph()
+    elif AGENT_INIT == "background":
+        def log_failure(task: asyncio.Future) -> None:
+            # The first request that needs the agents retries the build
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Building the agents failed: %s", task.exception())
+        asyncio.ensure_future(get_graph()).add_done_callback(log_failure)
+
+@app.on_event("startup")
+async def start_job_worker():
+    """Run queued jobs in this worker once its agents are built, unless JOB_WORKER_CONCURRENCY is 0"""
+    global _job_worker_task
+    if JOB_WORKER_CONCURRENCY <= 0:
+        return
+
+    async def run_jobs() -> None:
+        global job_worker
+        while True:
+            try:
+                _, qa_chain = await get_graph()
+                break
+            except Exception as e:
+                logger.error("Job worker waiting for the agents: %s", e)
+                await asyncio.sleep(5)
+        job_worker = JobWorker(
+            job_queue, qa_chain, concurrency=JOB_WORKER_CONCURRENCY, lease_seconds=JOB_LEASE_SECONDS
+        )
+        await job_worker.run()
+
+    _job_worker_task = asyncio.create_task(run_jobs())
+
+@app.on_event("shutdown")
+async def stop_job_worker():
+    """Hand running jobs back to the queue for other workers"""
+    if _job_worker_task is not None:
+        _job_worker_task.cancel()
+        await asyncio.wait({_job_worker_task})
+    if job_queue is not None:
+        job_queue.close()
+
+@app.on_event("shutdown")
+def shutdown_image_pool():
+    """Stop the image preprocessing workers"""
+    image_pool.shutdown()
+
+@app.on_event("shutdown")
+def shutdown_diagram_store():
+    """Cancel diagrams still being generated"""
+    diagram_store.shutdown()
+
+@app.get("/images/pool/stats")
+async def image_pool_stats():
+    """Image preprocessing pool occupancy and per-stage timings"""
+    return image_pool.stats()
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Live queue depth and wait times of every upstream provider"""
+    return shared_scheduler.stats()
+
+@app.get("/resilience/stats")
+async def resilience_stats():
+    """Circuit breaker state, retries, timeouts and hedges of every upstream provider"""
+    return shared_resilience.stats()
+
+@app.get("/pools/stats")
+async def connection_pool_stats():
+    """Connection pool utilization of the OpenAI and Bedrock clients"""
+    return pool_stats()
+
+@app.get("/routing/stats")
+async def routing_stats():
+    """Diagram routing decisions and the Bedrock calls they avoided"""
+    qa_graph, _ = await get_graph()
+    return qa_graph.routing_stats()
+
+@app.get("/cascade/stats")
+async def cascade_stats():
+    """QA model cascade tiers with their hit rates, escalation reasons and latencies"""
+    qa_graph, _ = await get_graph()
+    return qa_graph.qa_agent.cascade_stats()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Response cache hit and miss counters"""
+    if RESPONSE_CACHE_ENABLED:
+        await get_graph()
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.stats()}
+
+@app.get("/similarity/stats")
+async def similarity_stats():
+    """Near-duplicate index lookup counters"""
+    if SIMILARITY_INDEX_ENABLED:
+        await get_graph()
+    if similarity_index is None:
+        return {"enabled": False}
+    return {"enabled": True, **similarity_index.stats()}
+
+@app.get("/coalesce/stats")
+async def coalesce_stats():
+    """Identical calls in flight and the upstream calls coalesced into them"""
+    if not COALESCE_ENABLED:
+        return {"enabled": False}
+    qa_graph, _ = await get_graph()
+    return {"enabled": True, **qa_graph.flights.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request and stage latency, tokens, image sizes and outcomes"""
+    return Response(render(), media_type=CONTENT_TYPE)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint, 503 until the agents of this worker are built (unless AGENT_INIT is lazy)"""
+    if graph is None and AGENT_INIT != "lazy":
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
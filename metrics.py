@@ -0,0 +1,294 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Tuple, Iterator
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Prometheus text exposition format served at /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets up to the slowest diagram calls
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+# Payload buckets from small screenshots to unresized phone photos
+BYTES_BUCKETS = (16e3, 64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+
+INF_BUCKET = 'le="+Inf"'
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+class Histogram:
+    """Cumulative histogram with labels."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: bucket counts, sum and count
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    le = _labels(self.labelnames, key, f'le="{bound:g}"')
+                    lines.append(f"{self.name}_bucket{le} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, INF_BUCKET)} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total:g}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = SECONDS_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# The metrics of this process
+registry = Registry()
+REQUEST_SECONDS = registry.histogram(
+    "qa_request_seconds", "HTTP request latency until the last body byte", ("method", "route", "status")
+)
+STAGE_SECONDS = registry.histogram(
+    "qa_stage_seconds", "Time spent in each request stage", ("stage",)
+)
+SCHEDULER_WAIT_SECONDS = registry.histogram(
+    "qa_scheduler_wait_seconds", "Time upstream calls waited for a scheduler slot", ("provider",)
+)
+TOKENS = registry.counter(
+    "qa_tokens_total", "Model tokens reported by the providers", ("provider", "kind")
+)
+IMAGE_BYTES = registry.histogram(
+    "qa_image_bytes", "Image size as uploaded, as sent to the models and the estimated preprocessing memory", ("kind",), BYTES_BUCKETS
+)
+OUTCOMES = registry.counter(
+    "qa_outcomes_total", "Cache, near-duplicate and routing outcomes", ("kind", "outcome")
+)
+
+@dataclass
+class RequestTrace:
+    """Stages, token usage and outcomes of one request, logged when it completes."""
+    request_id: str
+    stages: Dict[str, float] = field(default_factory=dict)
+    tokens: Dict[str, int] = field(default_factory=dict)
+    outcomes: Dict[str, str] = field(default_factory=dict)
+    image_bytes: Dict[str, int] = field(default_factory=dict)
+
+# Trace of the request being served, shared by every task the request starts
+request_trace: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+_tracer = None
+
+def configure_tracing(service_name: str = "multimodal-qna-agent") -> bool:
+    """
+    Export spans to an OTLP collector with OpenTelemetry, if it is installed.
+
+    The collector endpoint comes from the standard OTEL_EXPORTER_OTLP_ENDPOINT
+    environment variable.
+
+    Args:
+        service_name (str): service.name resource attribute of the spans
+
+    Returns:
+        bool: Whether tracing was enabled
+    """
+    global _tracer
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning(
+            "OpenTelemetry tracing requested but opentelemetry-sdk and "
+            "opentelemetry-exporter-otlp-proto-http are not installed"
+        )
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    return True
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Record time spent in a stage measured elsewhere, e.g. in an image worker."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = request_trace.get()
+    if trace is not None:
+        trace.stages[stage] = trace.stages.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time a request stage, also as an OpenTelemetry span when tracing is enabled.
+
+    Args:
+        stage (str): Stage name, e.g. "openai_call"
+    """
+    started = time.perf_counter()
+    if _tracer is None:
+        try:
+            yield
+        finally:
+            record_stage(stage, time.perf_counter() - started)
+        return
+    with _tracer.start_as_current_span(stage):
+        try:
+            yield
+        finally:
+            record_stage(stage, time.perf_counter() - started)
+
+def record_tokens(provider: str, message: Any) -> None:
+    """Count the prompt and completion tokens a provider reported for a response."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    trace = request_trace.get()
+    for kind, key in (("prompt", "input_tokens"), ("completion", "output_tokens")):
+        if usage.get(key) is not None:
+            TOKENS.inc(usage[key], provider=provider, kind=kind)
+            if trace is not None:
+                name = f"{provider}:{kind}"
+                trace.tokens[name] = trace.tokens.get(name, 0) + usage[key]
+
+def record_outcome(kind: str, outcome: str) -> None:
+    """Count an outcome, e.g. kind "cache_answer" with outcome "hit"."""
+    OUTCOMES.inc(kind=kind, outcome=outcome)
+    trace = request_trace.get()
+    if trace is not None:
+        trace.outcomes[kind] = outcome
+
+def record_image_bytes(kind: str, size: int) -> None:
+    """Record an image size, kind "upload" for the raw upload, "encoded" for the model payload or "peak_estimate"."""
+    IMAGE_BYTES.observe(size, kind=kind)
+    trace = request_trace.get()
+    if trace is not None:
+        trace.image_bytes[kind] = trace.image_bytes.get(kind, 0) + size
+
+def render() -> str:
+    """All metrics in the Prometheus text format."""
+    return registry.render()
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request until its last body byte.
+
+    Each request gets a RequestTrace that stages, tokens and outcomes are
+    recorded into from any task the request starts, and that is logged as
+    one JSON line once the response is complete. The request id is taken
+    from an X-Request-ID header or generated, and echoed in the response.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex
+        trace = RequestTrace(request_id)
+        token = request_trace.set(trace)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        root = _tracer.start_as_current_span(f"{scope['method']} {scope['path']}") if _tracer else None
+        try:
+            if root is not None:
+                with root:
+                    await self.app(scope, receive, send_wrapper)
+            else:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - started
+            # The matched route template keeps ids out of the labels
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(seconds, method=scope["method"], route=route, status=str(status))
+            request_trace.reset(token)
+            logger.info(json.dumps({
+                "request_id": request_id,
+                "method": scope["method"],
+                "route": route,
+                "status": status,
+                "seconds": round(seconds, 4),
+                "stages": {stage: round(value, 4) for stage, value in trace.stages.items()},
+                "tokens": trace.tokens,
+                "outcomes": trace.outcomes,
+                "image_bytes": trace.image_bytes
+            }))
@@ -1,5 +1,13 @@
 from langchain_core.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from typing import Optional
+from image_utils import ImageHandle
+
+# Bump these whenever the corresponding templates, or how their output is
+# post-processed, change so that cached responses produced by an older
+# prompt are no longer reused
+MULTIMODAL_PROMPT_VERSION = "1"
+# 2: diagrams are minified
+DIAGRAM_PROMPT_VERSION = "2"
 
 # System prompt template for the multimodal agent
 MULTIMODAL_SYSTEM_TEMPLATE = """You are a helpful AI assistant who is trying to help a middle school student to understand concepts and solve problems in easy to understand manner,  
@@ -74,13 +82,13 @@ class MultimodalPromptTemplates:
         ])
     
     @staticmethod
-    def format_human_message(question: str, image: Optional[str] = None) -> list:
+    def format_human_message(question: str, image: Optional[ImageHandle] = None) -> list:
         """
         Format the human message with question and optional image.
         
         Args:
             question (str): The question to be answered
-            image (str, optional): Base64 encoded image data
+            image (ImageHandle, optional): Preprocessed image
             
         Returns:
             list: Formatted message content for the API
@@ -94,7 +102,7 @@ class MultimodalPromptTemplates:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": image
+                        "url": image.data_url
                     }
                 }
             ]
@@ -116,19 +124,18 @@ class DiagramPromptTemplates:
         ])
     
     @staticmethod
-    def format_diagram_message(context: str, image: Optional[str] = None) -> list:
+    def format_diagram_message(context: str, image: Optional[ImageHandle] = None) -> list:
         """Format the diagram message with context and optional image."""
         if image:
+            # Passed to Claude as is, no data URL for the Bedrock adapter to parse back
             return [
                 {
                     "type": "text",
                     "text": context
                 },
                 {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image
-                    }
+                    "type": "image",
+                    "source": image.anthropic_source
                 }
             ]
         return context 
\ No newline at end of file
@@ -0,0 +1,394 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable, TypeVar
+from scheduler import SchedulerOverloaded, request_deadline
+from metrics import record_outcome
+import asyncio
+import random
+import time
+
+T = TypeVar("T")
+
+# Circuit breaker states
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# Recent successful call latencies per provider the hedge delay is computed from
+LATENCY_WINDOW = 200
+
+# HTTP statuses worth another attempt: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Transient error types and codes of the OpenAI SDK, httpx, botocore and Bedrock
+RETRYABLE_ERRORS = {
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",
+    "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError",
+    "EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError", "ConnectionClosedError",
+    "ThrottlingException", "ServiceUnavailableException", "ModelTimeoutException",
+    "ModelNotReadyException", "InternalServerException", "ModelStreamErrorException"
+}
+
+class CircuitOpen(SchedulerOverloaded):
+    """Raised when a provider's circuit breaker rejects a call without trying it."""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(provider, retry_after, 503)
+        self.args = (f"{provider} is failing, retry in {self.retry_after:.0f}s",)
+
+class DeadlineExceeded(SchedulerOverloaded):
+    """Raised when a provider did not answer within the call deadline."""
+
+    def __init__(self, provider: str, seconds: float):
+        super().__init__(provider, 1.0, 504)
+        self.args = (f"{provider} did not answer within {seconds:.1f}s",)
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Decide whether a failed upstream call is worth another attempt.
+
+    LangChain wraps Bedrock errors in a ValueError, so the whole chain of
+    causes is inspected.
+
+    Args:
+        error (BaseException): Error raised by the call
+
+    Returns:
+        bool: Whether the error is transient
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__):
+            return True
+        status = getattr(error, "status_code", None) or getattr(error, "status", None)
+        if isinstance(status, int) and status in RETRYABLE_STATUS:
+            return True
+        # botocore ClientError
+        response = getattr(error, "response", None)
+        if isinstance(response, dict):
+            if response.get("Error", {}).get("Code") in RETRYABLE_ERRORS:
+                return True
+            if response.get("ResponseMetadata", {}).get("HTTPStatusCode") in RETRYABLE_STATUS:
+                return True
+        error = error.__cause__ or error.__context__
+    return False
+
+@dataclass
+class ResiliencePolicy:
+    """Deadline, retry, circuit breaker and hedging settings of one provider."""
+    call_timeout: float = 60.0
+    max_attempts: int = 3
+    backoff_base: float = 0.25
+    backoff_max: float = 4.0
+    failure_threshold: int = 5
+    open_seconds: float = 30.0
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_delay: float = 0.05
+    hedge_min_samples: int = 20
+    hedge_budget: float = 0.1
+
+class _Guard:
+    """Circuit breaker, latency window and counters of one provider."""
+
+    def __init__(self, name: str, policy: ResiliencePolicy):
+        self.name = name
+        self.policy = policy
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.probe_started: Optional[float] = None
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {
+            "calls": 0, "succeeded": 0, "failed": 0, "timeouts": 0, "retries": 0,
+            "rejected": 0, "opened": 0, "hedged": 0, "hedge_wins": 0
+        }
+
+    def count(self, event: str) -> None:
+        self.counts[event] += 1
+        record_outcome("upstream", f"{self.name}:{event}")
+
+    def admit(self) -> None:
+        """Let a call through unless the circuit is open; half open lets one probe through."""
+        now = time.monotonic()
+        if self.state == CIRCUIT_OPEN:
+            remaining = self.policy.open_seconds - (now - self.opened)
+            if remaining > 0:
+                self.count("rejected")
+                raise CircuitOpen(self.name, remaining)
+            self.state = CIRCUIT_HALF_OPEN
+            self.probe_started = None
+        if self.state == CIRCUIT_HALF_OPEN:
+            # A probe that never settled (e.g. shed by the scheduler) does not block forever
+            if self.probe_started is not None and now - self.probe_started < self.policy.open_seconds:
+                self.count("rejected")
+                raise CircuitOpen(self.name, 1.0)
+            self.probe_started = now
+        self.counts["calls"] += 1
+
+    def succeeded(self) -> None:
+        self.counts["succeeded"] += 1
+        self.failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.probe_started = None
+
+    def failed(self, event: str = "failed") -> None:
+        self.count(event)
+        self.failures += 1
+        if self.state == CIRCUIT_HALF_OPEN or (
+                self.state == CIRCUIT_CLOSED and self.failures >= self.policy.failure_threshold):
+            self.state = CIRCUIT_OPEN
+            self.opened = time.monotonic()
+            self.probe_started = None
+            self.count("opened")
+
+    def released(self, event: Optional[str] = None) -> None:
+        """A call ended without saying anything about the provider's health."""
+        if event is not None:
+            self.count(event)
+        self.probe_started = None
+
+    def timed_out(self, deadline: float) -> None:
+        if deadline == request_deadline.get():
+            # Cut short by the request budget, which says little about the provider
+            self.released("timeouts")
+        else:
+            self.failed("timeouts")
+
+    def latency(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a duplicate call is sent, None when this call is not hedged."""
+        policy = self.policy
+        if not policy.hedge or self.state != CIRCUIT_CLOSED or len(self.latencies) < policy.hedge_min_samples:
+            return None
+        if self.counts["hedged"] >= policy.hedge_budget * self.counts["calls"]:
+            return None
+        return max(policy.hedge_min_delay, self.latency(policy.hedge_quantile))
+
+class Resilience:
+    """
+    Deadlines, retries, circuit breakers and hedging of upstream model calls.
+
+    Every provider gets a policy and a guard. Each call attempt runs under a
+    deadline: the provider's call timeout, cut short by the request deadline.
+    Transient failures and timeouts are retried with full jitter backoff
+    while the request budget lasts. After a run of consecutive failures the
+    provider's circuit opens and calls fail fast with CircuitOpen, until a
+    single probe call succeeds again. With hedging enabled, an attempt still
+    running after the provider's recent p95 latency gets a duplicate, the
+    first success wins and the other is cancelled; hedges are capped at a
+    share of all calls so they cannot double the load of a slow provider.
+    """
+
+    def __init__(self):
+        self._guards: Dict[str, _Guard] = {}
+
+    def configure(self, provider: str, **settings) -> None:
+        """
+        Set the policy of a provider, resetting its breaker and counters.
+
+        Args:
+            provider (str): Provider name, e.g. "openai:gpt-4o"
+            **settings: ResiliencePolicy fields to change from the defaults
+        """
+        self._guards[provider] = _Guard(provider, ResiliencePolicy(**settings))
+
+    def _guard(self, provider: str) -> _Guard:
+        if provider not in self._guards:
+            self.configure(provider)
+        return self._guards[provider]
+
+    def deadline(self, provider: str) -> float:
+        """time.monotonic() deadline of a call started now: its timeout, cut short by the request deadline."""
+        deadline = time.monotonic() + self._guard(provider).policy.call_timeout
+        request_end = request_deadline.get()
+        return deadline if request_end is None else min(deadline, request_end)
+
+    def admit(self, provider: str) -> float:
+        """
+        Admit a call through the provider's circuit breaker.
+
+        Args:
+            provider (str): Provider name
+
+        Returns:
+            float: time.monotonic() deadline of the call
+
+        Raises:
+            CircuitOpen: When the provider's circuit is open
+        """
+        self._guard(provider).admit()
+        return self.deadline(provider)
+
+    async def call(self, provider: str, attempt: Callable[[float], Awaitable[T]]) -> T:
+        """
+        Run a call with deadlines, retries, the circuit breaker and hedging.
+
+        Args:
+            provider (str): Provider name
+            attempt: Coroutine function making one attempt, given its
+                time.monotonic() deadline (e.g. for the scheduler)
+
+        Returns:
+            The result of the first successful attempt
+
+        Raises:
+            CircuitOpen: When the provider's circuit is open
+            DeadlineExceeded: When the last attempt timed out
+            SchedulerOverloaded: When the scheduler shed an attempt, never retried
+            Exception: The error of the last attempt otherwise
+        """
+        guard = self._guard(provider)
+        policy = guard.policy
+        attempts = max(1, policy.max_attempts)
+        for number in range(1, attempts + 1):
+            deadline = self.admit(provider)
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                result = await asyncio.wait_for(self._hedged(guard, attempt, deadline), timeout)
+            except asyncio.TimeoutError:
+                guard.timed_out(deadline)
+                error: Exception = DeadlineExceeded(provider, max(timeout, 0.0))
+            except SchedulerOverloaded:
+                guard.released()
+                raise
+            except asyncio.CancelledError:
+                guard.released()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    guard.released()
+                    raise
+                guard.failed()
+                error = e
+            else:
+                guard.succeeded()
+                return result
+
+            if number == attempts:
+                break
+            backoff = random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** (number - 1)))
+            request_end = request_deadline.get()
+            if request_end is not None and time.monotonic() + backoff >= request_end:
+                # No budget left for another attempt
+                break
+            guard.count("retries")
+            await asyncio.sleep(backoff)
+        raise error
+
+    async def _timed(self, guard: _Guard, attempt: Callable[[float], Awaitable[T]], deadline: float) -> T:
+        started = time.monotonic()
+        result = await attempt(deadline)
+        guard.latencies.append(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, guard: _Guard, attempt: Callable[[float], Awaitable[T]], deadline: float) -> T:
+        """One attempt, with a duplicate sent after the hedge delay if it is still running."""
+        delay = guard.hedge_delay()
+        if delay is None:
+            return await self._timed(guard, attempt, deadline)
+        tasks = [asyncio.ensure_future(self._timed(guard, attempt, deadline))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                guard.count("hedged")
+                tasks.append(asyncio.ensure_future(self._timed(guard, attempt, deadline)))
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            guard.count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The slower call is abandoned, which also releases its scheduler slot
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, provider: str, chunks: AsyncIterator[T], deadline: float) -> AsyncIterator[T]:
+        """
+        Forward a streamed call admitted with admit, under its deadline.
+
+        Streams are neither retried nor hedged: their chunks may already
+        have been passed on.
+
+        Args:
+            provider (str): Provider name
+            chunks (AsyncIterator): Chunks of the streamed call
+            deadline (float): time.monotonic() deadline returned by admit
+
+        Yields:
+            The chunks of the call
+
+        Raises:
+            DeadlineExceeded: When the stream did not finish before the deadline
+        """
+        guard = self._guard(provider)
+        started = time.monotonic()
+        settled = False
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    guard.timed_out(deadline)
+                    settled = True
+                    raise DeadlineExceeded(provider, deadline - started) from None
+                except Exception as e:
+                    if is_retryable(e):
+                        guard.failed()
+                        settled = True
+                    raise
+                yield chunk
+            guard.latencies.append(time.monotonic() - started)
+            guard.succeeded()
+            settled = True
+        finally:
+            if not settled:
+                guard.released()
+            await chunks.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get breaker states and call counters of every provider.
+
+        Returns:
+            dict: Per provider the circuit state, consecutive failures, call,
+                retry, timeout and hedge counters, recent latency percentiles
+                and the current hedge delay
+        """
+        stats = {}
+        for name, guard in self._guards.items():
+            p50, p95 = guard.latency(0.5), guard.latency(0.95)
+            delay = guard.hedge_delay()
+            stats[name] = {
+                "state": guard.state,
+                "consecutive_failures": guard.failures,
+                "call_timeout_s": guard.policy.call_timeout,
+                "max_attempts": guard.policy.max_attempts,
+                "hedge": guard.policy.hedge,
+                **guard.counts,
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None
+            }
+        return stats
+
+# The resilience layer shared by every agent in this process
+shared_resilience = Resilience()
@@ -0,0 +1,72 @@
+from typing import Optional, Dict, Any, Tuple
+from image_utils import ImageHandle
+import re
+import threading
+
+# Words suggesting a question about something spatial, drawable or plottable
+VISUAL_TERMS = re.compile(
+    r"\b("
+    r"diagram|draw|sketch|illustrat\w*|visuali[sz]\w*|plot\w*|graph\w*|chart|figure|"
+    r"triangle|circle|square|rectangle|polygon|pentagon|hexagon|quadrilateral|parallelogram|"
+    r"trapezo\w*|rhomb\w*|angles?|degrees|parallel|perpendicular|tangent|chord|arc|radius|"
+    r"diameter|circumference|perimeter|area|volume|surface|cube|sphere|cylinder|cone|prism|"
+    r"pyramid|geometr\w*|coordinates?|axis|axes|quadrant|slope|intercept|parabola|hyperbola|"
+    r"ellipse|vectors?|projectile|trajectory|incline\w*|pulley|lens|mirror|refraction|"
+    r"circuit|resistors?|free.body|venn|flowchart|tree diagram|number line|shaded|shape"
+    r")\b",
+    re.IGNORECASE
+)
+
+# Equations of a curve, e.g. "y = 2x + 1" or "f(x) = x^2"
+PLOTTABLE = re.compile(r"\b(y\s*=|[fgh]\s*\(\s*x\s*\)\s*=)", re.IGNORECASE)
+
+def needs_diagram(question: str, image: Optional[ImageHandle] = None) -> Tuple[bool, str]:
+    """
+    Decide locally whether a diagram is likely to help answer a question.
+
+    Problems that come with an image are always illustrated. Text-only
+    questions are illustrated when they mention shapes, plots or physical
+    setups; everything else (facts, definitions, plain arithmetic) is not.
+
+    Args:
+        question (str): Question text
+        image (ImageHandle, optional): The uploaded image
+
+    Returns:
+        tuple: Whether to generate a diagram and the reason for the decision
+    """
+    if image is not None:
+        return True, "image"
+    match = VISUAL_TERMS.search(question)
+    if match is not None:
+        return True, f"term:{match.group(0).lower()}"
+    if PLOTTABLE.search(question):
+        return True, "equation"
+    return False, "text-only"
+
+class RoutingStats:
+    """Counters of routing decisions, used to measure the diagram calls avoided."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"with_diagram": 0, "without_diagram": 0, "overridden": 0}
+        self._reasons: Dict[str, int] = {}
+
+    def record(self, with_diagram: bool, reason: str, overridden: bool) -> None:
+        with self._lock:
+            self._stats["with_diagram" if with_diagram else "without_diagram"] += 1
+            if overridden:
+                self._stats["overridden"] += 1
+            # Count by reason kind, not by the matched term
+            kind = reason.split(":")[0]
+            self._reasons[kind] = self._reasons.get(kind, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get decision counters.
+
+        Returns:
+            dict: Decisions with and without a diagram, overrides and counts per reason
+        """
+        with self._lock:
+            return {**self._stats, "reasons": dict(self._reasons)}
@@ -0,0 +1,224 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, AsyncIterator
+from metrics import SCHEDULER_WAIT_SECONDS
+import asyncio
+import time
+
+# Absolute time.monotonic() deadline of the request being served, if any
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+class SchedulerOverloaded(Exception):
+    """Raised when a call is shed because it cannot start in time."""
+
+    def __init__(self, provider: str, retry_after: float, status_code: int = 503):
+        super().__init__(f"{provider} is overloaded, retry in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = max(1.0, retry_after)
+        self.status_code = status_code
+
+class Reservation:
+    """A granted scheduler slot, used to report the actual token usage of the call."""
+
+    def __init__(self, lane: "_Lane", estimated_tokens: int):
+        self._lane = lane
+        self.estimated_tokens = estimated_tokens
+
+    def record_usage(self, message: Any) -> None:
+        """
+        Refund or charge the difference between estimated and actual tokens.
+
+        Args:
+            message: Model response carrying LangChain usage_metadata
+        """
+        usage = getattr(message, "usage_metadata", None) or {}
+        actual = usage.get("total_tokens")
+        if actual is not None:
+            self._lane.adjust_tokens(self.estimated_tokens - actual)
+            self.estimated_tokens = actual
+
+class _Lane:
+    """Concurrency limit, token bucket and FIFO wait queue of one provider/model."""
+
+    def __init__(self, name: str, concurrency: Optional[int], tokens_per_minute: Optional[int]):
+        self.name = name
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = float(tokens_per_minute or 0)
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.waiters: deque = deque()
+        self.service_seconds: Optional[float] = None
+        self.completed = 0
+        self.shed = 0
+        self.waits: deque = deque(maxlen=1000)
+
+    def refill(self) -> None:
+        if not self.tokens_per_minute:
+            return
+        now = time.monotonic()
+        self.tokens = min(
+            float(self.tokens_per_minute),
+            self.tokens + (now - self.refilled) * self.tokens_per_minute / 60
+        )
+        self.refilled = now
+
+    def adjust_tokens(self, delta: float) -> None:
+        if self.tokens_per_minute:
+            self.refill()
+            self.tokens = min(float(self.tokens_per_minute), self.tokens + delta)
+
+    def estimated_wait(self, tokens: int) -> float:
+        """Seconds until a new call for the given tokens could start."""
+        wait = 0.0
+        if self.concurrency is not None and (self.active >= self.concurrency or self.waiters):
+            wait = (len(self.waiters) + 1) / self.concurrency * (self.service_seconds or 0.0)
+        if self.tokens_per_minute:
+            self.refill()
+            deficit = tokens - self.tokens
+            if deficit > 0:
+                wait = max(wait, deficit * 60 / self.tokens_per_minute)
+        return wait
+
+    def release(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the oldest waiter
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+class ProviderScheduler:
+    """
+    Process-wide admission control for upstream model calls.
+
+    Every provider/model gets its own lane with a concurrency limit served in
+    FIFO order and a tokens-per-minute bucket. A call whose request deadline
+    cannot be met given the current queue is rejected up front with
+    SchedulerOverloaded, so overload turns into fast 429/503 responses rather
+    than upstream rate limit errors and piling threads. Lanes without limits
+    admit calls immediately.
+    """
+
+    def __init__(self):
+        self._lanes: Dict[str, _Lane] = {}
+
+    def configure(self, provider: str, concurrency: Optional[int] = None,
+                  tokens_per_minute: Optional[int] = None) -> None:
+        """
+        Set the limits of a provider lane.
+
+        Args:
+            provider (str): Lane name, e.g. "openai:gpt-4o"
+            concurrency (int, optional): Maximum concurrent calls, unlimited when None
+            tokens_per_minute (int, optional): Token budget per minute, unlimited when None
+        """
+        self._lanes[provider] = _Lane(provider, concurrency or None, tokens_per_minute or None)
+
+    def _lane(self, provider: str) -> _Lane:
+        if provider not in self._lanes:
+            self.configure(provider)
+        return self._lanes[provider]
+
+    @asynccontextmanager
+    async def slot(self, provider: str, estimated_tokens: int = 0,
+                   deadline: Optional[float] = None) -> AsyncIterator[Reservation]:
+        """
+        Wait for permission to call a provider.
+
+        Args:
+            provider (str): Lane name, e.g. "openai:gpt-4o"
+            estimated_tokens (int): Prompt plus completion tokens the call may use
+            deadline (float, optional): time.monotonic() deadline, defaults to the request deadline
+
+        Yields:
+            Reservation: Handle to report the actual token usage
+
+        Raises:
+            SchedulerOverloaded: When the call cannot start before the deadline
+        """
+        lane = self._lane(provider)
+        deadline = deadline if deadline is not None else request_deadline.get()
+        queued = time.monotonic()
+
+        expected_wait = lane.estimated_wait(estimated_tokens)
+        if deadline is not None and queued + expected_wait + (lane.service_seconds or 0.0) > deadline:
+            lane.shed += 1
+            rate_limited = lane.tokens_per_minute and lane.tokens < estimated_tokens
+            raise SchedulerOverloaded(provider, expected_wait, 429 if rate_limited else 503)
+
+        # Take tokens up front; a negative balance is repaid by waiting
+        if lane.tokens_per_minute:
+            lane.refill()
+            lane.tokens -= estimated_tokens
+            if lane.tokens < 0:
+                try:
+                    await asyncio.sleep(-lane.tokens * 60 / lane.tokens_per_minute)
+                except asyncio.CancelledError:
+                    lane.adjust_tokens(estimated_tokens)
+                    raise
+
+        if lane.concurrency is not None:
+            if lane.active < lane.concurrency and not lane.waiters:
+                lane.active += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                lane.waiters.append(waiter)
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    await asyncio.wait_for(waiter, timeout)
+                except asyncio.TimeoutError:
+                    lane.shed += 1
+                    lane.adjust_tokens(estimated_tokens)
+                    raise SchedulerOverloaded(provider, lane.estimated_wait(estimated_tokens))
+                except asyncio.CancelledError:
+                    # The slot may have been handed over just before cancellation
+                    if waiter.done() and not waiter.cancelled():
+                        lane.release()
+                    lane.adjust_tokens(estimated_tokens)
+                    raise
+
+        started = time.monotonic()
+        lane.waits.append(started - queued)
+        SCHEDULER_WAIT_SECONDS.observe(started - queued, provider=provider)
+        try:
+            yield Reservation(lane, estimated_tokens)
+        finally:
+            duration = time.monotonic() - started
+            lane.service_seconds = duration if lane.service_seconds is None else (
+                0.9 * lane.service_seconds + 0.1 * duration
+            )
+            lane.completed += 1
+            if lane.concurrency is not None:
+                lane.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get live queue depth and wait time statistics of every lane.
+
+        Returns:
+            dict: Statistics per provider lane
+        """
+        stats = {}
+        for name, lane in self._lanes.items():
+            lane.refill()
+            waits = sorted(lane.waits)
+            stats[name] = {
+                "concurrency_limit": lane.concurrency,
+                "tokens_per_minute": lane.tokens_per_minute,
+                "tokens_available": round(lane.tokens) if lane.tokens_per_minute else None,
+                "active": lane.active,
+                "queued": sum(1 for waiter in lane.waiters if not waiter.done()),
+                "completed": lane.completed,
+                "shed": lane.shed,
+                "avg_service_ms": round((lane.service_seconds or 0.0) * 1000, 1),
+                "avg_wait_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                "p95_wait_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "max_wait_ms": round(waits[-1] * 1000, 1) if waits else 0.0
+            }
+        return stats
+
+# The scheduler shared by every agent in this process
+shared_scheduler = ProviderScheduler()
@@ -0,0 +1,362 @@
+from collections import OrderedDict
+from PIL import Image
+from typing import Optional, Dict, Any, List, Tuple
+from cache import normalize_question
+import json
+import logging
+import math
+import os
+import re
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Side of the grayscale thumbnail the perceptual hash is computed from
+PHASH_SIZE = 32
+
+# Low frequency DCT-II basis rows used by perceptual_hash
+_DCT_BASIS = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SIZE)) for x in range(PHASH_SIZE)]
+    for u in range(8)
+]
+
+# Punctuation that does not change what a question asks; operators and brackets do
+_IGNORED_PUNCTUATION = set(".,;:!?\"'`")
+_TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)?|\w+|[^\w\s]")
+
+# Words that only phrase the request; rewording them does not change the problem.
+# Anything that could name a quantity, an object or a direction ("to", "from",
+# "in", "not") is deliberately left out
+_FILLER_WORDS = {
+    "an", "the", "this", "that", "these", "those", "what", "which", "is", "are",
+    "was", "were", "be", "of", "please", "find", "calculate", "compute", "determine",
+    "evaluate", "solve", "work", "out", "give", "tell", "show", "me", "us", "can", "could",
+    "would", "you", "help", "we", "need", "answer", "value", "question", "problem",
+    "following", "given", "below", "above", "here", "shown", "image", "picture", "photo"
+}
+
+def perceptual_hash(img: Image.Image) -> int:
+    """
+    Compute a 64 bit DCT perceptual hash (pHash) of an image.
+
+    The hash keeps the sign of the 8x8 lowest frequencies of a 32x32
+    grayscale thumbnail relative to their median. It survives re-encoding,
+    rescaling and small crops, so re-photographed copies of the same page
+    land close together in Hamming distance.
+
+    Args:
+        img (Image.Image): Decoded image
+
+    Returns:
+        int: 64 bit perceptual hash
+    """
+    small = img.resize((PHASH_SIZE, PHASH_SIZE), Image.BOX, reducing_gap=2.0).convert("L")
+    pixels = list(small.getdata())
+    rows = [pixels[y * PHASH_SIZE:(y + 1) * PHASH_SIZE] for y in range(PHASH_SIZE)]
+    row_coeffs = [[sum(c * p for c, p in zip(basis, row)) for basis in _DCT_BASIS] for row in rows]
+    coeffs = [
+        sum(c * row_coeffs[y][v] for y, c in enumerate(_DCT_BASIS[u]))
+        for u in range(8)
+        for v in range(8)
+    ]
+    # The DC term only reflects overall brightness, keep it out of the median
+    median = sorted(coeffs[1:])[len(coeffs) // 2]
+    value = 0
+    for coeff in coeffs:
+        value = (value << 1) | (1 if coeff > median else 0)
+    return value
+
+def _term(token: str) -> str:
+    """Fold the plural of a word onto its singular; numbers, symbols and short words stay as they are."""
+    if len(token) > 3 and token.isalpha() and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+def question_key(question: str) -> str:
+    """
+    Reduce a question to the terms a reused answer must match.
+
+    Rewording is tolerated: case, whitespace, sentence punctuation, plurals
+    and filler words that only phrase the request ("what is", "find",
+    "calculate", "the", ...) are ignored, so "What is the area of the
+    triangles?" and "Find area of triangle" share a key. Everything that
+    could change the problem is kept, in order: numbers, mathematical
+    symbols, variables and every other word. So "sphere" vs "cylinder",
+    "part a" vs "part b", "sin" vs "cos" or "12 divided by 4" vs "4 divided
+    by 12" never match.
+
+    Args:
+        question (str): Question text
+
+    Returns:
+        str: Space separated terms
+    """
+    tokens = _TOKEN_PATTERN.findall(normalize_question(question))
+    terms = []
+    for i, token in enumerate(tokens):
+        if token in _IGNORED_PUNCTUATION or token in _FILLER_WORDS:
+            continue
+        following = tokens[i + 1] if i + 1 < len(tokens) else ""
+        # "a" and "s" are variables too, only drop the article and the "'s" of a possessive
+        if token == "a" and following.isalpha() and len(following) > 1:
+            continue
+        if token == "s" and i > 0 and tokens[i - 1] == "'":
+            continue
+        terms.append(_term(token))
+    return " ".join(terms)
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two perceptual hashes."""
+    return (a ^ b).bit_count()
+
+class SimilarityIndex:
+    """
+    Index of previously answered problems.
+
+    A problem is reused when its question has the same key terms (see
+    question_key) and its image is within max_hamming of the indexed image's
+    perceptual hash, so re-photographed copies of a worksheet share an
+    answer. Answers of other models or prompt versions are never reused.
+    Images are indexed with banded perceptual hashes, so a lookup only
+    verifies a handful of candidates: the hash is split into max_hamming + 1
+    bands, and any two images within the distance share at least one band.
+
+    Entries are appended to a JSON lines file. Every process reads the lines
+    other workers append before each lookup, and the oldest entries are
+    dropped past max_entries; the file is compacted once it holds twice as
+    many lines. An entry another worker appends while the file is compacted
+    may be lost, it is only an optimization.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_hamming: int = 10,
+                 max_entries: int = 10000):
+        """
+        Initialize the SimilarityIndex.
+
+        Args:
+            path (str, optional): JSON lines file backing the index
+            max_hamming (int): Largest perceptual hash distance that counts as the same image
+            max_entries (int): Maximum number of indexed problems, the oldest are dropped first
+        """
+        self.path = path
+        self.max_hamming = max_hamming
+        self.max_entries = max_entries
+        # id -> entry, oldest first
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        # (model_key, question key, phash) -> id
+        self._exact: Dict[Tuple[str, str, Optional[str]], int] = {}
+        # (model_key, question key, band, band value) -> ids
+        self._image_buckets: Dict[Tuple[str, str, int, int], set] = {}
+        self._phash_bands = self._make_bands(max_hamming + 1)
+        self._lock = threading.Lock()
+        # Identity of the file read so far, how far it was read and how many lines it has
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._offset = 0
+        self._file_lines = 0
+        self._stats = {"hits": 0, "misses": 0, "skipped_lines": 0, "compactions": 0}
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                self._refresh()
+
+    @staticmethod
+    def _make_bands(count: int) -> List[Tuple[int, int]]:
+        """Split the 64 hash bits into (shift, mask) pairs of near equal width."""
+        bands = []
+        shift = 0
+        for band in range(count):
+            width = 64 // count + (1 if band < 64 % count else 0)
+            bands.append((shift, (1 << width) - 1))
+            shift += width
+        return bands
+
+    def _band_keys(self, model_key: str, key: str, phash: int) -> List[Tuple[str, str, int, int]]:
+        return [
+            (model_key, key, band, (phash >> shift) & mask)
+            for band, (shift, mask) in enumerate(self._phash_bands)
+        ]
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._exact.clear()
+        self._image_buckets.clear()
+        self._offset = self._file_lines = 0
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        self._exact.pop((entry["model_key"], entry["key"], entry.get("phash")), None)
+        if entry.get("phash") is not None:
+            for band_key in self._band_keys(entry["model_key"], entry["key"], entry["phash_int"]):
+                self._image_buckets[band_key].discard(entry_id)
+                if not self._image_buckets[band_key]:
+                    del self._image_buckets[band_key]
+
+    def _insert(self, record: Dict[str, Any]) -> None:
+        entry = {
+            "question": record["question"],
+            "phash": record.get("phash"),
+            "model_key": record.get("model_key", ""),
+            "answer": record["answer"],
+            "subject": record["subject"],
+            "diagram": record["diagram"]
+        }
+        entry["key"] = question_key(entry["question"])
+        if entry["phash"] is not None:
+            entry["phash_int"] = int(entry["phash"], 16)
+        exact = (entry["model_key"], entry["key"], entry["phash"])
+        if exact in self._exact:
+            # A later answer to the same problem replaces the earlier one
+            self._remove(self._exact[exact])
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self._exact[exact] = entry_id
+        if entry["phash"] is not None:
+            for band_key in self._band_keys(entry["model_key"], entry["key"], entry["phash_int"]):
+                self._image_buckets.setdefault(band_key, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _refresh(self) -> None:
+        """Read the lines appended to the file since the last call, everything when it was replaced."""
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        file_id = (status.st_dev, status.st_ino)
+        if file_id != self._file_id or status.st_size < self._offset:
+            self._clear()
+            self._file_id = file_id
+        if status.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(status.st_size - self._offset)
+        # A line another worker is still writing is read on a later refresh
+        complete = data.rfind(b"\n") + 1
+        self._offset += complete
+        skipped = 0
+        for line in data[:complete].splitlines():
+            if not line.strip():
+                continue
+            self._file_lines += 1
+            try:
+                self._insert(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                skipped += 1
+        if skipped:
+            self._stats["skipped_lines"] += skipped
+            logger.warning("Skipped %d unreadable lines of the similarity index %s", skipped, self.path)
+
+    def _compact(self) -> None:
+        """Rewrite the file with the entries kept in memory."""
+        temporary = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(self._record(entry)) + "\n")
+        os.replace(temporary, self.path)
+        status = os.stat(self.path)
+        self._file_id = (status.st_dev, status.st_ino)
+        self._offset = status.st_size
+        self._file_lines = len(self._entries)
+        self._stats["compactions"] += 1
+
+    @staticmethod
+    def _record(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {name: entry[name] for name in ("question", "phash", "model_key", "answer", "subject", "diagram")}
+
+    def lookup(self, question: str, phash: Optional[str] = None,
+               model_key: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Find a previously answered problem close enough to reuse its answer.
+
+        Args:
+            question (str): Question text
+            phash (str, optional): Hex perceptual hash of the image
+            model_key (str): Models and prompt versions the answer must come from
+
+        Returns:
+            dict: Stored answer, subject and diagram with the image distance, or None
+        """
+        key = question_key(question)
+        if not key and phash is None:
+            # "Solve this" without an image says nothing about the problem
+            return None
+        best = None
+        best_distance = 0
+        with self._lock:
+            if self.path:
+                self._refresh()
+            if phash is None:
+                entry_id = self._exact.get((model_key, key, None))
+                best = self._entries.get(entry_id) if entry_id is not None else None
+            else:
+                query_phash = int(phash, 16)
+                candidates = set()
+                for band_key in self._band_keys(model_key, key, query_phash):
+                    candidates.update(self._image_buckets.get(band_key, ()))
+                for entry_id in candidates:
+                    entry = self._entries[entry_id]
+                    distance = hamming_distance(query_phash, entry["phash_int"])
+                    if distance <= self.max_hamming and (best is None or distance < best_distance):
+                        best, best_distance = entry, distance
+            self._stats["hits" if best else "misses"] += 1
+
+        if best is None:
+            return None
+        return {
+            "answer": best["answer"],
+            "subject": best["subject"],
+            "diagram": best["diagram"],
+            "image_distance": best_distance
+        }
+
+    def add(self, question: str, phash: Optional[str], answer: str,
+            subject: str, diagram: str, model_key: str = "") -> None:
+        """
+        Add an answered problem to the index.
+
+        Args:
+            question (str): Question text
+            phash (str, optional): Hex perceptual hash of the image
+            answer (str): Answer returned for the problem
+            subject (str): Subject returned for the problem
+            diagram (str): Diagram returned for the problem
+            model_key (str): Models and prompt versions that produced the answer and diagram
+        """
+        record = {
+            "question": question,
+            "phash": phash,
+            "model_key": model_key,
+            "answer": answer,
+            "subject": subject,
+            "diagram": diagram
+        }
+        if not question_key(question) and phash is None:
+            return
+        with self._lock:
+            if not self.path:
+                self._insert(record)
+                return
+            self._refresh()
+            if (model_key, question_key(question), phash) in self._exact:
+                return
+            # One write of the whole line, so lines of concurrent workers do not interleave
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(record) + "\n").encode())
+            finally:
+                os.close(fd)
+            self._refresh()
+            if self._file_lines > 2 * self.max_entries:
+                self._compact()
+
+    def stats(self) -> Dict[str, Any]:
+        """Get lookup counters and the number of indexed problems."""
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, **self._stats}
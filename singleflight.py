@@ -0,0 +1,88 @@
+from typing import Any, Awaitable, Callable, Dict
+import asyncio
+from metrics import record_outcome
+
+class _Flight:
+    """An upstream call in flight and the number of requests waiting for it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesce identical in-flight calls into one.
+
+    The first request for a key (the leader) starts the call as a task on the
+    event loop; requests for the same key arriving before it finishes
+    (followers) wait for that task instead of starting their own, and all of
+    them get its result or its exception. A waiter that disconnects only stops
+    waiting: the call is cancelled once no request is waiting for it anymore.
+
+    The call runs in the context of the leader, so its request deadline and
+    trace apply to the shared upstream call.
+    """
+
+    def __init__(self):
+        """Initialize the SingleFlight."""
+        self._flights: Dict[str, _Flight] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def run(self, kind: str, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a call, or wait for the identical call already in flight.
+
+        Args:
+            kind (str): Call kind the counters are kept for, e.g. "answer"
+            key (str): Content address of the call, e.g. a response cache key
+            call: Coroutine function producing the result
+
+        Returns:
+            Any: Result of the shared call
+        """
+        counters = self._stats.setdefault(kind, {"leaders": 0, "followers": 0, "cancelled": 0})
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(call()))
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            self._flights[key] = flight
+            role = "leader"
+        else:
+            role = "follower"
+        counters[f"{role}s"] += 1
+        record_outcome(f"coalesce_{kind}", role)
+
+        flight.waiters += 1
+        try:
+            # shield keeps one waiter's cancellation from cancelling the call of the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # The last waiter left; a new request must not join the cancelled call
+                self._forget(key, flight)
+                flight.task.cancel()
+                counters["cancelled"] += 1
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _finish(self, key: str, flight: _Flight) -> None:
+        self._forget(key, flight)
+        # Waiters cancelled as the call failed leave its exception unretrieved
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get calls in flight and leader, follower and cancellation counters per kind.
+
+        Returns:
+            dict: Coalescing statistics
+        """
+        return {
+            "in_flight": len(self._flights),
+            "waiting": sum(flight.waiters for flight in self._flights.values()),
+            "kinds": {kind: dict(counters) for kind, counters in self._stats.items()}
+        }
@@ -0,0 +1,119 @@
+from typing import Optional
+import re
+import xml.etree.ElementTree as ET
+
+SVG_OPEN = "<svg"
+SVG_CLOSE = "</svg>"
+
+# Decimal places kept in attribute values, well below a pixel at diagram sizes
+COORDINATE_PRECISION = 2
+
+# Attributes whose values are names, not numbers
+NON_NUMERIC_ATTRIBUTES = {"id", "class", "href", "xlink:href", "font-family"}
+
+COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+TEXT_ELEMENT = re.compile(r"(<text\b.*?</text>)", re.DOTALL)
+TAG = re.compile(r"<[^>]+>")
+ATTRIBUTE = re.compile(r'([\w:-]+)\s*=\s*"([^"]*)"')
+DECIMAL = re.compile(r"-?\d*\.\d+")
+
+class SvgStreamExtractor:
+    """
+    Extracts the first SVG document from streamed model output.
+
+    Text before "<svg" is dropped as it arrives and completion is detected
+    as soon as "</svg>" is seen, even when either tag is split across chunks,
+    so the caller can stop the generation right away.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._started = False
+        self._searched = 0
+        self.done = False
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Add a chunk of model output.
+
+        Args:
+            chunk (str): Next piece of generated text
+
+        Returns:
+            bool: True once the closing tag has been seen
+        """
+        if self.done:
+            return True
+        self._buffer += chunk
+        if not self._started:
+            start = self._buffer.find(SVG_OPEN)
+            if start < 0:
+                # Keep a tail in case the opening tag is split across chunks
+                self._buffer = self._buffer[-(len(SVG_OPEN) - 1):]
+                return False
+            self._buffer = self._buffer[start:]
+            self._started = True
+        end = self._buffer.find(SVG_CLOSE, self._searched)
+        if end >= 0:
+            self._buffer = self._buffer[:end + len(SVG_CLOSE)]
+            self.done = True
+        else:
+            self._searched = max(0, len(self._buffer) - len(SVG_CLOSE) + 1)
+        return self.done
+
+    @property
+    def svg(self) -> str:
+        """The complete SVG document, or an empty string if none was seen."""
+        return self._buffer if self.done else ""
+
+def _trim_number(match: re.Match) -> str:
+    value = round(float(match.group(0)), COORDINATE_PRECISION)
+    text = f"{value:.{COORDINATE_PRECISION}f}".rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+def _minify_tag(match: re.Match) -> str:
+    if match.group(0).startswith(("<?", "<!")):
+        # Declarations and processing instructions carry versions, not coordinates
+        return match.group(0)
+
+    def attribute(attr: re.Match) -> str:
+        name, value = attr.group(1), " ".join(attr.group(2).split())
+        if name not in NON_NUMERIC_ATTRIBUTES:
+            value = DECIMAL.sub(_trim_number, value)
+        return f'{name}="{value}"'
+    tag = ATTRIBUTE.sub(attribute, match.group(0))
+    tag = re.sub(r"\s+", " ", tag)
+    return re.sub(r"\s*(/?>)$", r"\1", tag)
+
+def minify_svg(svg: str) -> Optional[str]:
+    """
+    Validate and minify an SVG document.
+
+    Comments and whitespace between tags are dropped, whitespace runs are
+    collapsed and decimals in attribute values are rounded to
+    COORDINATE_PRECISION places. Whitespace inside <text> elements is only
+    collapsed, since it can be significant there.
+
+    Args:
+        svg (str): SVG document
+
+    Returns:
+        str: Minified SVG, or None if the document is not well-formed SVG
+    """
+    try:
+        root = ET.fromstring(svg)
+    except ET.ParseError:
+        return None
+    if root.tag.rsplit("}", 1)[-1] != "svg":
+        return None
+
+    svg = COMMENT.sub("", svg)
+    parts = []
+    for index, part in enumerate(TEXT_ELEMENT.split(svg)):
+        if index % 2:
+            part = re.sub(r"\s+", " ", part)
+        else:
+            part = re.sub(r">\s+", ">", part)
+            part = re.sub(r"\s+<", "<", part).strip()
+        parts.append(TAG.sub(_minify_tag, part))
+    return "".join(parts)
@@ -0,0 +1,53 @@
+import pytest
+from cascade import check_answer, latex_problem
+
+STEPS = (
+    "The triangle has base 4 and height 3, so the area is "
+    "$$A = \\frac{1}{2} \\cdot 4 \\cdot 3 = 6$$ square units."
+)
+
+def answer(text, subject="Math", confidence=0.9):
+    return {"answer": text, "subject": subject, "confidence": confidence}
+
+@pytest.mark.parametrize("response", [
+    answer(STEPS),
+    answer("Paris is the capital of France.", "Geography"),
+    answer("Paris.", "Geography"),
+    answer(STEPS, confidence=95),
+    answer("The price went from $5 to $7, an increase of $2 or 40 percent.", "Economics"),
+    answer("$$\\left( \\begin{matrix} 1 & 0 \\\\ 0 & 1 \\end{matrix} \\right)$$ is the identity matrix of size 2."),
+])
+def test_accepted(response):
+    assert check_answer(response) == (True, "accepted")
+
+@pytest.mark.parametrize("response, truncated, reason", [
+    (None, False, "parse"),
+    (answer(STEPS), True, "truncated"),
+    (answer(STEPS, confidence=0.5), False, "confidence"),
+    (answer(STEPS, confidence=None), False, "confidence"),
+    (answer("", "General"), False, "length"),
+    (answer("   ", "General"), False, "length"),
+    (answer("The slope is 3."), False, "length"),
+    (answer("x = 4", "Algebra"), False, "length"),
+    (answer("I cannot determine the length from the image.", "General"), False, "hedging"),
+    (answer("There is not enough information to find the angle of the triangle."), False, "hedging"),
+    (answer("The volume of the sphere is $$\\frac{4}{3}\\pi r^3 = 36\\pi"), False, "latex"),
+    (answer("The volume of the sphere is $$\\frac{4}{3\\pi r^3$$ cubic units."), False, "latex"),
+])
+def test_escalated(response, truncated, reason):
+    assert check_answer(response, truncated) == (False, reason)
+
+def test_min_confidence_is_configurable():
+    assert check_answer(answer(STEPS, confidence=0.5), min_confidence=0.4) == (True, "accepted")
+
+@pytest.mark.parametrize("text, problem", [
+    ("Area $$A = 6$$ and price $5", None),
+    ("$$\\{1, 2\\}$$", None),
+    ("$$x$$ and $$y", "unclosed $$"),
+    ("$$}x{$$", "unbalanced braces"),
+    ("$$\\left( x$$", "unmatched \\left"),
+    ("$$\\begin{pmatrix} 1 \\end{matrix}$$", "unmatched environment"),
+    ("$$\\begin{cases} x $$", "unmatched environment"),
+])
+def test_latex_problem(text, problem):
+    assert latex_problem(text) == problem
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from job_worker import JobWorker
+from jobs import JobQueue, JOB_FAILED, JOB_QUEUED
+from resilience import CircuitOpen, DeadlineExceeded
+
+class FailingChain:
+    """Graph stand-in whose every call raises the same error."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+        self.calls = 0
+
+    async def ainvoke(self, state):
+        self.calls += 1
+        raise self.error
+
+def make_worker(tmp_path, error: Exception) -> JobWorker:
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=3, retry_backoff_seconds=0)
+    return JobWorker(queue, FailingChain(error), worker_id="worker")
+
+def run_claimed(worker: JobWorker) -> bool:
+    job = worker.queue.claim(worker.worker_id, lease_seconds=60)
+    if job is None:
+        return False
+    asyncio.run(worker._run_job(job))
+    return True
+
+def test_job_timing_out_every_attempt_fails_after_max_attempts(tmp_path):
+    worker = make_worker(tmp_path, DeadlineExceeded("bedrock:claude", 30))
+    job, _ = worker.queue.submit("What is 2 + 2?")
+
+    while run_claimed(worker):
+        pass
+
+    stored = worker.queue.get(job["job_id"])
+    assert stored["status"] == JOB_FAILED
+    assert stored["attempts"] == 3
+    assert "did not answer" in stored["error"]
+    assert worker.chain.calls == 3
+    assert worker.stats()["retried"] == 2 and worker.stats()["failed"] == 1
+
+def test_open_circuit_puts_job_back_without_using_an_attempt(tmp_path):
+    worker = make_worker(tmp_path, CircuitOpen("bedrock:claude", 0))
+    job, _ = worker.queue.submit("What is 2 + 2?")
+
+    assert run_claimed(worker)
+
+    stored = worker.queue.get(job["job_id"])
+    assert stored["status"] == JOB_QUEUED
+    assert stored["attempts"] == 0
+    assert worker.stats()["released"] == 1
+    # Put back for the circuit's retry_after, not claimable right away
+    assert not run_claimed(worker)
+
+class HangingChain:
+    """Graph stand-in that never answers."""
+
+    async def ainvoke(self, state):
+        await asyncio.Event().wait()
+
+def test_cancelled_job_is_handed_back_without_using_an_attempt(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=3)
+    worker = JobWorker(queue, HangingChain(), worker_id="worker")
+    job, _ = queue.submit("What is 2 + 2?")
+
+    async def run_and_cancel():
+        running = asyncio.create_task(worker._run_job(queue.claim(worker.worker_id, lease_seconds=60)))
+        await asyncio.sleep(0.05)
+        running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+
+    asyncio.run(run_and_cancel())
+
+    stored = queue.get(job["job_id"])
+    assert stored["status"] == JOB_QUEUED
+    assert stored["attempts"] == 0
+    assert worker.stats()["released"] == 1 and worker.stats()["running"] == 0
@@ -0,0 +1,180 @@
+import io
+import os
+import time
+import pytest
+from PIL import Image
+from image_utils import process_image_bytes
+from jobs import (
+    JobQueue, IdempotencyConflict, JobQueueFull,
+    JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED
+)
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=3, retry_backoff_seconds=0)
+    yield queue
+    queue.close()
+
+def image(color=(255, 0, 0)):
+    data = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(data, "PNG")
+    return process_image_bytes(data.getvalue(), "problem.png")
+
+@pytest.fixture
+def later(monkeypatch):
+    """Move the clock the queue sees to the given seconds after the start of the test."""
+    start = time.time()
+
+    def move(seconds):
+        monkeypatch.setattr(time, "time", lambda: start + seconds)
+    return move
+
+def test_claim_takes_oldest_job_and_counts_the_attempt(queue):
+    first, _ = queue.submit("first")
+    queue.submit("second")
+
+    claimed = queue.claim("a", lease_seconds=60)
+
+    assert claimed["job_id"] == first["job_id"]
+    assert claimed["status"] == JOB_RUNNING
+    assert claimed["attempts"] == 1
+    assert claimed["lease_owner"] == "a"
+
+def test_expired_lease_is_reclaimed_by_another_worker(queue):
+    job, _ = queue.submit("question")
+    queue.claim("a", lease_seconds=-1)
+
+    reclaimed = queue.claim("b", lease_seconds=60)
+
+    assert reclaimed["job_id"] == job["job_id"]
+    assert reclaimed["attempts"] == 2
+    # The first worker lost the lease: it can neither renew nor store a result
+    assert not queue.renew(job["job_id"], "a", 60)
+    assert not queue.complete(job["job_id"], "a", {"answer": "stale"})
+    assert queue.complete(job["job_id"], "b", {"answer": "4"})
+    assert queue.get(job["job_id"])["result"] == {"answer": "4"}
+
+def test_renewed_lease_is_not_reclaimed(queue):
+    queue.submit("question")
+    job = queue.claim("a", lease_seconds=-1)
+
+    assert queue.renew(job["job_id"], "a", 60)
+    assert queue.claim("b", lease_seconds=60) is None
+
+def test_expired_lease_on_last_attempt_fails_the_job(queue):
+    job, _ = queue.submit("question")
+    for _ in range(3):
+        assert queue.claim("a", lease_seconds=-1) is not None
+
+    assert queue.claim("b", lease_seconds=60) is None
+    stored = queue.get(job["job_id"])
+    assert stored["status"] == JOB_FAILED
+    assert stored["error"] == "Worker lease expired"
+
+def test_fail_retries_until_max_attempts(queue):
+    job, _ = queue.submit("question")
+    for attempt in (1, 2):
+        claimed = queue.claim("a", lease_seconds=60)
+        assert claimed["attempts"] == attempt
+        assert queue.fail(job["job_id"], "a", "upstream error", claimed["attempts"])
+        assert queue.get(job["job_id"])["status"] == JOB_QUEUED
+
+    claimed = queue.claim("a", lease_seconds=60)
+    assert queue.fail(job["job_id"], "a", "upstream error", claimed["attempts"])
+    stored = queue.get(job["job_id"])
+    assert stored["status"] == JOB_FAILED
+    assert stored["attempts"] == 3
+    assert stored["error"] == "upstream error"
+    assert queue.claim("a", lease_seconds=60) is None
+
+def test_fail_backs_off_exponentially(tmp_path, later):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=3, retry_backoff_seconds=10)
+    job, _ = queue.submit("question")
+    queue.fail(job["job_id"], "a", "error", queue.claim("a", 60)["attempts"])
+
+    assert queue.claim("a", 60) is None
+    later(11)
+    claimed = queue.claim("a", 60)
+    queue.fail(job["job_id"], "a", "error", claimed["attempts"])
+
+    # The second retry waits twice as long
+    later(11 + 15)
+    assert queue.claim("a", 60) is None
+    later(11 + 21)
+    assert queue.claim("a", 60)["attempts"] == 3
+
+def test_release_does_not_use_up_an_attempt(queue):
+    job, _ = queue.submit("question")
+    for _ in range(5):
+        claimed = queue.claim("a", lease_seconds=60)
+        assert claimed["attempts"] == 1
+        assert queue.release(job["job_id"], "a")
+
+    assert queue.get(job["job_id"])["attempts"] == 0
+    assert not queue.release(job["job_id"], "a")
+
+def test_release_delays_the_next_claim(queue, later):
+    job, _ = queue.submit("question")
+    queue.claim("a", lease_seconds=60)
+    queue.release(job["job_id"], "a", delay=5)
+
+    assert queue.claim("a", lease_seconds=60) is None
+    later(6)
+    assert queue.claim("a", lease_seconds=60)["job_id"] == job["job_id"]
+
+def test_idempotency_key_returns_the_existing_job(queue):
+    job, created = queue.submit("question", image(), idempotency_key="sheet-7")
+    again, created_again = queue.submit("question", image(), idempotency_key="sheet-7")
+
+    assert created and not created_again
+    assert again["job_id"] == job["job_id"]
+    assert queue.stats()["jobs"][JOB_QUEUED] == 1
+
+def test_idempotency_key_reused_for_other_inputs_conflicts(queue):
+    queue.submit("question", image(), idempotency_key="sheet-7")
+
+    with pytest.raises(IdempotencyConflict):
+        queue.submit("other question", image(), idempotency_key="sheet-7")
+    with pytest.raises(IdempotencyConflict):
+        queue.submit("question", image((0, 0, 255)), idempotency_key="sheet-7")
+
+def test_submit_refuses_beyond_max_pending(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_pending=2)
+    queue.submit("first")
+    queue.submit("second")
+
+    with pytest.raises(JobQueueFull):
+        queue.submit("third")
+
+def test_images_are_stored_once_and_restored(queue):
+    first, _ = queue.submit("first", image())
+    second, _ = queue.submit("second", image())
+
+    assert first["image_ref"] == second["image_ref"]
+    assert len(os.listdir(queue.images_dir)) == 1
+    restored = queue.load_image(first["image_ref"], first["image_meta"])
+    assert restored.data == image().data
+
+def test_purge_drops_expired_finished_jobs_and_their_images(queue, later):
+    done, _ = queue.submit("done", image())
+    waiting, _ = queue.submit("waiting", image((0, 0, 255)))
+    claimed = queue.claim("a", lease_seconds=60)
+    assert claimed["job_id"] == done["job_id"]
+    queue.complete(done["job_id"], "a", {"answer": "4"})
+
+    assert queue.purge() == 0
+    later(queue.ttl_seconds + 1)
+    assert queue.purge(image_grace_seconds=0) == 1
+
+    assert queue.get(done["job_id"]) is None
+    assert queue.get(waiting["job_id"])["status"] == JOB_QUEUED
+    assert os.listdir(queue.images_dir) == [f"{waiting['image_ref']}.img"]
+
+def test_stats_count_jobs_per_status(queue):
+    job, _ = queue.submit("first")
+    queue.submit("second")
+    queue.claim("a", lease_seconds=60)
+    queue.complete(job["job_id"], "a", {"answer": "4"})
+
+    jobs = queue.stats()["jobs"]
+    assert jobs[JOB_QUEUED] == 1 and jobs[JOB_SUCCEEDED] == 1 and jobs[JOB_RUNNING] == 0
@@ -0,0 +1,57 @@
+import pytest
+from similarity import SimilarityIndex, question_key
+
+PHASH = "f0e1d2c3b4a59687"
+# Three bits away from PHASH: the same page photographed again
+NEAR_PHASH = "f0e1d2c3b4a59680"
+
+@pytest.mark.parametrize("indexed, asked", [
+    ("What is the area of the triangles?", "Find area of triangle"),
+    ("What's the value of x?", "Find x."),
+    ("Calculate the volume of this sphere", "what is the volume of the sphere"),
+    ("Solve  2x + 3 = 7", "solve 2x + 3 = 7 please"),
+    ("Find the triangle's perimeter", "Find the triangle perimeter"),
+])
+def test_rewordings_match(indexed, asked):
+    assert question_key(indexed) == question_key(asked)
+
+@pytest.mark.parametrize("indexed, asked", [
+    ("What is the volume of the sphere?", "What is the volume of the cylinder?"),
+    ("Solve part a", "Solve part b"),
+    ("What is 12 divided by 4?", "What is 4 divided by 12?"),
+    ("Find sin 30", "Find cos 30"),
+    ("What is the capital of France?", "What is the capital of Spain?"),
+    ("Simplify 2 + 3i", "Simplify 2 + 3"),
+    ("If a = 5, find a + b", "If c = 5, find c + b"),
+    ("Convert 5 meters to feet", "Convert 5 feet to meters"),
+    ("Is x even?", "Is x not even?"),
+])
+def test_different_problems_do_not_match(indexed, asked):
+    assert question_key(indexed) != question_key(asked)
+
+def test_reworded_question_reuses_answer_of_near_image():
+    index = SimilarityIndex()
+    index.add("What is the area of the triangle?", PHASH, "6", "Math", "<svg/>", "qa:1")
+
+    match = index.lookup("Find area of triangle", NEAR_PHASH, "qa:1")
+    assert match["answer"] == "6"
+    assert match["image_distance"] == 3
+
+    assert index.lookup("Find perimeter of triangle", NEAR_PHASH, "qa:1") is None
+    assert index.lookup("Find area of triangle", NEAR_PHASH, "qa:2") is None
+    assert index.lookup("Find area of triangle", "0f1e2d3c4b5a6978", "qa:1") is None
+
+def test_text_only_question_without_terms_is_not_reused():
+    index = SimilarityIndex()
+    index.add("Solve this", None, "Please attach the problem", "General", "<svg/>")
+
+    assert index.lookup("Please solve this", None) is None
+    assert index.stats()["entries"] == 0
+
+def test_index_file_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "similarity.jsonl")
+    writer, reader = SimilarityIndex(path), SimilarityIndex(path)
+
+    writer.add("What is the area of the triangle?", PHASH, "6", "Math", "<svg/>")
+
+    assert reader.lookup("Find area of triangle", NEAR_PHASH)["answer"] == "6"
@@ -0,0 +1,57 @@
+import itertools
+import json
+import pytest
+from agents import StreamingAnswerParser
+
+PAYLOADS = [
+    '{"answer": "The area is 12 square units.", "subject": "Math"}',
+    '{"subject": "Math", "answer": "Use the formula\\nA = \\\\frac{1}{2}bh\\t(done)"}',
+    '{"answer": "She said \\"yes\\" and left\\\\", "subject": "English"}',
+    '{"answer": "a\\/b \\b\\f\\r end", "subject": "General"}',
+    '{"answer": "\\u00bd of 10 is 5 \\u2014 \\u03c0 \\u221a2", "subject": "Math"}',
+    '{"answer": "Great job \\ud83d\\ude00! \\ud835\\udc65\\u00b2", "subject": "General"}',
+    '{"answer": "Raw unicode: π ≈ 3.14 😀", "subject": "Math"}',
+    '{\n  "answer" :  "spaced key",\n  "subject": "General"\n}',
+    '{"answer": "", "subject": "General"}',
+]
+
+def decode(chunks):
+    parser = StreamingAnswerParser("answer")
+    streamed = "".join(parser.feed(chunk) for chunk in chunks)
+    return parser, streamed
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_every_two_chunk_split_matches_json_loads(payload):
+    expected = json.loads(payload)["answer"]
+    for split in range(len(payload) + 1):
+        parser, streamed = decode([payload[:split], payload[split:]])
+        assert streamed == expected, f"split at {split}"
+        assert parser.done
+        assert parser.text == payload
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_one_character_chunks_match_json_loads(payload):
+    parser, streamed = decode(list(payload))
+    assert streamed == json.loads(payload)["answer"]
+    assert parser.done
+
+def test_every_three_chunk_split_of_a_surrogate_pair():
+    payload = '{"answer": "x\\ud83d\\ude00y"}'
+    for first, second in itertools.combinations(range(len(payload) + 1), 2):
+        _, streamed = decode([payload[:first], payload[first:second], payload[second:]])
+        assert streamed == "x\U0001F600y", f"splits at {first}, {second}"
+
+def test_text_after_the_field_is_not_streamed():
+    parser, streamed = decode(['{"answer": "4"', ', "subject": "Math", "answer2": "no"}'])
+    assert streamed == "4"
+    assert parser.feed(" trailing") == ""
+    assert parser.text.endswith(" trailing")
+
+def test_nothing_is_streamed_before_the_field_starts():
+    parser = StreamingAnswerParser("answer")
+    assert parser.feed('{"subject": "Math", "ans') == ""
+    assert parser.feed('wer": "ok"}') == "ok"
+
+def test_streams_the_configured_field():
+    parser = StreamingAnswerParser("subject")
+    assert "".join(parser.feed(chunk) for chunk in ['{"answer": "4", "subj', 'ect": "Ma', 'th"}']) == "Math"
@@ -0,0 +1,58 @@
+import pytest
+from svg_utils import SvgStreamExtractor, minify_svg
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg"><rect width="1" height="1"/></svg>'
+
+def feed_all(chunks):
+    extractor = SvgStreamExtractor()
+    done = [extractor.feed(chunk) for chunk in chunks]
+    return extractor, done
+
+@pytest.mark.parametrize("split", range(1, len(SVG)))
+def test_extractor_finds_tags_split_at_any_point(split):
+    extractor, done = feed_all([SVG[:split], SVG[split:]])
+    assert done == [False, True]
+    assert extractor.svg == SVG
+
+def test_extractor_drops_text_before_svg_and_after_close():
+    extractor, done = feed_all(["Here is the diagram:\n<s", "vg xmlns='x'>", "<g/></sv", "g>\nIt shows a triangle."])
+    assert done == [False, False, False, True]
+    assert extractor.svg == "<svg xmlns='x'><g/></svg>"
+
+def test_extractor_reports_done_once_complete():
+    extractor, done = feed_all([SVG, "<svg>more</svg>"])
+    assert done == [True, True]
+    assert extractor.svg == SVG
+
+@pytest.mark.parametrize("chunks", [
+    ["I cannot draw this problem."],
+    ["<sv", "g><rect/>", "</sv"],
+    [""],
+])
+def test_extractor_without_complete_svg_returns_nothing(chunks):
+    extractor, done = feed_all(chunks)
+    assert not any(done)
+    assert extractor.svg == ""
+
+def test_minify_svg_output_is_stable():
+    # Cached diagrams are keyed by DIAGRAM_PROMPT_VERSION: bump it when this output changes
+    svg = """<?xml version="1.0"?>
+<!-- generated -->
+<svg xmlns="http://www.w3.org/2000/svg"   width="200.000" height="100" viewBox="0 0 200 100">
+  <g id="layer.1">
+    <circle cx="50.12345" cy="-0.001" r="20.5" />
+    <path d="M 10.3333 20.6666 L 30.999 40"/>
+  </g>
+  <text x="10" y="90.456">  Area  =  12 cm²  </text>
+</svg>"""
+    assert minify_svg(svg) == (
+        '<?xml version="1.0"?>'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100" viewBox="0 0 200 100">'
+        '<g id="layer.1"><circle cx="50.12" cy="0" r="20.5"/><path d="M 10.33 20.67 L 31 40"/></g>'
+        '<text x="10" y="90.46"> Area = 12 cm² </text>'
+        '</svg>'
+    )
+
+@pytest.mark.parametrize("document", ["<svg><rect></svg>", "<html><body/></html>", "not xml"])
+def test_minify_svg_rejects_malformed_or_non_svg(document):
+    assert minify_svg(document) is None